@@ -0,0 +1,88 @@
+"""
+Bandwidth/CPU trade-off of the x-shuffle-zlib payload compression.
+
+Encodes a smooth synthetic geophysical field and white noise with the client codec at several
+zlib levels, with and without the byte shuffle, and reports the compression ratio, codec
+throughput and the resulting end-to-end time of one transfer over links of various speeds.
+
+Usage:
+    PYTHONPATH=src python benchmarks/compression_benchmark.py [--size N] [--repeat R]
+"""
+import argparse
+import time
+import zlib
+
+import numpy as np
+
+from clients.cyberwater.lib import low_level_api
+
+# Link speeds (bits per second) for which the end-to-end transfer time is estimated
+LINK_SPEEDS = {'100 Mbit/s': 100e6, '1 Gbit/s': 1e9, '10 Gbit/s': 10e9}
+
+
+def smooth_field(n):
+    """ A smooth 2-D field, similar to a temperature or pressure grid, flattened to n doubles """
+    side = int(np.sqrt(n))
+    y, x = np.mgrid[0:side, 0:n // side]
+    field = 280.0 + 15.0 * np.sin(x / 40.0) * np.cos(y / 25.0) + 0.01 * x
+    return np.ascontiguousarray(field.ravel(), dtype='<f8')
+
+
+def timed(function, payload, repeat):
+    """ Best wall time of `repeat` calls of function(payload), and its last result """
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(payload)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--size', type=int, default=1_000_000, help="Number of doubles per payload")
+    parser.add_argument('--repeat', type=int, default=3, help="Repetitions per measurement (best is reported)")
+    args = parser.parse_args()
+
+    fields = {
+        'smooth': smooth_field(args.size),
+        'noise': np.random.default_rng(0).standard_normal(args.size).astype('<f8'),
+    }
+
+    header = f"{'field':<8} {'codec':<16} {'ratio':>6} {'enc MB/s':>9} {'dec MB/s':>9}"
+    header += "".join(f" {name:>12}" for name in LINK_SPEEDS)
+    print(f"Payload: {args.size} doubles ({args.size * 8 / 1e6:.1f} MB); link columns are ms per transfer")
+    print(header)
+
+    for field_name, field in fields.items():
+        raw = field.tobytes()
+        megabytes = len(raw) / 1e6
+        rows = [('raw', None, None)]
+        for level in (1, 3, 6):
+            rows.append((f"zlib-{level}", level, False))
+            rows.append((f"shuffle-zlib-{level}", level, True))
+
+        for codec, level, shuffle in rows:
+            if level is None:
+                encoded, encode_time, decode_time = raw, 0.0, 0.0
+            elif shuffle:
+                low_level_api.COMPRESSION_LEVEL = level
+                encode_time, encoded = timed(low_level_api.encode_payload, raw, args.repeat)
+                decode_time, decoded = timed(low_level_api.decode_payload, encoded, args.repeat)
+                assert decoded == raw
+            else:
+                encode_time, encoded = timed(lambda data: zlib.compress(data, level), raw, args.repeat)
+                decode_time, _ = timed(zlib.decompress, encoded, args.repeat)
+
+            ratio = len(raw) / len(encoded)
+            encode_rate = megabytes / encode_time if encode_time else float('inf')
+            decode_rate = megabytes / decode_time if decode_time else float('inf')
+            line = f"{field_name:<8} {codec:<16} {ratio:>6.2f} {encode_rate:>9.0f} {decode_rate:>9.0f}"
+            for speed in LINK_SPEEDS.values():
+                transfer_ms = (encode_time + len(encoded) * 8 / speed + decode_time) * 1e3
+                line += f" {transfer_ms:>12.1f}"
+            print(line)
+
+
+if __name__ == '__main__':
+    main()
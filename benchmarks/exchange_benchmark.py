@@ -0,0 +1,195 @@
+"""
+End-to-end throughput and latency of the exchange service.
+
+Starts exchange_server.py on a free local port (or uses the server given with --url) and
+drives it with simulated model pairs through the Python client: for every session, a producer
+thread sends one payload per variable and step while a consumer thread receives them. Every
+combination of payload size, number of variables and number of concurrent sessions is run for
+the given number of steps, and the messages/s, MB/s and p50/p99 step latency (from the start of
+the producer's step to the consumer having received all its variables) are reported.
+
+Results can be saved with --json and compared with an earlier run with --baseline, e.g. before
+and after a server change.
+
+Usage:
+    PYTHONPATH=src python benchmarks/exchange_benchmark.py [--sizes 1000 100000] [--variables 1 4]
+                                                          [--sessions 1 4] [--steps N] [--queue-depth D]
+                                                          [--server-args "--workers 2 --store shared"]
+                                                          [--url URL] [--json FILE] [--baseline FILE]
+"""
+import argparse
+import contextlib
+import itertools
+import json
+import os
+import shlex
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import numpy as np
+
+from clients.cyberwater.lib import low_level_api
+
+SERVER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'src', 'server')
+
+# Seconds each long-poll waits on the server, and number of consecutive empty waits after which a run fails
+WAIT_TIMEOUT = 5.0
+MAX_EMPTY_WAITS = 6
+
+# Initiator and invitee IDs of the simulated model pairs
+INITIATOR_ID = 3
+INVITEE_ID = 4
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+@contextlib.contextmanager
+def local_server(server_args):
+    """ Run exchange_server.py on a free loopback port and yield its URL """
+    port = free_port()
+    server = subprocess.Popen([sys.executable, 'exchange_server.py', '--host', '127.0.0.1', '--port', str(port)]
+                              + server_args, cwd=SERVER_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        deadline = time.monotonic() + 30
+        while True:
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=1).close()
+                break
+            except OSError:
+                if server.poll() is not None or time.monotonic() > deadline:
+                    raise RuntimeError("The exchange server did not start; run exchange_server.py with the same arguments to see why")
+                time.sleep(0.1)
+        yield f"http://127.0.0.1:{port}"
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def produce(server_url, session_id, var_ids, payload, steps, step_starts):
+    for step in range(steps):
+        step_starts[step] = time.perf_counter()
+        for var_id in var_ids:
+            response = low_level_api.send_data(server_url, session_id, var_id, payload)
+            while response.status_code == 409:
+                low_level_api.wait_for_queue_space(server_url, session_id, var_id, WAIT_TIMEOUT)
+                response = low_level_api.send_data(server_url, session_id, var_id, payload)
+            response.raise_for_status()
+
+
+def consume(server_url, session_id, var_ids, steps, step_ends):
+    for step in range(steps):
+        for var_id in var_ids:
+            empty_waits = 0
+            while low_level_api.wait_and_receive_data(server_url, session_id, var_id, WAIT_TIMEOUT) is None:
+                empty_waits += 1
+                if empty_waits == MAX_EMPTY_WAITS:
+                    raise RuntimeError(f"No data for variable {var_id} of session {session_id} at step {step}")
+        step_ends[step] = time.perf_counter()
+
+
+def run(server_url, run_id, size, variables, sessions, steps, queue_depth):
+    """ Exchange `steps` steps in `sessions` concurrent sessions and return the measurements """
+    var_ids = list(range(1, variables + 1))
+    payload = np.random.default_rng(run_id).standard_normal(size)
+    session_ids = []
+    for index in range(sessions):
+        session_info = low_level_api.create_session(
+            server_url, run_id, index, INITIATOR_ID, INVITEE_ID, var_ids, [size] * variables,
+            input_variables_queue_depth=[queue_depth] * variables)
+        session_id = session_info['session_id']
+        low_level_api.join_session(server_url, session_id, INVITEE_ID)
+        session_ids.append(session_id)
+
+    step_starts = [[0.0] * steps for _ in session_ids]
+    step_ends = [[0.0] * steps for _ in session_ids]
+    errors = []
+
+    def guarded(function, *args):
+        try:
+            function(*args)
+        except Exception as e:
+            errors.append(e)
+
+    threads = []
+    for session_id, starts, ends in zip(session_ids, step_starts, step_ends):
+        threads.append(threading.Thread(target=guarded, args=(produce, server_url, session_id, var_ids, payload, steps, starts)))
+        threads.append(threading.Thread(target=guarded, args=(consume, server_url, session_id, var_ids, steps, ends)))
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    for session_id in session_ids:
+        low_level_api.end_session(server_url, session_id, INITIATOR_ID)
+        low_level_api.end_session(server_url, session_id, INVITEE_ID)
+    if errors:
+        raise errors[0]
+
+    latencies = np.array(step_ends) - np.array(step_starts)
+    messages = sessions * variables * steps
+    return {
+        'size': size, 'variables': variables, 'sessions': sessions, 'steps': steps,
+        'messages_per_s': messages / elapsed,
+        'mb_per_s': messages * size * 8 / 1e6 / elapsed,
+        'p50_ms': float(np.percentile(latencies, 50)) * 1e3,
+        'p99_ms': float(np.percentile(latencies, 99)) * 1e3,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 100000], help="Payload sizes (number of doubles)")
+    parser.add_argument('--variables', type=int, nargs='+', default=[1, 4], help="Variables exchanged per session and step")
+    parser.add_argument('--sessions', type=int, nargs='+', default=[1, 4], help="Concurrent sessions (model pairs)")
+    parser.add_argument('--steps', type=int, default=100, help="Steps exchanged per session")
+    parser.add_argument('--queue-depth', type=int, default=1, help="Queue depth of every variable")
+    parser.add_argument('--compression', default=None, help="Payload compression of the client (e.g. x-shuffle-zlib)")
+    parser.add_argument('--server-args', default='', help="Extra arguments for exchange_server.py, as one string")
+    parser.add_argument('--url', default=None, help="URL of a running server to use instead of starting one")
+    parser.add_argument('--json', default=None, help="Write the results to this JSON file")
+    parser.add_argument('--baseline', default=None, help="JSON file of an earlier run to compare the results with")
+    args = parser.parse_args()
+
+    baseline = {}
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = {(r['size'], r['variables'], r['sessions']): r for r in json.load(f)['results']}
+
+    low_level_api.configure_client(pool_maxsize=2 * max(args.sessions) + 4, compression=args.compression)
+    server = contextlib.nullcontext(args.url) if args.url else local_server(shlex.split(args.server_args))
+
+    header = f"{'size':>9} {'vars':>5} {'sessions':>8} {'msgs/s':>10} {'MB/s':>9} {'p50 ms':>9} {'p99 ms':>9}"
+    if baseline:
+        header += f" {'msgs/s vs base':>15} {'p99 vs base':>12}"
+    print(header)
+
+    results = []
+    with server as server_url:
+        for run_id, (size, variables, sessions) in enumerate(itertools.product(args.sizes, args.variables, args.sessions), 1):
+            result = run(server_url, run_id, size, variables, sessions, args.steps, args.queue_depth)
+            results.append(result)
+            line = (f"{size:>9} {variables:>5} {sessions:>8} {result['messages_per_s']:>10.1f} {result['mb_per_s']:>9.1f} "
+                    f"{result['p50_ms']:>9.3f} {result['p99_ms']:>9.3f}")
+            base = baseline.get((size, variables, sessions))
+            if base is not None:
+                line += (f" {result['messages_per_s'] / base['messages_per_s'] - 1:>+15.1%}"
+                         f" {result['p99_ms'] / base['p99_ms'] - 1:>+12.1%}")
+            print(line, flush=True)
+
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump({'server_args': args.server_args, 'queue_depth': args.queue_depth,
+                       'compression': args.compression, 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
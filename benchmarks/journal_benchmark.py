@@ -0,0 +1,121 @@
+"""
+Cost of the session journal of the exchange server: added latency of /send_data and recovery time.
+
+Drives the server application in-process (through httpx's ASGI transport, so no network is
+involved) with the in-memory session store, once without and once with a journal, and times
+/send_data + /receive_data cycles. It then fills the journal with many sessions and times
+their recovery, as done at server startup.
+
+Usage:
+    PYTHONPATH=src/server python benchmarks/journal_benchmark.py [--sizes 1000 100000] [--iterations N]
+                                                                 [--sessions S] [--variables V] [--journal-dir DIR] [--fsync]
+"""
+import argparse
+import asyncio
+import os
+import shutil
+import statistics
+import tempfile
+import time
+
+import httpx
+import numpy as np
+
+import exchange_server
+
+
+def percentile(samples, q):
+    return float(np.percentile(samples, q)) * 1e3
+
+
+async def create_session(client, base, variables, size):
+    """ Create and join a session with `variables` input variables of `size` doubles """
+    response = await client.post("/create_session", json={
+        "source_model_ID": base, "destination_model_ID": 2, "initiator_id": 3, "invitee_id": 4,
+        "input_variables_ID": list(range(1, variables + 1)), "input_variables_size": [size] * variables,
+    })
+    session_id = response.json()["session_id"]
+    await client.post("/join_session", json={"session_id": session_id, "invitee_id": 4})
+    return session_id
+
+
+async def time_send_data(store, size, iterations):
+    """ Latencies (in seconds) of /send_data for payloads of `size` doubles, each followed by a /receive_data """
+    exchange_server.sessions = store
+    payload = np.random.default_rng(0).standard_normal(size).astype('<f8').tobytes()
+    transport = httpx.ASGITransport(app=exchange_server.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        session_id = await create_session(client, 1, 1, size)
+        headers = {'Session-ID': session_id, 'Var-ID': '1'}
+        latencies = []
+        for _ in range(iterations):
+            start = time.perf_counter()
+            response = await client.post("/send_data", content=payload, headers=headers)
+            latencies.append(time.perf_counter() - start)
+            assert response.status_code == 200, response.text
+            await client.get("/receive_data", params={'session_id': session_id, 'var_id': 1})
+    return latencies
+
+
+async def fill_sessions(store, sessions, variables, size):
+    """ Create `sessions` sessions with a payload of `size` doubles for each of their `variables` """
+    exchange_server.sessions = store
+    payload = np.zeros(size, dtype='<f8').tobytes()
+    transport = httpx.ASGITransport(app=exchange_server.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        for i in range(sessions):
+            session_id = await create_session(client, 1000 + i, variables, size)
+            for var_id in range(1, variables + 1):
+                response = await client.post("/send_data", content=payload, headers={'Session-ID': session_id, 'Var-ID': str(var_id)})
+                assert response.status_code == 200, response.text
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 100000, 1000000],
+                        help="Payload sizes (number of doubles) for the /send_data timings")
+    parser.add_argument('--iterations', type=int, default=200, help="Timed /send_data calls per size and mode")
+    parser.add_argument('--sessions', type=int, default=100, help="Sessions to recover")
+    parser.add_argument('--variables', type=int, default=4, help="Variables with a payload per recovered session")
+    parser.add_argument('--size', type=int, default=12500, help="Payload size (number of doubles) of the recovered sessions")
+    parser.add_argument('--journal-dir', default=None, help="Journal directory (a temporary one by default)")
+    parser.add_argument('--fsync', action='store_true', help="Sync the journal to disk after every write")
+    args = parser.parse_args()
+
+    journal_dir = args.journal_dir or tempfile.mkdtemp(prefix='exchange_journal_')
+    try:
+        print(f"{'size (doubles)':>14} {'journal':>8} {'mean ms':>9} {'p50 ms':>9} {'p99 ms':>9}")
+        for size in args.sizes:
+            for journaled in (False, True):
+                shutil.rmtree(journal_dir, ignore_errors=True)
+                journal = exchange_server.SessionJournal(journal_dir, fsync=args.fsync) if journaled else None
+                store = exchange_server.InProcessSessionStore(journal=journal)
+                store.recover()
+                latencies = asyncio.run(time_send_data(store, size, args.iterations))
+                if journal is not None:
+                    journal.close()
+                print(f"{size:>14} {'on' if journaled else 'off':>8} {statistics.mean(latencies) * 1e3:>9.3f} "
+                      f"{percentile(latencies, 50):>9.3f} {percentile(latencies, 99):>9.3f}")
+
+        shutil.rmtree(journal_dir, ignore_errors=True)
+        journal = exchange_server.SessionJournal(journal_dir, fsync=args.fsync)
+        store = exchange_server.InProcessSessionStore(journal=journal)
+        store.recover()
+        asyncio.run(fill_sessions(store, args.sessions, args.variables, args.size))
+        journal.close()
+        journal_bytes = sum(os.path.getsize(os.path.join(journal_dir, name)) for name in os.listdir(journal_dir))
+
+        start = time.perf_counter()
+        recovered = exchange_server.InProcessSessionStore(journal=exchange_server.SessionJournal(journal_dir))
+        count = recovered.recover()
+        elapsed = time.perf_counter() - start
+        recovered.journal.close()
+        print(f"Recovered {count} sessions ({journal_bytes / 1e6:.1f} MB of journal) in {elapsed * 1e3:.1f} ms "
+              f"({journal_bytes / 1e6 / elapsed:.0f} MB/s)")
+    finally:
+        if args.journal_dir is None:
+            shutil.rmtree(journal_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+"""
+Latency and throughput of the binary transport and the shared memory fast path compared with
+the HTTP API.
+
+Starts exchange_server.py with a binary transport port on a free local port pair (or uses the
+server given with --url and --binary-port) and, for every payload size, times round trips of a
+payload through one variable: the client sends it and then receives it back, first through the
+HTTP API (low_level_api), then through a binary transport connection (binary_api) and then
+through the shared memory segment of a same-host session (shared_memory_api). The round
+trips/s, MB/s (counting the payload once per round trip) and p50/p99 round trip latency are
+reported per transport, with the speedup over HTTP.
+
+Usage:
+    PYTHONPATH=src python benchmarks/transport_benchmark.py [--sizes 1 1000 1000000] [--round-trips N]
+                                                           [--server-args "--workers 2 --store shared"]
+                                                           [--url URL --binary-port PORT]
+"""
+import argparse
+import contextlib
+import shlex
+import time
+
+import numpy as np
+
+from clients.cyberwater.lib import low_level_api
+from clients.cyberwater.lib.binary_api import BinaryExchangeClient
+from clients.cyberwater.lib.shared_memory_api import SharedMemoryVariable
+from exchange_benchmark import INITIATOR_ID, INVITEE_ID, WAIT_TIMEOUT, free_port, local_server
+
+
+def http_round_trip(server_url, session_id, payload, out):
+    low_level_api.send_data(server_url, session_id, 1, payload).raise_for_status()
+    if low_level_api.wait_and_receive_data(server_url, session_id, 1, WAIT_TIMEOUT, out=out) is None:
+        raise RuntimeError("No data received over HTTP")
+
+
+def binary_round_trip(client, session_id, payload, out):
+    status_code, _ = client.send_data(session_id, 1, payload)
+    if status_code != 200:
+        raise RuntimeError(f"Sending over the binary transport failed with status {status_code}")
+    if client.wait_and_receive_data(session_id, 1, WAIT_TIMEOUT, out=out) is None:
+        raise RuntimeError("No data received over the binary transport")
+
+
+def shared_memory_round_trip(variable, payload, out):
+    if variable.send_data(payload, WAIT_TIMEOUT) is None:
+        raise RuntimeError("Sending through shared memory failed")
+    if variable.wait_and_receive_data(WAIT_TIMEOUT, out=out) is None:
+        raise RuntimeError("No data received through shared memory")
+
+
+def start_session(server_url, run_id, size, shared_memory=False):
+    session_info = low_level_api.create_session(server_url, run_id, int(shared_memory), INITIATOR_ID, INVITEE_ID, [1], [size],
+                                                shared_memory=shared_memory)
+    session_id = session_info['session_id']
+    low_level_api.join_session(server_url, session_id, INVITEE_ID)
+    return session_id
+
+
+def end_session(server_url, session_id):
+    low_level_api.end_session(server_url, session_id, INITIATOR_ID)
+    low_level_api.end_session(server_url, session_id, INVITEE_ID)
+
+
+def measure(round_trip, round_trips, size):
+    """ Time `round_trips` calls of `round_trip`, after a few warm-up calls, and return the measurements """
+    for _ in range(min(10, round_trips)):
+        round_trip()
+    latencies = np.empty(round_trips)
+    start = time.perf_counter()
+    for index in range(round_trips):
+        round_trip_start = time.perf_counter()
+        round_trip()
+        latencies[index] = time.perf_counter() - round_trip_start
+    elapsed = time.perf_counter() - start
+    return {
+        'round_trips_per_s': round_trips / elapsed,
+        'mb_per_s': round_trips * size * 8 / 1e6 / elapsed,
+        'p50_ms': float(np.percentile(latencies, 50)) * 1e3,
+        'p99_ms': float(np.percentile(latencies, 99)) * 1e3,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1, 1000, 1000000], help="Payload sizes (number of doubles)")
+    parser.add_argument('--round-trips', type=int, default=500, help="Round trips timed per size and transport")
+    parser.add_argument('--server-args', default='', help="Extra arguments for exchange_server.py, as one string")
+    parser.add_argument('--url', default=None, help="URL of a running server to use instead of starting one")
+    parser.add_argument('--binary-port', type=int, default=None, help="Binary transport port of the server given with --url")
+    args = parser.parse_args()
+
+    if args.url is not None:
+        if args.binary_port is None:
+            parser.error("--url requires --binary-port")
+        binary_port, server = args.binary_port, contextlib.nullcontext(args.url)
+    else:
+        binary_port = free_port()
+        server = local_server(['--binary-port', str(binary_port)] + shlex.split(args.server_args))
+
+    print(f"{'size':>9} {'transport':>9} {'trips/s':>10} {'MB/s':>9} {'p50 ms':>9} {'p99 ms':>9} {'speedup':>8}")
+    with server as server_url:
+        host = server_url.split('://')[1].rsplit(':', 1)[0]
+        for run_id, size in enumerate(args.sizes, 1):
+            payload = np.random.default_rng(run_id).standard_normal(size)
+            out = np.empty(size)
+
+            session_id = start_session(server_url, run_id, size)
+            http = measure(lambda: http_round_trip(server_url, session_id, payload, out), args.round_trips, size)
+            with BinaryExchangeClient(host, binary_port) as client:
+                binary = measure(lambda: binary_round_trip(client, session_id, payload, out), args.round_trips, size)
+            end_session(server_url, session_id)
+
+            session_id = start_session(server_url, run_id, size, shared_memory=True)
+            with SharedMemoryVariable(server_url, session_id, 1) as variable:
+                shared = measure(lambda: shared_memory_round_trip(variable, payload, out), args.round_trips, size)
+            end_session(server_url, session_id)
+
+            for transport, result in (('http', http), ('binary', binary), ('shm', shared)):
+                speedup = f"{result['round_trips_per_s'] / http['round_trips_per_s']:>7.2f}x"
+                print(f"{size:>9} {transport:>9} {result['round_trips_per_s']:>10.1f} {result['mb_per_s']:>9.1f} "
+                      f"{result['p50_ms']:>9.3f} {result['p99_ms']:>9.3f} {speedup:>8}", flush=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,203 @@
+import asyncio
+import time
+from typing import Dict, List, Optional
+import numpy as np
+
+from .async_low_level_api import *
+from .diagnostics import logger
+# Server URL and current session are shared with the synchronous high-level API
+from . import high_level_api
+from .high_level_api import SessionData, WaitPolicy, resolve_wait_policy, session_key, set_wait_policy
+
+
+def _session_id(session_id: Optional[List[int]]):
+    """ Format an explicit session ID, or fall back to the one set with set_session_id """
+    return session_key(session_id)
+
+async def start_session(sd: SessionData):
+    if not high_level_api.SERVER_URL_SET:
+        logger.error("Server URL not set. Please set a valid server URL before starting a session.")
+        return
+
+    session_info = await create_session(high_level_api.SERVER_URL, sd.source_model_id, sd.destination_model_id,
+                                sd.initiator_id, sd.invitee_id, sd.input_variables_id, sd.input_variables_size,
+                                sd.output_variables_id, sd.output_variables_size,
+                                sd.input_variables_queue_depth, sd.output_variables_queue_depth,
+                                sd.history_length, sd.history_bytes, sd.shared_memory,
+                                sd.input_variables_dtype, sd.output_variables_dtype,
+                                sd.input_variables_shape, sd.output_variables_shape)
+    if sd.wait_policy is not None and 'session_id' in session_info:
+        set_wait_policy(sd.wait_policy, session_info['session_id'])
+    return session_info
+
+async def retrieve_session_status(session_id: List[int]):
+    if not high_level_api.SERVER_URL_SET:
+        logger.error("Server URL not set. Please set a valid server URL before joining a session.")
+        return
+
+    return await get_session_status(high_level_api.SERVER_URL, _session_id(session_id))
+
+async def join_session_with_retries(session_id: List[int], invitee_id: int, max_retries: Optional[int] = None,
+                                    retry_delay: Optional[float] = None, policy: Optional[WaitPolicy] = None):
+    session_id = _session_id(session_id)
+    state = resolve_wait_policy(max_retries, retry_delay, policy, session_id).start()
+    while state.next_attempt():
+        response = await join_session(high_level_api.SERVER_URL, session_id, invitee_id)
+        if response['success']:
+            logger.info("Successfully joined the session.")
+            return 1
+        else:
+            logger.info("Failed to join the session. Error: %s", response['error'])
+            if "Session is already active" in response['error']:
+                return 0
+            await asyncio.sleep(state.next_delay())
+    return 0
+
+async def send_data_with_retries(var_send: int, arr_send: np.ndarray, max_retries: Optional[int] = None, retry_delay: Optional[float] = None,
+                                 session_id: Optional[List[int]] = None, policy: Optional[WaitPolicy] = None):
+    """
+    Sends data for a variable once its queue has room (with the default queue depth of 1, once
+    the peer has consumed the previous data), waiting on the server for up to `retry_delay`
+    seconds per attempt, or as set by the wait policy (see high_level_api.WaitPolicy). Other coroutines keep running while this one waits.
+
+    Returns:
+        int: 1 if the data was sent, 0 otherwise.
+    """
+    session_id = _session_id(session_id)
+    state = resolve_wait_policy(max_retries, retry_delay, policy, session_id).start()
+    while state.next_attempt():
+        status = await wait_for_queue_space(high_level_api.SERVER_URL, session_id, var_send, state.poll_timeout())
+        if status is not None and status['queued'] < status['queue_depth']:
+            response = await send_data(high_level_api.SERVER_URL, session_id, var_send, arr_send)
+            if response.is_success:
+                return 1
+            logger.error("Failed to send data, error: %s", response.text)
+            return 0
+        elif status is None:
+            await asyncio.sleep(state.next_delay())
+
+    logger.warning("Failed to send data for var_id %s after %s attempts due to a full queue.", var_send, state.attempts)
+    return 0
+
+async def check_data_availability_with_retries(var_id: int, max_retries: Optional[int] = None, retry_delay: Optional[float] = None,
+                                               session_id: Optional[List[int]] = None, policy: Optional[WaitPolicy] = None):
+    """
+    Waits until data is available for a variable, for up to `retry_delay` seconds per attempt
+    or as set by the wait policy.
+
+    Returns:
+        int: 1 if the data is available, 0 otherwise.
+    """
+    session_id = _session_id(session_id)
+    state = resolve_wait_policy(max_retries, retry_delay, policy, session_id).start()
+    while state.next_attempt():
+        flag_status = await wait_for_variable_flag(high_level_api.SERVER_URL, session_id, var_id, 1, state.poll_timeout())
+        if flag_status == 1:
+            return 1
+        elif flag_status is None:
+            await asyncio.sleep(state.next_delay())
+
+    logger.warning("Failed to find available data for session %s, variable %s after %s retries.", session_id, var_id, state.attempts)
+    return 0
+
+async def receive_data_with_retries(var_receive: int, max_retries: Optional[int] = None, retry_delay: Optional[float] = None,
+                                    session_id: Optional[List[int]] = None, out: Optional[np.ndarray] = None,
+                                    policy: Optional[WaitPolicy] = None):
+    """
+    Attempts to receive data until successful or until the maximum number of retries is reached.
+
+    Returns:
+        tuple:
+            int: Status code (1 for success, 0 for failure)
+            numpy.ndarray or None: The received data array (`out` if given) if successful, otherwise None.
+    """
+    session_id = _session_id(session_id)
+    state = resolve_wait_policy(max_retries, retry_delay, policy, session_id).start()
+    while state.next_attempt():
+        data_array = await receive_data(high_level_api.SERVER_URL, session_id, var_receive, out=out)
+        if data_array is not None:
+            return (1, data_array)
+        await asyncio.sleep(state.next_delay())
+
+    logger.warning("Failed to receive data for var_id %s after %s attempts.", var_receive, state.attempts)
+    return (0, None)
+
+async def wait_and_receive_data_with_retries(var_receive: int, max_retries: Optional[int] = None, retry_delay: Optional[float] = None,
+                                             session_id: Optional[List[int]] = None, out: Optional[np.ndarray] = None,
+                                             policy: Optional[WaitPolicy] = None):
+    """
+    Waits for data to become available and receives it in one request per attempt.
+
+    Returns:
+        tuple:
+            int: Status code (1 for success, 0 for failure)
+            numpy.ndarray or None: The received data array (`out` if given) if successful, otherwise None.
+    """
+    session_id = _session_id(session_id)
+    state = resolve_wait_policy(max_retries, retry_delay, policy, session_id).start()
+    while state.next_attempt():
+        timeout = state.poll_timeout()
+        started = time.monotonic()
+        data_array = await wait_and_receive_data(high_level_api.SERVER_URL, session_id, var_receive, timeout, out=out)
+        if data_array is not None:
+            return (1, data_array)
+        # An answer before the wait expired is an error rather than a timeout, so back off
+        if time.monotonic() - started < timeout:
+            await asyncio.sleep(state.next_delay())
+
+    logger.warning("Failed to receive data for var_id %s after %s attempts.", var_receive, state.attempts)
+    return (0, None)
+
+async def send_many_with_retries(arrays_send: Dict[int, np.ndarray], max_retries: Optional[int] = None, retry_delay: Optional[float] = None,
+                                 session_id: Optional[List[int]] = None, policy: Optional[WaitPolicy] = None):
+    """
+    Sends data for several variables in one request, retrying while the queue of any of them
+    is full.
+
+    Returns:
+        int: 1 if the data was sent, 0 otherwise.
+    """
+    session_id = _session_id(session_id)
+    state = resolve_wait_policy(max_retries, retry_delay, policy, session_id).start()
+    while state.next_attempt():
+        response = await send_many(high_level_api.SERVER_URL, session_id, arrays_send)
+        if response.is_success:
+            return 1
+        elif response.status_code != 409:
+            logger.error("Failed to send data, error: %s", response.text)
+            return 0
+        await asyncio.sleep(state.next_delay())
+
+    logger.warning("Failed to send data for var_ids %s after %s attempts due to a full queue.", list(arrays_send), state.attempts)
+    return 0
+
+async def receive_many_with_retries(var_ids: List[int], max_retries: Optional[int] = None, retry_delay: Optional[float] = None,
+                                    session_id: Optional[List[int]] = None, policy: Optional[WaitPolicy] = None):
+    """
+    Receives data for several variables in one request, retrying until new data is available
+    for all of them.
+
+    Returns:
+        tuple:
+            int: Status code (1 for success, 0 for failure)
+            dict or None: Maps each variable ID to its received data array if successful, otherwise None.
+    """
+    session_id = _session_id(session_id)
+    state = resolve_wait_policy(max_retries, retry_delay, policy, session_id).start()
+    while state.next_attempt():
+        data_by_var = await receive_many(high_level_api.SERVER_URL, session_id, var_ids)
+        if data_by_var is not None:
+            return (1, data_by_var)
+        await asyncio.sleep(state.next_delay())
+
+    logger.warning("Failed to receive data for var_ids %s after %s attempts.", list(var_ids), state.attempts)
+    return (0, None)
+
+async def end_session_now(user_id: int, session_id: Optional[List[int]] = None):
+    if not high_level_api.SERVER_URL_SET:
+        logger.error("Server URL not set. Please set a valid server URL before ending a session.")
+        return
+
+    session_id = _session_id(session_id)
+    await end_session(high_level_api.SERVER_URL, session_id, user_id)
+    high_level_api.WAIT_POLICIES.pop(session_id, None)
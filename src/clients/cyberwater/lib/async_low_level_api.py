@@ -0,0 +1,518 @@
+import itertools
+
+import httpx
+import numpy as np
+
+from .diagnostics import logger
+from .low_level_api import (HISTORY_RECORD_HEADER, batch_layouts, pack_batch, pack_payload, payload_array, payload_dtype,
+                            payload_layout, range_selection, unpack_batch)
+
+
+class AsyncExchangeClient:
+    """
+    Holds a pooled, keep-alive asynchronous HTTP client shared by all coroutines of this module,
+    so that many exchanges can be in flight concurrently over a few reused connections.
+
+    Parameters:
+        max_connections (int): Maximum number of concurrent connections.
+        max_keepalive_connections (int): Maximum number of idle connections kept alive.
+        connect_timeout (float): Seconds to wait for a connection to the server.
+        read_timeout (float): Seconds to wait for a response, or None to wait indefinitely.
+        verify (bool or str): TLS certificate verification, as accepted by `httpx`.
+    """
+    def __init__(self, max_connections=32, max_keepalive_connections=16, connect_timeout=10.0, read_timeout=60.0, verify=False):
+        limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_keepalive_connections)
+        self.client = httpx.AsyncClient(limits=limits, verify=verify)
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+
+    def timeout(self, wait=0.0):
+        """ Request timeout, extended by `wait` seconds for requests the server may hold open """
+        read_timeout = None if self.read_timeout is None else self.read_timeout + wait
+        return httpx.Timeout(read_timeout, connect=self.connect_timeout)
+
+    async def get(self, url, wait=0.0, **kwargs):
+        return await self.client.get(url, timeout=self.timeout(wait), **kwargs)
+
+    async def post(self, url, wait=0.0, **kwargs):
+        return await self.client.post(url, timeout=self.timeout(wait), **kwargs)
+
+    async def aclose(self):
+        await self.client.aclose()
+
+
+# Client shared by every coroutine of this module, created on first use
+_client = None
+
+# Declared dtypes of variables, by (server URL, session ID, variable ID), kept until the session
+# is ended (see declared_dtype)
+_declared_dtypes = {}
+
+def _get_client():
+    global _client
+    if _client is None:
+        _client = AsyncExchangeClient()
+    return _client
+
+async def configure_client(max_connections=32, max_keepalive_connections=16, connect_timeout=10.0, read_timeout=60.0, verify=False):
+    """
+    Replaces the shared asynchronous HTTP client with one using the given limits, timeouts
+    and TLS verification settings. See AsyncExchangeClient for the parameters.
+
+    Returns:
+        AsyncExchangeClient: The new shared client.
+    """
+    global _client
+    await close_client()
+    _client = AsyncExchangeClient(max_connections, max_keepalive_connections, connect_timeout, read_timeout, verify)
+    return _client
+
+async def close_client():
+    """
+    Closes the shared asynchronous HTTP client. It must be called before the event loop that
+    used the client is closed; a new client is created on the next call.
+    """
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+async def create_session(server_url, source_model_ID, destination_model_ID, initiator_id, invitee_id,
+                         input_variables_ID=None, input_variables_size=None,
+                         output_variables_ID=None, output_variables_size=None,
+                         input_variables_queue_depth=None, output_variables_queue_depth=None,
+                         history_length=None, history_bytes=None, shared_memory=False,
+                         input_variables_dtype=None, output_variables_dtype=None,
+                         input_variables_shape=None, output_variables_shape=None):
+    """
+    Creates a session with specified parameters on the server.
+
+    Parameters:
+        server_url (str): The server URL.
+        source_model_ID (int): ID of the source model.
+        destination_model_ID (int): ID of the destination model.
+        initiator_id (int): ID of the session initiator.
+        invitee_id (int): ID of the invitee.
+        input_variables_ID (list): Optional list of input variable IDs.
+        input_variables_size (list): Optional list of sizes for input variables.
+        output_variables_ID (list): Optional list of output variable IDs.
+        output_variables_size (list): Optional list of sizes for output variables.
+        input_variables_queue_depth (list): Optional list of queue depths for input variables.
+        output_variables_queue_depth (list): Optional list of queue depths for output variables.
+        history_length (int): Optional number of received payloads the server keeps per variable.
+        history_bytes (int): Optional limit on the total size of the payloads kept per variable.
+        shared_memory (bool): Exchange the variables through shared memory segments on the
+            server host instead of through the server (see shared_memory_api).
+        input_variables_dtype (list): Optional list of the element types of input variables (float64 if not given).
+        output_variables_dtype (list): Optional list of the element types of output variables.
+        input_variables_shape (list): Optional list of the shapes of input variables.
+        output_variables_shape (list): Optional list of the shapes of output variables.
+
+    Returns:
+        dict: JSON response from the server or an error message.
+    """
+    data = {
+        "source_model_ID": source_model_ID,
+        "destination_model_ID": destination_model_ID,
+        "initiator_id": initiator_id,
+        "invitee_id": invitee_id,
+        "input_variables_ID": input_variables_ID or [],
+        "input_variables_size": input_variables_size or [],
+        "output_variables_ID": output_variables_ID or [],
+        "output_variables_size": output_variables_size or [],
+        "input_variables_queue_depth": input_variables_queue_depth or [],
+        "output_variables_queue_depth": output_variables_queue_depth or []
+    }
+    if history_length is not None:
+        data["history_length"] = history_length
+    if history_bytes is not None:
+        data["history_bytes"] = history_bytes
+    if shared_memory:
+        data["shared_memory"] = True
+    if input_variables_dtype or output_variables_dtype:
+        data["input_variables_dtype"] = [np.dtype(dtype).name for dtype in input_variables_dtype or []]
+        data["output_variables_dtype"] = [np.dtype(dtype).name for dtype in output_variables_dtype or []]
+    if input_variables_shape or output_variables_shape:
+        data["input_variables_shape"] = [list(shape) for shape in input_variables_shape or []]
+        data["output_variables_shape"] = [list(shape) for shape in output_variables_shape or []]
+
+    response = await _get_client().post(f"{server_url}/create_session", json=data)
+
+    if response.is_success:
+        session_info = response.json()
+        logger.info("Session status: %s. Session ID: %s", session_info.get('status', 'unknown'), session_info.get('session_id', 'N/A'))
+        return session_info
+    else:
+        logger.error("Error creating session: %s", response.text)
+        return {"error": response.text}
+
+async def get_session_status(server_url, session_id):
+    """
+    Retrieves the status of a session from the server.
+
+    Parameters:
+        server_url (str): The base URL of the server.
+        session_id (str): The ID of the session to check.
+
+    Returns:
+        The status of the session as an integer if successful, or None if an error occurs.
+    """
+    params = {'session_id': session_id}
+
+    response = await _get_client().get(f"{server_url}/get_session_status", params=params)
+
+    if response.is_success:
+        return response.json()
+    else:
+        logger.warning("Failed to retrieve session status. Server responded with: %s - %s", response.status_code, response.text)
+        return None
+
+async def join_session(server_url, session_id, invitee_id):
+    """
+    Attempts to join a session with a given session ID and invitee ID.
+
+    Parameters:
+        server_url (str): The server URL.
+        session_id (str): The ID of the session to join.
+        invitee_id (int): The invitee ID to authenticate the joining.
+
+    Returns:
+        dict: A dictionary with 'success' status and 'error' message if applicable.
+    """
+    data = {"invitee_id": invitee_id, "session_id": session_id}
+
+    try:
+        response = await _get_client().post(f"{server_url}/join_session", json=data)
+        if response.is_success:
+            return {'success': True}
+        else:
+            return {'success': False, 'error': response.json().get('detail', 'Unknown error')}
+    except Exception as e:
+        return {'success': False, 'error': str(e)}
+
+async def get_variable_size(server_url, session_id, var_id):
+    """
+    Retrieves the size of a specific variable within a session from the server.
+
+    Parameters:
+        server_url (str): The server URL.
+        session_id (str): The ID of the session.
+        var_id (int): The ID of the variable.
+
+    Returns:
+        int: The size of the variable if the request is successful, -1 otherwise.
+    """
+    params = {'session_id': session_id, 'var_id': var_id}
+
+    response = await _get_client().get(f"{server_url}/get_variable_size", params=params)
+    if response.is_success:
+        return response.json().get('size', -1)
+    else:
+        logger.warning("Error occurred while retrieving variable size: %s", response.text)
+        return -1
+
+async def get_variable_info(server_url, session_id, var_id):
+    """
+    Retrieves the declared layout of a specific variable within a session from the server.
+
+    Returns:
+        dict: The `size`, `dtype` and `shape` of the payloads the server accepts for the variable
+        if the request is successful, None otherwise.
+    """
+    params = {'session_id': session_id, 'var_id': var_id}
+
+    response = await _get_client().get(f"{server_url}/get_variable_size", params=params)
+    if response.is_success:
+        return response.json()
+    else:
+        logger.warning("Error occurred while retrieving variable size: %s", response.text)
+        return None
+
+async def declared_dtype(server_url, session_id, var_id):
+    """
+    Returns the name of the dtype a variable was declared with, asking the server the first
+    time, or None if the server could not tell.
+    """
+    key = (server_url, str(session_id), var_id)
+    if key not in _declared_dtypes:
+        info = await get_variable_info(server_url, session_id, var_id)
+        if info is None:
+            return None
+        _declared_dtypes[key] = info['dtype']
+    return _declared_dtypes[key]
+
+def range_headers(offset=None, count=None, hyperslab=None):
+    """ The Range header selecting part of a payload (see low_level_api.range_selection), if any """
+    selection = range_selection(offset, count, hyperslab)
+    return {} if selection is None else {'Range': "=".join(selection)}
+
+async def send_data(server_url, session_id, var_id, data, dtype=None, offset=None, hyperslab=None):
+    """
+    Sends an array of numbers as binary data to the server for a specific session and variable.
+
+    Parameters:
+        server_url (str): The server URL.
+        session_id (str): The session ID to which the data belongs.
+        var_id (int): The identifier for the variable to which the data is related.
+        data (numpy.ndarray or list of float): The elements to be sent, as an array of any shape
+            (or any object supporting the buffer protocol) or a list.
+        dtype (str or numpy.dtype): The element type to send the data in (see low_level_api.send_data).
+        offset, hyperslab: Send only part of the next payload of the variable (see
+            low_level_api.send_data).
+
+    Returns:
+        httpx.Response: The server response, with the sequence number assigned to the data as
+        `seq` in its JSON body (None while parts of the payload are missing), or status code 409
+        if the queue of the variable is full.
+    """
+    if dtype is None:
+        dtype = await declared_dtype(server_url, session_id, var_id)
+    dtype = payload_dtype(data, dtype)
+    binary_data = pack_payload(data, dtype).tobytes()
+
+    headers = {
+        'Session-ID': session_id,
+        'Var-ID': str(var_id),
+        'Payload-Dtype': dtype
+    }
+    if offset is not None or hyperslab is not None:
+        unit, selection = range_selection(offset, np.size(data), hyperslab)
+        headers['Content-Range'] = f"{unit} {selection}/*"
+
+    return await _get_client().post(f"{server_url}/send_data", content=binary_data, headers=headers)
+
+async def get_variable_flag(server_url, session_id, var_id):
+    """
+    Retrieves the flag status for a specific variable within a session.
+
+    Parameters:
+        server_url (str): The server URL.
+        session_id (str): The ID of the session.
+        var_id (int): The ID of the variable.
+
+    Returns:
+        int: The flag status if the request is successful, None otherwise.
+    """
+    params = {'session_id': session_id, 'var_id': var_id}
+
+    response = await _get_client().get(f"{server_url}/get_variable_flag", params=params)
+
+    if response.is_success:
+        return response.json().get('flag_status')
+    else:
+        logger.warning("Error occurred while retrieving flag status: %s", response.text)
+        return None
+
+async def wait_for_variable_flag(server_url, session_id, var_id, flag_status, timeout):
+    """
+    Waits on the server until the flag of a specific variable reaches the expected value.
+
+    Parameters:
+        server_url (str): The server URL.
+        session_id (str): The ID of the session.
+        var_id (int): The ID of the variable.
+        flag_status (int): The flag value to wait for (1 when data is available, 0 when it was consumed).
+        timeout (float): Maximum number of seconds the server should wait.
+
+    Returns:
+        int: The flag status when the wait ended if the request is successful, None otherwise.
+    """
+    params = {'session_id': session_id, 'var_id': var_id, 'flag_status': flag_status, 'timeout': timeout}
+
+    response = await _get_client().get(f"{server_url}/wait_for_variable_flag", wait=timeout, params=params)
+
+    if response.is_success:
+        return response.json().get('flag_status')
+    else:
+        logger.warning("Error occurred while waiting for flag status: %s", response.text)
+        return None
+
+async def wait_for_queue_space(server_url, session_id, var_id, timeout):
+    """
+    Waits on the server until the queue of a specific variable has room for another payload.
+
+    Parameters:
+        server_url (str): The server URL.
+        session_id (str): The ID of the session.
+        var_id (int): The ID of the variable.
+        timeout (float): Maximum number of seconds the server should wait.
+
+    Returns:
+        dict: The queue status (`queued`, `queue_depth` and `last_seq`) when the wait ended if the
+        request is successful, None otherwise.
+    """
+    params = {'session_id': session_id, 'var_id': var_id, 'timeout': timeout}
+
+    response = await _get_client().get(f"{server_url}/wait_for_queue_space", wait=timeout, params=params)
+
+    if response.is_success:
+        return response.json()
+    else:
+        logger.warning("Error occurred while waiting for queue space: %s", response.text)
+        return None
+
+async def receive_data(server_url, session_id, var_id, return_seq=False, out=None, offset=None, count=None, hyperslab=None):
+    """
+    Receives binary data from the server for a given session and variable ID, as an array of the
+    dtype and shape declared for the variable.
+
+    Parameters:
+        server_url (str): The server URL.
+        session_id (str): The session ID from which data is to be retrieved.
+        var_id (int): The variable ID associated with the data.
+        return_seq (bool): Also return the sequence number the server assigned to the data.
+        out (numpy.ndarray): Optional array of the size of the data to receive it into.
+        offset, count, hyperslab: Receive only part of the payload (see low_level_api.receive_data).
+
+    Returns:
+        numpy.ndarray: The received data, as a read-only view over the response body or in
+        `out`, or None if an error occurred. With `return_seq`, a (seq, data) tuple instead, or None.
+    """
+    params = {"session_id": session_id, "var_id": var_id}
+
+    headers = range_headers(offset, count, hyperslab)
+    response = await _get_client().get(f"{server_url}/receive_data", params=params, headers=headers)
+
+    if response.is_success:
+        data = payload_array(response.content, out, *payload_layout(response.headers))
+        if return_seq:
+            return int(response.headers['Sequence-Number']), data
+        return data
+    else:
+        logger.info("Error retrieving data for session %s variable %s: %s", session_id, var_id, response.text)
+        return None
+
+async def wait_and_receive_data(server_url, session_id, var_id, timeout, return_seq=False, out=None, offset=None, count=None,
+                                hyperslab=None):
+    """
+    Waits on the server until data is available for a given session and variable ID, then
+    receives it in the same request.
+
+    Parameters:
+        server_url (str): The server URL.
+        session_id (str): The session ID from which data is to be retrieved.
+        var_id (int): The variable ID associated with the data.
+        timeout (float): Maximum number of seconds the server should wait for the data.
+        return_seq (bool): Also return the sequence number the server assigned to the data.
+        out (numpy.ndarray): Optional array of the size of the data to receive it into.
+        offset, count, hyperslab: Receive only part of the payload (see low_level_api.receive_data).
+
+    Returns:
+        numpy.ndarray: The received data, as a read-only view over the response body or in
+        `out`, or None if no data arrived before the timeout or an error occurred. With
+        `return_seq`, a (seq, data) tuple instead, or None.
+    """
+    params = {"session_id": session_id, "var_id": var_id, "timeout": timeout}
+
+    headers = range_headers(offset, count, hyperslab)
+    response = await _get_client().get(f"{server_url}/wait_and_receive_data", wait=timeout, params=params, headers=headers)
+
+    if response.is_success:
+        data = payload_array(response.content, out, *payload_layout(response.headers))
+        if return_seq:
+            return int(response.headers['Sequence-Number']), data
+        return data
+    else:
+        logger.info("Error retrieving data for session %s variable %s: %s", session_id, var_id, response.text)
+        return None
+
+async def send_many(server_url, session_id, data_by_var):
+    """
+    Sends data for several variables of a session to the server in a single request.
+
+    Parameters:
+        server_url (str): The server URL.
+        session_id (str): The session ID to which the data belongs.
+        data_by_var (dict): Maps each variable ID to the array (or list of numbers) to be sent for
+            it, converted to the declared dtype of the variable (see declared_dtype).
+
+    Returns:
+        httpx.Response: The server response, with status code 409 if the queue of one of the
+        variables is full.
+    """
+    dtypes = {var_id: payload_dtype(data, await declared_dtype(server_url, session_id, var_id))
+              for var_id, data in data_by_var.items()}
+    headers = {'Session-ID': session_id, 'Payload-Dtypes': ",".join(dtypes.values())}
+
+    return await _get_client().post(f"{server_url}/send_data_batch", content=pack_batch(data_by_var, dtypes), headers=headers)
+
+async def receive_many(server_url, session_id, var_ids):
+    """
+    Receives data for several variables of a session from the server in a single request,
+    without waiting for it (see low_level_api.receive_many).
+
+    Parameters:
+        server_url (str): The server URL.
+        session_id (str): The session ID from which data is to be retrieved.
+        var_ids (list of int): The variable IDs to receive.
+
+    Returns:
+        dict: Maps each variable ID to an ndarray of its data, or None if new data is not queued
+        for every variable or an error occurred.
+    """
+    params = {"session_id": session_id, "var_ids": list(var_ids)}
+
+    response = await _get_client().get(f"{server_url}/receive_data_batch", params=params)
+
+    if response.is_success:
+        return unpack_batch(response.content, layouts=batch_layouts(response.headers))
+    else:
+        logger.info("Error retrieving data for session %s variables %s: %s", session_id, var_ids, response.text)
+        return None
+
+async def receive_history(server_url, session_id, var_id, start_seq, end_seq=None, timeout=0.0, offset=None, count=None,
+                          hyperslab=None):
+    """
+    Reads earlier payloads of a variable by sequence number without consuming them.
+
+    Parameters:
+        server_url (str): The server URL.
+        session_id (str): The session ID from which data is to be retrieved.
+        var_id (int): The variable ID associated with the data.
+        start_seq (int): Sequence number of the first payload to read.
+        end_seq (int): Sequence number of the last payload to read (inclusive), `start_seq` if not given.
+        timeout (float): Maximum number of seconds the server should wait for payloads not sent yet.
+        offset, count, hyperslab: Read only part of every payload (see low_level_api.receive_history).
+
+    Returns:
+        dict: Maps each sequence number of the range to an ndarray of its data, or None if a
+        payload of the range is no longer stored, did not arrive before the timeout, or an error
+        occurred.
+    """
+    params = {"session_id": session_id, "var_id": var_id, "start_seq": start_seq, "timeout": timeout}
+    if end_seq is not None:
+        params["end_seq"] = end_seq
+
+    headers = range_headers(offset, count, hyperslab)
+    response = await _get_client().get(f"{server_url}/receive_history", wait=timeout, params=params, headers=headers)
+
+    if response.is_success:
+        return unpack_batch(response.content, HISTORY_RECORD_HEADER, itertools.repeat(payload_layout(response.headers)))
+    else:
+        logger.warning("Error retrieving history: %s", response.text)
+        return None
+
+async def end_session(server_url, session_id, user_id):
+    """
+    Ends a session on the server using the session ID and user ID.
+
+    Parameters:
+        server_url (str): The server URL.
+        session_id (str): The ID of the session to be ended.
+        user_id (int): The ID of the user (initiator or invitee) ending the session.
+    """
+    data = {
+        "session_id": session_id,
+        "user_id": user_id
+    }
+
+    response = await _get_client().post(f"{server_url}/end_session", json=data)
+
+    if response.is_success:
+        logger.info("%s", response.json().get("status", "No status message received."))
+    else:
+        logger.error("Error ending session: %s", response.text)
+
+    # A later session may reuse the ID with other declarations
+    for key in [key for key in _declared_dtypes if key[:2] == (server_url, str(session_id))]:
+        del _declared_dtypes[key]
@@ -0,0 +1,240 @@
+"""
+Client of the binary transport of the exchange server.
+
+The server started with --binary-port also serves the data path of its sessions over persistent
+TCP connections with fixed-size binary frame headers. Sessions are still created, joined and
+ended through the HTTP API (low_level_api); a BinaryExchangeClient then sends and receives
+payloads, reads flags and waits for data or queue space without the per-request cost of HTTP.
+
+Every request is a header (little-endian uint8 operation, uint8 session ID length, int32 variable
+ID, int64 argument, float64 timeout in seconds, uint64 payload length) followed by the UTF-8
+session ID and the payload. Every response is a header (uint16 status code as in the HTTP API,
+int64 value, uint64 body length) followed by the body: the payload received, or the error detail
+if the status code is not 200.
+
+Payloads hold the elements of a variable in its declared dtype. The client reads the dtype and
+shape of a variable from the server once (OP_GET_VARIABLE_SIZE), converts the data it sends to
+that dtype and returns received data in that shape.
+"""
+import json
+import socket
+import struct
+import threading
+
+from .diagnostics import logger
+from .low_level_api import output_buffer, pack_payload, payload_array, wire_dtype
+from .tracing import trace_span
+
+REQUEST_HEADER = struct.Struct('<BBiqdQ')
+RESPONSE_HEADER = struct.Struct('<HqQ')
+
+# Body of the OP_WAIT_FOR_QUEUE_SPACE response: queued payloads, queue depth and latest sequence number
+QUEUE_STATUS_RECORD = struct.Struct('<qqq')
+
+OP_SEND_DATA = 1
+OP_RECEIVE_DATA = 2
+OP_WAIT_AND_RECEIVE_DATA = 3
+OP_GET_VARIABLE_FLAG = 4
+OP_WAIT_FOR_VARIABLE_FLAG = 5
+OP_WAIT_FOR_QUEUE_SPACE = 6
+OP_GET_VARIABLE_SIZE = 7
+
+# Payloads up to this size are sent in the same write as their request header
+COALESCE_SIZE = 64 * 1024
+
+
+class BinaryExchangeClient:
+    """
+    A persistent connection to the binary transport of the exchange server. Requests on one
+    connection are served in order, so threads sharing a client wait for each other's requests,
+    including long-polls; use a client per thread to exchange variables concurrently.
+
+    Parameters:
+        host (str): Host of the server.
+        port (int): Port of the binary transport (--binary-port of the server).
+        connect_timeout (float): Seconds to wait for the connection to the server.
+        read_timeout (float): Seconds to wait for a response, extended by the timeout of requests
+            the server may hold open, or None to wait indefinitely.
+
+    The layouts of variables are kept for the life of the client; call forget_session once a
+    session has ended if the client is reused for a later session with the same ID.
+    """
+    def __init__(self, host, port, connect_timeout=10.0, read_timeout=60.0):
+        self.sock = socket.create_connection((host, port), timeout=connect_timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.read_timeout = read_timeout
+        self._header = bytearray(RESPONSE_HEADER.size)
+        self._lock = threading.Lock()
+        self._layouts = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.sock.close()
+
+    def _receive_into(self, buffer):
+        view = memoryview(buffer).cast('B')
+        while view:
+            received = self.sock.recv_into(view)
+            if received == 0:
+                raise ConnectionError("The exchange server closed the binary transport connection")
+            view = view[received:]
+
+    def request(self, op, session_id, var_id, argument=0, timeout=0.0, payload=b"", buffer=None):
+        """
+        Sends one request and reads its response.
+
+        Parameters:
+            op (int): The operation (one of the OP_* constants).
+            session_id (str): The session ID.
+            var_id (int): The variable ID.
+            argument (int): Argument of the operation, such as the expected flag status.
+            timeout (float): Maximum number of seconds the server should wait, for waiting operations.
+            payload (bytes-like): The payload to send.
+            buffer (memoryview): Optional writable byte buffer to read a successful response body
+                into, used if its size matches the body.
+
+        Returns:
+            tuple: The status code, value and body of the response (`buffer` if it was used).
+        """
+        session_id = str(session_id).encode()
+        header = REQUEST_HEADER.pack(op, len(session_id), var_id, argument, timeout, len(payload)) + session_id
+        with self._lock:
+            try:
+                self.sock.settimeout(None if self.read_timeout is None else self.read_timeout + timeout)
+                if len(payload) <= COALESCE_SIZE:
+                    self.sock.sendall(header + bytes(payload))
+                else:
+                    self.sock.sendall(header)
+                    self.sock.sendall(payload)
+                self._receive_into(self._header)
+                status_code, value, length = RESPONSE_HEADER.unpack(self._header)
+                if status_code != 200 or buffer is None or len(buffer) != length:
+                    buffer = bytearray(length)
+                self._receive_into(buffer)
+            except OSError:
+                # A request interrupted halfway leaves the connection out of step with the server
+                self.close()
+                raise
+        return status_code, value, buffer
+
+    def get_variable_info(self, session_id, var_id):
+        """
+        Returns the `size`, `dtype` and `shape` of a variable as get_variable_info of the HTTP
+        API, or None if an error occurred.
+        """
+        status_code, _, body = self.request(OP_GET_VARIABLE_SIZE, session_id, var_id)
+        if status_code != 200:
+            logger.warning("Error getting size of session %s variable %s: %s", session_id, var_id, body.decode())
+            return None
+        return json.loads(body)
+
+    def layout(self, session_id, var_id):
+        """ Returns the little-endian dtype and the shape of the payloads of a variable, asking the server the first time """
+        key = (str(session_id), var_id)
+        if key not in self._layouts:
+            info = self.get_variable_info(session_id, var_id)
+            if info is None:
+                # The session or variable is unknown, and the server will say so on the request itself
+                return wire_dtype('float64'), (-1,)
+            self._layouts[key] = (wire_dtype(info['dtype']), tuple(info['shape']))
+        return self._layouts[key]
+
+    def forget_session(self, session_id):
+        """ Drops the layouts kept for the variables of a session """
+        self._layouts = {key: layout for key, layout in self._layouts.items() if key[0] != str(session_id)}
+
+    def send_data(self, session_id, var_id, data):
+        """
+        Sends data for a variable, converted to its declared dtype, as send_data of the HTTP API.
+
+        Parameters:
+            session_id (str): The session ID to which the data belongs.
+            var_id (int): The variable ID of the data.
+            data (numpy.ndarray or list of float): The elements to be sent.
+
+        Returns:
+            tuple: The status code (200 on success, 409 if the queue of the variable is full) and
+            the sequence number the server assigned to the data.
+        """
+        dtype, _ = self.layout(session_id, var_id)
+        payload = pack_payload(data, dtype)
+        with trace_span('BINARY send_data', 'binary', bytes=len(payload)) as span:
+            status_code, seq, body = self.request(OP_SEND_DATA, session_id, var_id, payload=payload)
+            span.set(status=status_code)
+        if status_code != 200:
+            logger.info("Error sending data for session %s variable %s: %s", session_id, var_id, body.decode())
+        return status_code, seq
+
+    def _receive(self, op, session_id, var_id, timeout, return_seq, out):
+        dtype, shape = self.layout(session_id, var_id)
+        with trace_span('BINARY ' + ('receive_data' if op == OP_RECEIVE_DATA else 'wait_and_receive_data'), 'binary') as span:
+            status_code, seq, body = self.request(op, session_id, var_id, timeout=timeout, buffer=output_buffer(out, dtype))
+            span.set(status=status_code, bytes=len(body))
+        if status_code != 200:
+            logger.info("Error retrieving data for session %s variable %s: %s", session_id, var_id, body.decode())
+            return None
+        data = payload_array(body, out, dtype, shape)
+        logger.debug("Received %d %s elements for session %s variable %s", data.size, dtype.name, session_id, var_id)
+        return (seq, data) if return_seq else data
+
+    def receive_data(self, session_id, var_id, return_seq=False, out=None):
+        """
+        Receives the oldest queued payload of a variable, or the last received one again if its
+        queue is empty, as receive_data of the HTTP API.
+
+        Returns:
+            numpy.ndarray: The received data (`out` if given), or None if an error occurred.
+            With `return_seq`, a (seq, data) tuple instead, or None.
+        """
+        return self._receive(OP_RECEIVE_DATA, session_id, var_id, 0.0, return_seq, out)
+
+    def wait_and_receive_data(self, session_id, var_id, timeout, return_seq=False, out=None):
+        """
+        Waits on the server until data is queued for a variable and receives it, as
+        wait_and_receive_data of the HTTP API.
+
+        Returns:
+            numpy.ndarray: The received data (`out` if given), or None if no data arrived before
+            the timeout or an error occurred. With `return_seq`, a (seq, data) tuple instead, or None.
+        """
+        return self._receive(OP_WAIT_AND_RECEIVE_DATA, session_id, var_id, timeout, return_seq, out)
+
+    def get_variable_flag(self, session_id, var_id):
+        """ Returns the flag status of a variable, or None if an error occurred """
+        status_code, flag_status, body = self.request(OP_GET_VARIABLE_FLAG, session_id, var_id)
+        if status_code != 200:
+            logger.warning("Error getting flag of session %s variable %s: %s", session_id, var_id, body.decode())
+            return None
+        return flag_status
+
+    def wait_for_variable_flag(self, session_id, var_id, flag_status, timeout):
+        """
+        Waits on the server until the flag of a variable equals `flag_status` or `timeout`
+        seconds have passed, and returns the flag status then, or None if an error occurred.
+        """
+        status_code, current_status, body = self.request(OP_WAIT_FOR_VARIABLE_FLAG, session_id, var_id,
+                                                         argument=flag_status, timeout=timeout)
+        if status_code != 200:
+            logger.warning("Error waiting for flag of session %s variable %s: %s", session_id, var_id, body.decode())
+            return None
+        return current_status
+
+    def wait_for_queue_space(self, session_id, var_id, timeout):
+        """
+        Waits on the server until the queue of a variable has room for another payload or
+        `timeout` seconds have passed.
+
+        Returns:
+            dict: The queue status ('queued', 'queue_depth' and 'last_seq'), or None if an error occurred.
+        """
+        status_code, _, body = self.request(OP_WAIT_FOR_QUEUE_SPACE, session_id, var_id, timeout=timeout)
+        if status_code != 200:
+            logger.warning("Error waiting for queue space of session %s variable %s: %s", session_id, var_id, body.decode())
+            return None
+        queued, queue_depth, last_seq = QUEUE_STATUS_RECORD.unpack(body)
+        return {"var_id": var_id, "queued": queued, "queue_depth": queue_depth, "last_seq": last_seq}
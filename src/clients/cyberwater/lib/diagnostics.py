@@ -0,0 +1,52 @@
+"""
+Diagnostics of the client API.
+
+Every module of the client logs to the 'exchange.client' logger with lazily formatted messages:
+per-call details of the data path at DEBUG level, session changes and retries at INFO, and
+failures at WARNING or ERROR. Repeated warnings and errors are rate-limited (see
+rate_limit), and nothing below WARNING is emitted unless configured otherwise, so
+production runs do not pay for formatting data-path messages.
+
+The level can be set with configure_logging or the EXCHANGE_LOG_LEVEL environment variable.
+"""
+import logging
+import os
+
+from .rate_limit import RateLimitFilter
+
+LOGGER_NAME = 'exchange.client'
+
+logger = logging.getLogger(LOGGER_NAME)
+
+
+def configure_logging(level=logging.WARNING, burst=10, interval=60.0, handler=None):
+    """
+    Configures the client logger.
+
+    Parameters:
+        level (int or str): Lowest level emitted, e.g. logging.DEBUG to follow every call.
+        burst (int): Warnings and errors of the same message let through per interval, or None
+            to disable rate limiting.
+        interval (float): Length in seconds of the rate-limiting window.
+        handler (logging.Handler): Handler to write the records to; a handler writing to stderr
+            is added if none is given and the logger has none yet.
+
+    Returns:
+        logging.Logger: The client logger.
+    """
+    logger.setLevel(level.upper() if isinstance(level, str) else level)
+    for log_filter in [f for f in logger.filters if isinstance(f, RateLimitFilter)]:
+        logger.removeFilter(log_filter)
+    if burst is not None:
+        logger.addFilter(RateLimitFilter(burst, interval))
+    if handler is None and not logger.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter('%(asctime)s %(name)s %(levelname)s: %(message)s'))
+    if handler is not None:
+        logger.addHandler(handler)
+    return logger
+
+
+logger.addFilter(RateLimitFilter())
+if os.environ.get('EXCHANGE_LOG_LEVEL'):
+    configure_logging(os.environ['EXCHANGE_LOG_LEVEL'])
@@ -1,11 +1,14 @@
 import ctypes
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 import numpy as np
+import random
 import time
-from typing import List
+from typing import Dict, List, Optional
 
 # Assuming there is an external module named http_interface that provides required HTTP functionalities
 from .low_level_api import *
+from .diagnostics import logger
+from .tracing import trace_span, traced_call, finish_tracing
 
 # Global configuration
 SERVER_URL = ""
@@ -23,6 +26,98 @@ class SessionData:
     input_variables_size: List[int]
     output_variables_id: List[int]
     output_variables_size: List[int]
+    # Number of payloads that may be queued per variable before the peer receives them (1 if empty)
+    input_variables_queue_depth: List[int] = field(default_factory=list)
+    output_variables_queue_depth: List[int] = field(default_factory=list)
+    # Number and total size (in bytes) of received payloads the server keeps per variable (server defaults if None)
+    history_length: Optional[int] = None
+    history_bytes: Optional[int] = None
+    # Exchange the variables through shared memory segments on the server host (see shared_memory_api),
+    # which the *_with_retries functions do not use
+    shared_memory: bool = False
+    # How the *_with_retries functions wait during this session (see WaitPolicy); the default policy if None
+    wait_policy: Optional["WaitPolicy"] = None
+    # Element type of each variable (see low_level_api.VARIABLE_DTYPES, float64 if empty) and shape,
+    # which received arrays take (a vector of the variable size if empty)
+    input_variables_dtype: List[str] = field(default_factory=list)
+    output_variables_dtype: List[str] = field(default_factory=list)
+    input_variables_shape: List[List[int]] = field(default_factory=list)
+    output_variables_shape: List[List[int]] = field(default_factory=list)
+
+@dataclass
+class WaitPolicy:
+    """
+    How the *_with_retries functions wait for the peer or the server.
+
+    Server-side waits (for queue space, a flag or data) are held open for up to `poll_timeout`
+    seconds per attempt. Between attempts that fail right away, the client sleeps for
+    `initial_delay` seconds at first, then for a delay multiplied by `multiplier` after every
+    attempt up to `max_delay`, each randomly shortened by up to a `jitter` fraction so that
+    clients do not retry in lockstep. Short first delays keep the latency low when the peer is
+    nearly ready, and the backoff protects the server when it is not.
+
+    A call gives up after `deadline` seconds or `max_retries` attempts, whichever comes first
+    (None for no limit; at least one of them should be set).
+    """
+    deadline: Optional[float] = 60.0
+    max_retries: Optional[int] = None
+    initial_delay: float = 0.01
+    max_delay: float = 1.0
+    multiplier: float = 2.0
+    jitter: float = 0.5
+    poll_timeout: float = 5.0
+
+    @classmethod
+    def fixed(cls, max_retries, retry_delay):
+        """ Policy of `max_retries` attempts, `retry_delay` seconds apart and long-polls of `retry_delay` seconds """
+        return cls(deadline=None if max_retries is not None else cls.deadline, max_retries=max_retries,
+                   initial_delay=retry_delay, max_delay=retry_delay, multiplier=1.0, jitter=0.0, poll_timeout=retry_delay)
+
+    def start(self):
+        return RetryState(self)
+
+class RetryState:
+    """ Attempts made and time left in one call retried under a WaitPolicy """
+    def __init__(self, policy: WaitPolicy):
+        self.policy = policy
+        self.attempts = 0
+        self.delay = policy.initial_delay
+        self.deadline = None if policy.deadline is None else time.monotonic() + policy.deadline
+
+    def remaining(self):
+        """ Seconds left until the deadline """
+        if self.deadline is None:
+            return float('inf')
+        return max(0.0, self.deadline - time.monotonic())
+
+    def can_retry(self):
+        """ Whether another attempt may follow the current one """
+        if self.policy.max_retries is not None and self.attempts >= self.policy.max_retries:
+            return False
+        return self.remaining() > 0
+
+    def next_attempt(self):
+        """ Counts a new attempt, unless the retries or time are used up (the first attempt is always made) """
+        if self.attempts and not self.can_retry():
+            return False
+        self.attempts += 1
+        return True
+
+    def poll_timeout(self):
+        """ Seconds the server may hold the current attempt open """
+        return min(self.policy.poll_timeout, self.remaining())
+
+    def next_delay(self):
+        """ Seconds to sleep before the next attempt, 0 if there will be none """
+        if not self.can_retry():
+            return 0.0
+        delay = min(self.delay * random.uniform(1.0 - self.policy.jitter, 1.0), self.remaining())
+        self.delay = min(self.delay * self.policy.multiplier, self.policy.max_delay)
+        return delay
+
+# Wait policy of each session, by session ID (see set_wait_policy), and of sessions without one
+WAIT_POLICIES: Dict[str, WaitPolicy] = {}
+DEFAULT_WAIT_POLICY = WaitPolicy()
 
 class EndSessionData:
     session_id: str
@@ -34,7 +129,7 @@ def set_server_url(url: str):
         SERVER_URL = url.strip()
         SERVER_URL_SET = True
     else:
-        print("Error: Invalid server URL provided.")
+        logger.error("Invalid server URL provided.")
         SERVER_URL_SET = False
 
 def set_session_id(ids: List[int]):
@@ -42,120 +137,287 @@ def set_session_id(ids: List[int]):
     if len(ids) == 5:
         # Convert list of integers to a comma-separated string
         SESSION_ID = ','.join(map(str, ids))
-        print(SESSION_ID)
+        logger.debug("Session ID: %s", SESSION_ID)
     else:
-        print("Error: Invalid session ID array size.")
+        logger.error("Invalid session ID array size.")
+
+
+def session_key(session_id=None):
+    """ The session ID string of a session ID given as a list of integers, or of the current session if None """
+    if session_id is None:
+        session_id = SESSION_ID
+    return session_id if isinstance(session_id, str) else ','.join(map(str, session_id))
+
+def set_wait_policy(policy: WaitPolicy, session_id: Optional[List[int]] = None):
+    """
+    Sets how the *_with_retries functions wait in a session when called without `max_retries`
+    and `retry_delay`: the session with the given ID, or the current one (see set_session_id).
+    Other sessions keep their own policy.
+    """
+    WAIT_POLICIES[session_key(session_id)] = policy
 
+def resolve_wait_policy(max_retries, retry_delay, policy, session_id=None):
+    """
+    The policy of a *_with_retries call: `policy` if given, a fixed delay if `max_retries` or
+    `retry_delay` are given, as in earlier versions of this API, or else the policy of the
+    session with the given ID (the current one if None).
+    """
+    if policy is not None:
+        return policy
+    session_policy = WAIT_POLICIES.get(session_key(session_id), DEFAULT_WAIT_POLICY)
+    if max_retries is not None or retry_delay is not None:
+        return WaitPolicy.fixed(max_retries, session_policy.poll_timeout if retry_delay is None else retry_delay)
+    return session_policy
 
 def start_session(sd: SessionData):
     if not SERVER_URL_SET:
-        print("Error: Server URL not set. Please set a valid server URL before starting a session.")
+        logger.error("Server URL not set. Please set a valid server URL before starting a session.")
         return
 
-    create_session(SERVER_URL, sd.source_model_id, sd.destination_model_id,
+    session_info = create_session(SERVER_URL, sd.source_model_id, sd.destination_model_id,
                 sd.initiator_id, sd.invitee_id, sd.input_variables_id, sd.input_variables_size,
-                sd.output_variables_id, sd.output_variables_size)
+                sd.output_variables_id, sd.output_variables_size,
+                sd.input_variables_queue_depth, sd.output_variables_queue_depth,
+                sd.history_length, sd.history_bytes, sd.shared_memory,
+                sd.input_variables_dtype, sd.output_variables_dtype,
+                sd.input_variables_shape, sd.output_variables_shape)
+    if sd.wait_policy is not None and 'session_id' in session_info:
+        set_wait_policy(sd.wait_policy, session_info['session_id'])
+
+def retry_sleep(seconds):
+    """ Sleeps between two attempts of a *_with_retries function, recording the sleep when tracing """
+    if seconds <= 0:
+        return
+    with trace_span('sleep', 'sleep', seconds=seconds):
+        time.sleep(seconds)
 
 def retrieve_session_status(session_id):
     if not SERVER_URL_SET:
-        print("Error: Server URL not set. Please set a valid server URL before joining a session.")
+        logger.error("Server URL not set. Please set a valid server URL before joining a session.")
         return
     
     session_id = ','.join(map(str, session_id))
     return(get_session_status(SERVER_URL, session_id))
 
-def join_session_with_retries(session_id, invitee_id, max_retries, retry_delay):
-    retries = 0
+@traced_call
+def join_session_with_retries(session_id, invitee_id, max_retries=None, retry_delay=None, policy: Optional[WaitPolicy] = None):
     session_id = ','.join(map(str, session_id))
-    while retries < max_retries:
+    state = resolve_wait_policy(max_retries, retry_delay, policy, session_id).start()
+    while state.next_attempt():
         response = join_session(SERVER_URL, session_id, invitee_id)
         if response['success']:
-            print("Successfully joined the session.")
+            logger.info("Successfully joined the session.")
             return 1
         else:
-            print(f"Failed to join the session. Error: {response['error']}")
+            logger.info("Failed to join the session. Error: %s", response['error'])
             if "Session is already active" in response['error']:
                 return 0
-            time.sleep(retry_delay)
-            retries += 1
+            retry_sleep(state.next_delay())
     return 0
 
-def send_data_with_retries(var_send: int, arr_send: np.ndarray, max_retries: int, retry_delay: int):
-    retries = 0
-    while retries < max_retries:
-        flag = get_variable_flag(SERVER_URL, SESSION_ID, var_send)
-        print(f"Flag status: {flag}")
+@traced_call
+def send_data_with_retries(var_send: int, arr_send: np.ndarray, max_retries: Optional[int] = None,
+                           retry_delay: Optional[float] = None, policy: Optional[WaitPolicy] = None):
+    """
+    Sends data for a variable once its queue has room.
+
+    Parameters:
+        var_send (int): The variable ID of the data.
+        arr_send (np.ndarray): The data to send.
+        max_retries (int): Maximum number of attempts, each waiting on the server for up to
+            `retry_delay` seconds. If neither this nor `retry_delay` is given, the wait policy
+            of the session is used (see WaitPolicy).
+        retry_delay (float): Seconds to wait per attempt.
+        policy (WaitPolicy): Wait policy of this call, overriding the other settings.
 
-        if flag == 0:  # Check if the flag indicates readiness to send
+    Returns:
+        int: 1 if the data was sent, 0 otherwise.
+    """
+    state = resolve_wait_policy(max_retries, retry_delay, policy).start()
+    while state.next_attempt():
+        # Block on the server until the queue of the variable has room, which with the default
+        # queue depth of 1 means the peer has consumed the previous data
+        status = wait_for_queue_space(SERVER_URL, SESSION_ID, var_send, state.poll_timeout())
+        logger.debug("Queue status: %s", status)
+
+        if status is not None and status['queued'] < status['queue_depth']:  # Check if there is room to send
             response = send_data(SERVER_URL, SESSION_ID, var_send, arr_send)
             if response.ok:  # Check if the data was sent successfully
-                print("Data successfully sent.")
+                logger.debug("Data successfully sent.")
                 return 1  # Return 1 to indicate successful send
             else:
-                print("Failed to send data, error:", response.text)
-                # Decide whether to break or continue depending on your application's requirements
-                break
+                logger.error("Failed to send data, error: %s", response.text)
+                return 0
+        elif status is None:
+            # The server returned an error immediately, so wait before asking again
+            retry_sleep(state.next_delay())
         else:
-            print("Flag is not set for sending, retrying...")
-        
-        time.sleep(retry_delay)  # Wait before retrying
-        retries += 1  # Increment the retry count
+            logger.info("Queue is full, retrying...")
 
-        if retries >= max_retries:
-            print(f"Failed to send data for var_id {var_send} after {max_retries} attempts due to flag status.")
-            return 0  # Return 0 to indicate failure after all retries
-
-    return 0  # Ensure a return value if the loop exits normally
+    logger.warning("Failed to send data for var_id %s after %s attempts due to a full queue.", var_send, state.attempts)
+    return 0
 
-def check_data_availability_with_retries(var_id, max_retries, retry_delay):
-    retries = 0
-    while retries < max_retries:
-        flag_status = get_variable_flag(SERVER_URL, SESSION_ID, var_id)
+@traced_call
+def check_data_availability_with_retries(var_id, max_retries=None, retry_delay=None, policy: Optional[WaitPolicy] = None):
+    state = resolve_wait_policy(max_retries, retry_delay, policy).start()
+    while state.next_attempt():
+        # Block on the server until the peer has sent the data
+        flag_status = wait_for_variable_flag(SERVER_URL, SESSION_ID, var_id, 1, state.poll_timeout())
         if flag_status == 1:
-            print(f"Data is available for session {SESSION_ID}, variable {var_id}.")
+            logger.debug("Data is available for session %s, variable %s.", SESSION_ID, var_id)
             return 1
         else:
-            print(f"Data not available for session {SESSION_ID}, variable {var_id}, retrying...")
-            time.sleep(retry_delay)
-            retries += 1
-    
-    print(f"Failed to find available data for session {SESSION_ID}, variable {var_id} after {max_retries} retries.")
+            logger.info("Data not available for session %s, variable %s, retrying...", SESSION_ID, var_id)
+            if flag_status is None:
+                retry_sleep(state.next_delay())
+
+    logger.warning("Failed to find available data for session %s, variable %s after %s retries.", SESSION_ID, var_id, state.attempts)
     return 0
 
-def receive_data_with_retries(var_receive, max_retries, retry_delay):
+@traced_call
+def receive_data_with_retries(var_receive, max_retries=None, retry_delay=None, out=None, policy: Optional[WaitPolicy] = None):
     """
-    Continuously attempts to receive data until successful or until the maximum number of retries is reached.
+    Continuously attempts to receive data until successful or until the retries or the deadline
+    of the wait policy are used up.
 
     Parameters:
         var_receive (int): The variable ID for which data is expected.
-        max_retries (int): Maximum number of attempts to fetch the data.
+        max_retries (int): Maximum number of attempts to fetch the data. If neither this nor
+            `retry_delay` is given, the wait policy of the session is used (see WaitPolicy).
         retry_delay (int): Seconds to wait between retries.
-    
+        out (np.ndarray): Optional array of the size of the variable to receive the data into.
+        policy (WaitPolicy): Wait policy of this call, overriding the other settings.
+
     Returns:
         tuple:
             int: Status code (1 for success, 0 for failure)
-            list of float or None: The received data array if successful, otherwise None.
+            np.ndarray or None: The received data array (`out` if given) if successful, otherwise None.
     """
-    retries = 0
+    state = resolve_wait_policy(max_retries, retry_delay, policy).start()
     status_receive = 0  # Initialize status as 0 (failure)
-    while retries < max_retries:
-        data_array = receive_data(SERVER_URL, SESSION_ID, var_receive)
+    while state.next_attempt():
+        data_array = receive_data(SERVER_URL, SESSION_ID, var_receive, out=out)
         if data_array is not None:
             status_receive = 1  # Set status to 1 (success)
-            print("Data received successfully.")
+            logger.debug("Data received successfully.")
             return (status_receive, data_array)
         else:
-            print("Failed to fetch data, retrying...")
-            time.sleep(retry_delay)
-            retries += 1
+            logger.info("Failed to fetch data, retrying...")
+            retry_sleep(state.next_delay())
 
-    print(f"Failed to receive data for var_id {var_receive} after {max_retries} attempts.")
+    logger.warning("Failed to receive data for var_id %s after %s attempts.", var_receive, state.attempts)
     return (status_receive, None)  # Return the final status (still 0) and None for the data
 
+@traced_call
+def wait_and_receive_data_with_retries(var_receive, max_retries=None, retry_delay=None, out=None,
+                                       policy: Optional[WaitPolicy] = None):
+    """
+    Waits for data to become available and receives it, replacing a call to
+    check_data_availability_with_retries followed by receive_data_with_retries.
+
+    Parameters:
+        var_receive (int): The variable ID for which data is expected.
+        max_retries (int): Maximum number of attempts to fetch the data. If neither this nor
+            `retry_delay` is given, the wait policy of the session is used (see WaitPolicy).
+        retry_delay (int): Seconds the server waits for the data on each attempt.
+        out (np.ndarray): Optional array of the size of the variable to receive the data into.
+        policy (WaitPolicy): Wait policy of this call, overriding the other settings.
+
+    Returns:
+        tuple:
+            int: Status code (1 for success, 0 for failure)
+            np.ndarray or None: The received data array (`out` if given) if successful, otherwise None.
+    """
+    state = resolve_wait_policy(max_retries, retry_delay, policy).start()
+    while state.next_attempt():
+        timeout = state.poll_timeout()
+        started = time.monotonic()
+        data_array = wait_and_receive_data(SERVER_URL, SESSION_ID, var_receive, timeout, out=out)
+        if data_array is not None:
+            logger.debug("Data received successfully.")
+            return (1, data_array)
+        else:
+            logger.info("Data not available for session %s, variable %s, retrying...", SESSION_ID, var_receive)
+            # An answer before the wait expired is an error rather than a timeout, so back off
+            if time.monotonic() - started < timeout:
+                retry_sleep(state.next_delay())
+
+    logger.warning("Failed to receive data for var_id %s after %s attempts.", var_receive, state.attempts)
+    return (0, None)
+
+@traced_call
+def send_many_with_retries(arrays_send: Dict[int, np.ndarray], max_retries: Optional[int] = None,
+                           retry_delay: Optional[float] = None, policy: Optional[WaitPolicy] = None):
+    """
+    Sends data for several variables in one request, retrying while the queue of any of them
+    is full.
+
+    Parameters:
+        arrays_send (dict): Maps each variable ID to the array to be sent for it.
+        max_retries (int): Maximum number of attempts to send the data. If neither this nor
+            `retry_delay` is given, the wait policy of the session is used (see WaitPolicy).
+        retry_delay (int): Seconds to wait between retries.
+        policy (WaitPolicy): Wait policy of this call, overriding the other settings.
+
+    Returns:
+        int: 1 if the data was sent, 0 otherwise.
+    """
+    state = resolve_wait_policy(max_retries, retry_delay, policy).start()
+    while state.next_attempt():
+        response = send_many(SERVER_URL, SESSION_ID, arrays_send)
+        if response.ok:
+            logger.debug("Data successfully sent.")
+            return 1
+        elif response.status_code == 409:
+            logger.info("Queue is full, retrying...")
+        else:
+            logger.error("Failed to send data, error: %s", response.text)
+            return 0
+
+        retry_sleep(state.next_delay())
+
+    logger.warning("Failed to send data for var_ids %s after %s attempts due to a full queue.", list(arrays_send), state.attempts)
+    return 0
+
+@traced_call
+def receive_many_with_retries(var_ids: List[int], max_retries: Optional[int] = None,
+                              retry_delay: Optional[float] = None, policy: Optional[WaitPolicy] = None):
+    """
+    Receives data for several variables in one request, retrying until new data is available
+    for all of them. No separate flag check is needed beforehand.
+
+    Parameters:
+        var_ids (list of int): The variable IDs for which data is expected.
+        max_retries (int): Maximum number of attempts to fetch the data. If neither this nor
+            `retry_delay` is given, the wait policy of the session is used (see WaitPolicy).
+        retry_delay (int): Seconds to wait between retries.
+        policy (WaitPolicy): Wait policy of this call, overriding the other settings.
+
+    Returns:
+        tuple:
+            int: Status code (1 for success, 0 for failure)
+            dict or None: Maps each variable ID to its received data array if successful, otherwise None.
+    """
+    state = resolve_wait_policy(max_retries, retry_delay, policy).start()
+    while state.next_attempt():
+        data_by_var = receive_many(SERVER_URL, SESSION_ID, var_ids)
+        if data_by_var is not None:
+            logger.debug("Data received successfully.")
+            return (1, data_by_var)
+        else:
+            logger.info("Failed to fetch data, retrying...")
+            retry_sleep(state.next_delay())
+
+    logger.warning("Failed to receive data for var_ids %s after %s attempts.", list(var_ids), state.attempts)
+    return (0, None)
+
 def end_session_now(user_id: int):
     if not SERVER_URL_SET:
-        print("Error: Server URL not set. Please set a valid server URL before ending a session.")
+        logger.error("Server URL not set. Please set a valid server URL before ending a session.")
         return
         
     end_session(SERVER_URL, SESSION_ID, user_id)
+    WAIT_POLICIES.pop(session_key(), None)
+    # Export the timings recorded during the session if tracing is enabled (see tracing.py)
+    finish_tracing()
 
@@ -1,14 +1,270 @@
+import numpy as np
 import requests
+from requests.adapters import HTTPAdapter
+import itertools
 import struct
 import time 
+import zlib
 import os
 import ssl
 
+from .diagnostics import logger
+from .tracing import trace_span
+
+# Size of the pieces in which response bodies are read from the connection
+STREAM_CHUNK_SIZE = 1 << 20
+
+# Content coding for payloads understood by the server: the bytes of every 8-byte group are
+# regrouped by position (byte shuffle) and then deflated with zlib
+SHUFFLE_ZLIB_ENCODING = 'x-shuffle-zlib'
+COMPRESSION_LEVEL = 1
+
+# Header of each record in a batch body: little-endian int32 variable ID and uint64 payload length in bytes
+BATCH_RECORD_HEADER = struct.Struct('<iQ')
+
+# Element types variables may be declared with (see create_session). Payloads hold the elements
+# of a variable in C order and little-endian byte order; variables are float64 by default
+VARIABLE_DTYPES = ('float64', 'float32', 'int64', 'int32', 'int16', 'int8', 'uint64', 'uint32', 'uint16', 'uint8', 'bool')
+
+# Declared dtypes of variables, by (server URL, session ID, variable ID), kept until the session
+# is ended (see declared_dtype)
+_declared_dtypes = {}
+
+# Header of each record in a history body: little-endian uint64 sequence number and uint64 payload length in bytes
+HISTORY_RECORD_HEADER = struct.Struct('<QQ')
+
 cert_path = "/global/homes/a/amlodha/Final_Data_Exchange_Service_Code1/src/clients/cyberwater/lib/ssl-cert-snakeoil.pem"
 
+
+class ExchangeClient:
+    """
+    Holds a pooled, keep-alive HTTP session so that consecutive API calls reuse their
+    connections (and TLS handshakes) instead of opening a new one per request.
+
+    Parameters:
+        pool_connections (int): Number of per-host connection pools to cache.
+        pool_maxsize (int): Maximum number of connections kept alive per host.
+        connect_timeout (float): Seconds to wait for a connection to the server.
+        read_timeout (float): Seconds to wait for a response, or None to wait indefinitely.
+        verify (bool or str): TLS certificate verification, as accepted by `requests`.
+        compression (str): Content coding used for variable payloads, either None to send raw
+            payloads or SHUFFLE_ZLIB_ENCODING to compress them (useful on slow links).
+    """
+    def __init__(self, pool_connections=4, pool_maxsize=16, connect_timeout=10.0, read_timeout=60.0, verify=False,
+                 compression=None):
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.verify = verify
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.compression = compression
+
+    def timeout(self, wait=0.0):
+        """ Request timeout, extended by `wait` seconds for requests the server may hold open """
+        read_timeout = None if self.read_timeout is None else self.read_timeout + wait
+        return (self.connect_timeout, read_timeout)
+
+    def get(self, url, wait=0.0, **kwargs):
+        with trace_span('GET', 'http', url=url) as span:
+            response = self.session.get(url, timeout=self.timeout(wait), **kwargs)
+            span.set(status=response.status_code)
+        return response
+
+    def post(self, url, wait=0.0, **kwargs):
+        with trace_span('POST', 'http', url=url) as span:
+            response = self.session.post(url, timeout=self.timeout(wait), **kwargs)
+            span.set(status=response.status_code, bytes=len(kwargs.get('data') or b""))
+        return response
+
+    def close(self):
+        self.session.close()
+
+
+# Client shared by every function of this module
+_client = ExchangeClient()
+
+def configure_client(pool_connections=4, pool_maxsize=16, connect_timeout=10.0, read_timeout=60.0, verify=False,
+                     compression=None):
+    """
+    Replaces the shared HTTP client used by all API functions with one using the given
+    pool size, timeouts, TLS verification and compression settings. See ExchangeClient for
+    the parameters.
+
+    Returns:
+        ExchangeClient: The new shared client.
+    """
+    global _client
+    _client.close()
+    _client = ExchangeClient(pool_connections, pool_maxsize, connect_timeout, read_timeout, verify, compression)
+    return _client
+
+def read_response_payload(response, buffer=None):
+    """
+    Reads a streamed response body into a buffer preallocated from its Content-Length header,
+    so that apart from the buffer itself only one chunk is held in memory at a time.
+
+    Parameters:
+        response (requests.Response): A response obtained with `stream=True`.
+        buffer (memoryview): Optional writable byte buffer to read the body into, used if its
+            size matches the Content-Length header.
+
+    Returns:
+        bytearray or memoryview: The response body (`buffer` if it was used).
+    """
+    with trace_span('read body', 'http', url=response.url) as span:
+        content_length = response.headers.get('Content-Length')
+        if content_length is None:
+            buffer = bytearray(response.content)
+        else:
+            if buffer is None or len(buffer) != int(content_length):
+                buffer = bytearray(int(content_length))
+            offset = 0
+            for chunk in response.iter_content(chunk_size=STREAM_CHUNK_SIZE):
+                buffer[offset:offset + len(chunk)] = chunk
+                offset += len(chunk)
+        span.set(bytes=len(buffer))
+    return buffer
+
+def encode_payload(payload):
+    """ Byte-shuffles and compresses a raw payload; a last group shorter than 8 bytes is shuffled as is """
+    with trace_span('encode', 'pack', bytes=len(payload)):
+        view = memoryview(payload)
+        shuffled = b"".join(view[byte::8].tobytes() for byte in range(8))
+        return zlib.compress(shuffled, COMPRESSION_LEVEL)
+
+def decode_payload(payload):
+    """ Decompresses and un-shuffles a payload produced by encode_payload """
+    with trace_span('decode', 'unpack', bytes=len(payload)):
+        shuffled = memoryview(zlib.decompress(payload))
+        n, tail = divmod(len(shuffled), 8)
+        raw = bytearray(len(shuffled))
+        offset = 0
+        for byte in range(8):
+            length = n + (byte < tail)
+            raw[byte::8] = shuffled[offset:offset + length]
+            offset += length
+        return raw
+
+def wire_dtype(dtype):
+    """ Little-endian NumPy dtype of the payload elements of a variable declared with `dtype` """
+    return np.dtype(dtype).newbyteorder('<')
+
+def payload_dtype(data, dtype=None):
+    """
+    Name of the dtype `data` is sent in: `dtype` if given, the dtype of `data` if it is a NumPy
+    array of one of VARIABLE_DTYPES, and float64 otherwise.
+    """
+    if dtype is not None:
+        return np.dtype(dtype).name
+    if isinstance(data, np.ndarray) and data.dtype.name in VARIABLE_DTYPES:
+        return data.dtype.name
+    return 'float64'
+
+def pack_payload(data, dtype='float64'):
+    """
+    Returns the little-endian bytes of the elements of `data` in `dtype`, in C order, as a byte
+    memoryview. Contiguous arrays of such elements (NumPy arrays or any object supporting the
+    buffer protocol) are sent as they are, without a copy; lists and other layouts are converted once.
+    """
+    return memoryview(np.ascontiguousarray(data, dtype=wire_dtype(dtype))).cast('B')
+
+def parse_shape(text):
+    """ Parses a shape from the comma-separated dimensions of a Payload-Shape header """
+    return tuple(int(dim) for dim in text.split(',')) if text else ()
+
+def payload_layout(headers):
+    """
+    Returns the little-endian dtype and the shape of a payload from the Payload-Dtype and
+    Payload-Shape headers of its response; a float64 vector if they are missing.
+    """
+    shape = headers.get('Payload-Shape')
+    return wire_dtype(headers.get('Payload-Dtype', 'float64')), parse_shape(shape) if shape is not None else (-1,)
+
+def batch_layouts(headers):
+    """ Returns the (dtype, shape) of every record of a batch response, from its Payload-Dtypes and Payload-Shapes headers """
+    dtypes = headers.get('Payload-Dtypes')
+    if not dtypes:
+        return []
+    return [(wire_dtype(dtype), parse_shape(shape)) for dtype, shape in zip(dtypes.split(','), headers['Payload-Shapes'].split(';'))]
+
+def output_buffer(out, dtype=np.dtype('<f8')):
+    """
+    Byte view of the array `out` that a payload of `dtype` elements can be read into directly,
+    or None if its layout does not allow it
+    """
+    if out is None or out.dtype != dtype or not out.flags.c_contiguous or not out.flags.writeable:
+        return None
+    return memoryview(out).cast('B')
+
+def payload_array(binary_data, out=None, dtype=np.dtype('<f8'), shape=(-1,)):
+    """
+    Returns the `dtype` elements of a payload as an ndarray of `shape` viewing `binary_data`, or
+    in `out` (an array of the same size, converted to its dtype) if given. Nothing is copied if
+    the payload was read into `out` directly.
+    """
+    if out is None:
+        return np.frombuffer(binary_data, dtype=dtype).reshape(shape)
+    if isinstance(binary_data, memoryview) and binary_data.obj is out:
+        return out
+    data = np.frombuffer(binary_data, dtype=dtype)
+    if data.size != out.size:
+        raise ValueError(f"Received {data.size} elements for an output array of size {out.size}")
+    np.copyto(out, data.reshape(out.shape))
+    return out
+
+def payload_headers(selection=None):
+    """
+    Headers asking the server to send payloads in the configured compression, if any, and only
+    the elements of a `selection` (see range_selection), if given
+    """
+    headers = {} if selection is None else {'Range': "=".join(selection)}
+    if _client.compression is not None:
+        headers['Accept-Encoding'] = f"{_client.compression}, identity"
+    return headers
+
+def range_selection(offset=None, count=None, hyperslab=None):
+    """
+    Returns the (unit, selection) of a part of a variable for the Range and Content-Range
+    headers, or None for the whole variable: either `count` elements from element `offset` of
+    the flattened variable (to its end if `count` is not given), or a `hyperslab` of its declared
+    shape, one slice (without step), (start, stop) pair or index per dimension.
+    """
+    if hyperslab is not None:
+        dims = []
+        for dim in hyperslab:
+            if isinstance(dim, slice):
+                if dim.step not in (None, 1):
+                    raise ValueError("Hyperslabs cannot have a step")
+                dims.append(f"{'' if dim.start is None else dim.start}:{'' if dim.stop is None else dim.stop}")
+            elif isinstance(dim, tuple):
+                dims.append(f"{dim[0]}:{dim[1]}")
+            else:
+                dims.append(str(int(dim)))
+        return 'hyperslab', ",".join(dims)
+    if offset is None and count is None:
+        return None
+    offset = offset or 0
+    return 'elements', f"{offset}-{'' if count is None else offset + count - 1}"
+
+def read_decoded_payload(response, out=None):
+    """
+    Reads a streamed payload response and decompresses it if the server sent it compressed.
+    Uncompressed payloads are read straight into the array `out` if its dtype and layout allow it.
+    """
+    if response.headers.get('Content-Encoding') == SHUFFLE_ZLIB_ENCODING:
+        return decode_payload(read_response_payload(response))
+    dtype, _ = payload_layout(response.headers)
+    return read_response_payload(response, output_buffer(out, dtype))
+
 def create_session(server_url, source_model_ID, destination_model_ID, initiator_id, invitee_id,
                    input_variables_ID=None, input_variables_size=None,
-                   output_variables_ID=None, output_variables_size=None):
+                   output_variables_ID=None, output_variables_size=None,
+                   input_variables_queue_depth=None, output_variables_queue_depth=None,
+                   history_length=None, history_bytes=None, shared_memory=False,
+                   input_variables_dtype=None, output_variables_dtype=None,
+                   input_variables_shape=None, output_variables_shape=None):
     """
     Creates a session with specified parameters on the server.
 
@@ -22,6 +278,21 @@ def create_session(server_url, source_model_ID, destination_model_ID, initiator_
         input_variables_size (list): Optional list of sizes for input variables.
         output_variables_ID (list): Optional list of output variable IDs.
         output_variables_size (list): Optional list of sizes for output variables.
+        input_variables_queue_depth (list): Optional list of the number of payloads that may be
+            queued for each input variable before it is received (1 if not given).
+        output_variables_queue_depth (list): Optional list of queue depths for output variables.
+        history_length (int): Optional number of received payloads the server keeps per variable
+            for receive_history (1 if not given).
+        history_bytes (int): Optional limit on the total size of the payloads kept per variable.
+        shared_memory (bool): Exchange the variables through shared memory segments on the
+            server host instead of through the server (see shared_memory_api).
+        input_variables_dtype (list): Optional list of the element types of input variables, names
+            of VARIABLE_DTYPES or NumPy dtypes (float64 if not given).
+        output_variables_dtype (list): Optional list of the element types of output variables.
+        input_variables_shape (list): Optional list of the shapes (lists of dimensions) of input
+            variables, whose product must match their size; the size may be omitted then.
+            Received data is returned in this shape (a vector of the variable size if not given).
+        output_variables_shape (list): Optional list of the shapes of output variables.
 
     Returns:
         dict: JSON response from the server or an error message.
@@ -35,20 +306,34 @@ def create_session(server_url, source_model_ID, destination_model_ID, initiator_
         "input_variables_ID": input_variables_ID or [],
         "input_variables_size": input_variables_size or [],
         "output_variables_ID": output_variables_ID or [],
-        "output_variables_size": output_variables_size or []
+        "output_variables_size": output_variables_size or [],
+        "input_variables_queue_depth": input_variables_queue_depth or [],
+        "output_variables_queue_depth": output_variables_queue_depth or []
     }
+    if history_length is not None:
+        data["history_length"] = history_length
+    if history_bytes is not None:
+        data["history_bytes"] = history_bytes
+    if shared_memory:
+        data["shared_memory"] = True
+    if input_variables_dtype or output_variables_dtype:
+        data["input_variables_dtype"] = [np.dtype(dtype).name for dtype in input_variables_dtype or []]
+        data["output_variables_dtype"] = [np.dtype(dtype).name for dtype in output_variables_dtype or []]
+    if input_variables_shape or output_variables_shape:
+        data["input_variables_shape"] = [list(shape) for shape in input_variables_shape or []]
+        data["output_variables_shape"] = [list(shape) for shape in output_variables_shape or []]
 
 
     # Send POST request to the server
-    response = requests.post(f"{server_url}/create_session", json=data, verify=False)
+    response = _client.post(f"{server_url}/create_session", json=data)
     
     # Check response status
     if response.ok:
         session_info = response.json()
-        print(f"Session status: {session_info.get('status', 'unknown')}. Session ID: {session_info.get('session_id', 'N/A')}")
+        logger.info("Session status: %s. Session ID: %s", session_info.get('status', 'unknown'), session_info.get('session_id', 'N/A'))
         return session_info
     else:
-        print("Error occurred:", response.text)
+        logger.error("Error creating session: %s", response.text)
         return {"error": response.text}
 
 def get_session_status(server_url, session_id):
@@ -66,7 +351,7 @@ def get_session_status(server_url, session_id):
     url = f"{server_url}/get_session_status?session_id={session_id}"
     
     # Send the GET request to the server
-    response = requests.get(url, verify=False)
+    response = _client.get(url)
     
     # Check the response status
     if response.ok:
@@ -75,7 +360,7 @@ def get_session_status(server_url, session_id):
         return session_status
     else:
         # Optionally handle different error codes distinctly if needed
-        print(f"Failed to retrieve session status. Server responded with: {response.status_code} - {response.text}")
+        logger.warning("Failed to retrieve session status. Server responded with: %s - %s", response.status_code, response.text)
         return None
 
 def join_session(server_url, session_id, invitee_id):
@@ -93,7 +378,7 @@ def join_session(server_url, session_id, invitee_id):
     data = {"invitee_id": invitee_id, "session_id": session_id}
 
     try:
-        response = requests.post(f"{server_url}/join_session", json=data, verify=False)
+        response = _client.post(f"{server_url}/join_session", json=data)
         if response.ok:
             return {'success': True}
         else:
@@ -118,41 +403,104 @@ def get_variable_size(server_url, session_id, var_id):
     params = {'session_id': session_id, 'var_id': var_id}
 
     # Perform the GET request
-    response = requests.get(url, params=params)
+    response = _client.get(url, params=params)
     if response.ok:
         # Parse and return the size from the JSON response
         size_info = response.json()
-        print(f"Size of variable {var_id} in session {session_id}: {size_info.get('size', 'Unknown')}")
+        logger.debug("Size of variable %s in session %s: %s", var_id, session_id, size_info.get('size', 'Unknown'))
         return size_info.get('size', -1)
     else:
         # Log and return -1 if there was an error during the request
-        print("Error occurred while retrieving variable size:", response.text)
+        logger.warning("Error occurred while retrieving variable size: %s", response.text)
         return -1
+
+def get_variable_info(server_url, session_id, var_id):
+    """
+    Retrieves the declared layout of a specific variable within a session from the server.
+
+    Parameters:
+        server_url (str): The server URL.
+        session_id (str): The ID of the session.
+        var_id (int): The ID of the variable.
+
+    Returns:
+        dict: The `size`, `dtype` and `shape` of the payloads the server accepts for the variable
+        if the request is successful, None otherwise.
+    """
+    response = _client.get(f"{server_url}/get_variable_size", params={'session_id': session_id, 'var_id': var_id})
+    if response.ok:
+        return response.json()
+    else:
+        logger.warning("Error occurred while retrieving variable size: %s", response.text)
+        return None
+
+def declared_dtype(server_url, session_id, var_id):
+    """
+    Returns the name of the dtype a variable was declared with, asking the server the first
+    time, or None if the server could not tell.
+    """
+    key = (server_url, str(session_id), var_id)
+    if key not in _declared_dtypes:
+        info = get_variable_info(server_url, session_id, var_id)
+        if info is None:
+            return None
+        _declared_dtypes[key] = info['dtype']
+    return _declared_dtypes[key]
     
-def send_data(server_url, session_id, var_id, data):
+def send_data(server_url, session_id, var_id, data, dtype=None, offset=None, hyperslab=None):
     """
-    Sends a list of double precision floats as binary data to the server for a specific session and variable.
+    Sends an array of numbers as binary data to the server for a specific session and variable.
 
     Parameters:
         server_url (str): The server URL.
         session_id (str): The session ID to which the data belongs.
         var_id (int): The identifier for the variable to which the data is related.
-        data (list of float): The data to be sent, represented as a list of doubles.
+        data (numpy.ndarray or list of float): The elements to be sent, as an array of any shape
+            (or any object supporting the buffer protocol) or a list.
+        dtype (str or numpy.dtype): The element type to send the data in. If not given, the data
+            is converted to the declared dtype of the variable (see declared_dtype).
+        offset (int): Send only part of the next payload of the variable, the elements of `data`
+            from this element of the flattened variable on.
+        hyperslab (tuple): Send only part of the next payload of the variable, the elements of
+            `data` in this hyperslab of its declared shape (see range_selection).
+
+    Returns:
+        requests.Response: The server response. Its JSON body holds the sequence number assigned
+        to the data as `seq`; the status code is 409 if the queue of the variable is full, and 400
+        if the data does not match the declared size of the variable, or `dtype` its declared dtype. The payload of
+        parts sent with `offset` or `hyperslab`, for instance by the ranks of a domain-decomposed
+        model, is queued once they cover the whole variable, and `seq` is None until then.
 
     Note:
-        The data is packed in little-endian format.
+        The data is sent in little-endian format, and compressed if the shared client was
+        configured with a compression (see configure_client).
     """
-    # Convert the list of doubles into binary data using little-endian format
-    binary_data = struct.pack('<' + 'd' * len(data), *data)
-
-    # Prepare HTTP headers to include session and variable identifiers
+    # Little-endian arrays of the declared dtype are sent from their own memory
+    if dtype is None:
+        dtype = declared_dtype(server_url, session_id, var_id)
+    dtype = payload_dtype(data, dtype)
+    with trace_span('send_data', 'pack') as span:
+        binary_data = pack_payload(data, dtype)
+        span.set(bytes=len(binary_data))
+
+    # Prepare HTTP headers to include session and variable identifiers, and the element type
+    # for the server to check against the declared one
     headers = {
         'Session-ID': session_id,
-        'Var-ID': str(var_id)
+        'Var-ID': str(var_id),
+        'Payload-Dtype': dtype
     }
+    if offset is not None or hyperslab is not None:
+        unit, selection = range_selection(offset, np.size(data), hyperslab)
+        headers['Content-Range'] = f"{unit} {selection}/*"
+
+    # Compress the payload if configured (see configure_client)
+    if _client.compression is not None:
+        binary_data = encode_payload(binary_data)
+        headers['Content-Encoding'] = _client.compression
 
     # Send the binary data as a POST request to the server
-    response = requests.post(f"{server_url}/send_data", data=binary_data, headers=headers, verify=False)
+    response = _client.post(f"{server_url}/send_data", data=binary_data, headers=headers)
     
     return response
 
@@ -174,48 +522,343 @@ def get_variable_flag(server_url, session_id, var_id):
     params = {'session_id': session_id, 'var_id': var_id}
 
     # Perform the GET request
-    response = requests.get(url, params=params, verify=False)
+    response = _client.get(url, params=params)
 
     # Check if the request was successful
     if response.ok:
         # Parse and return the flag status from the JSON response
         flag_status = response.json().get('flag_status')
-        print(f"Flag for session {session_id} variable {var_id}: {flag_status}")
+        logger.debug("Flag for session %s variable %s: %s", session_id, var_id, flag_status)
         return flag_status
     else:
         # Log and return None if there was an error during the request
-        print("Error occurred while retrieving flag status:", response.text)
+        logger.warning("Error occurred while retrieving flag status: %s", response.text)
         return None
 
 
-def receive_data(server_url, session_id, var_id):
+def wait_for_variable_flag(server_url, session_id, var_id, flag_status, timeout):
     """
-    Receives binary data from the server for a given session and variable ID, assuming the data
-    is a stream of double precision floats.
+    Waits on the server until the flag of a specific variable reaches the expected value.
+
+    The server holds the request open until the flag changes or the timeout expires, so the
+    caller is notified as soon as the peer sends or consumes the data instead of polling.
+
+    Parameters:
+        server_url (str): The server URL.
+        session_id (str): The ID of the session.
+        var_id (int): The ID of the variable.
+        flag_status (int): The flag value to wait for (1 when data is available, 0 when it was consumed).
+        timeout (float): Maximum number of seconds the server should wait.
+
+    Returns:
+        int: The flag status when the wait ended if the request is successful, None otherwise.
+    """
+    url = f"{server_url}/wait_for_variable_flag"
+    params = {'session_id': session_id, 'var_id': var_id, 'flag_status': flag_status, 'timeout': timeout}
+
+    response = _client.get(url, wait=timeout, params=params)
+
+    if response.ok:
+        return response.json().get('flag_status')
+    else:
+        logger.warning("Error occurred while waiting for flag status: %s", response.text)
+        return None
+
+
+def wait_for_queue_space(server_url, session_id, var_id, timeout):
+    """
+    Waits on the server until the queue of a specific variable has room for another payload,
+    so that a producer can run up to the queue depth of the variable ahead of its consumer.
+
+    Parameters:
+        server_url (str): The server URL.
+        session_id (str): The ID of the session.
+        var_id (int): The ID of the variable.
+        timeout (float): Maximum number of seconds the server should wait.
+
+    Returns:
+        dict: The queue status when the wait ended, with the number of payloads not received yet
+        (`queued`), the `queue_depth` and the sequence number of the latest payload sent
+        (`last_seq`), if the request is successful, None otherwise.
+    """
+    url = f"{server_url}/wait_for_queue_space"
+    params = {'session_id': session_id, 'var_id': var_id, 'timeout': timeout}
+
+    response = _client.get(url, wait=timeout, params=params)
+
+    if response.ok:
+        return response.json()
+    else:
+        logger.warning("Error occurred while waiting for queue space: %s", response.text)
+        return None
+
+
+def receive_data(server_url, session_id, var_id, return_seq=False, out=None, offset=None, count=None, hyperslab=None):
+    """
+    Receives binary data from the server for a given session and variable ID, as an array of the
+    dtype and shape declared for the variable. The oldest payload queued for the variable is
+    received, or the last received one again if none is queued.
 
     Parameters:
         server_url (str): The server URL.
         session_id (str): The session ID from which data is to be retrieved.
         var_id (int): The variable ID associated with the data.
+        return_seq (bool): Also return the sequence number the server assigned to the data.
+        out (numpy.ndarray): Optional array of the size of the data to receive it into, read into
+            directly if it has the dtype of the variable and converted otherwise.
+        offset, count, hyperslab: Receive only part of the payload, `count` elements from
+            element `offset` of the flattened variable or a hyperslab of its declared shape (see
+            range_selection). The whole payload is received from the queue all the same.
     
     Returns:
-        list of float: The unpacked data array of double precision floats, or None if an error occurred.
+        numpy.ndarray: The received data, as a view over the response buffer or `out`, or None
+        if an error occurred. With `return_seq`, a (seq, data) tuple instead, or None.
     """
     params = {"session_id": session_id, "var_id": var_id}
 
-    response = requests.get(f"{server_url}/receive_data", params=params, verify=False)
+    headers = payload_headers(range_selection(offset, count, hyperslab))
+    with _client.get(f"{server_url}/receive_data", params=params, headers=headers, stream=True) as response:
+        if response.ok:
+            dtype, shape = payload_layout(response.headers)
+            binary_data = read_decoded_payload(response, out)
+            with trace_span('receive_data', 'unpack', bytes=len(binary_data)):
+                unpacked_data = payload_array(binary_data, out, dtype, shape)
+            logger.debug("Received %d %s elements for session %s variable %s", unpacked_data.size, dtype.name, session_id, var_id)
+            if return_seq:
+                return int(response.headers['Sequence-Number']), unpacked_data
+            return unpacked_data
+        else:
+            logger.info("Error retrieving data for session %s variable %s: %s", session_id, var_id, response.text)
+            return None
+
+
+def wait_and_receive_data(server_url, session_id, var_id, timeout, return_seq=False, out=None, offset=None, count=None,
+                          hyperslab=None):
+    """
+    Waits on the server until data is queued for a given session and variable ID, then
+    receives the oldest queued payload in the same request. The server removes it from the
+    queue atomically, so no separate flag check is needed.
+
+    Parameters:
+        server_url (str): The server URL.
+        session_id (str): The session ID from which data is to be retrieved.
+        var_id (int): The variable ID associated with the data.
+        timeout (float): Maximum number of seconds the server should wait for the data.
+        return_seq (bool): Also return the sequence number the server assigned to the data.
+        out (numpy.ndarray): Optional array of the size of the data to receive it into (see receive_data).
+        offset, count, hyperslab: Receive only part of the payload (see receive_data).
+
+    Returns:
+        numpy.ndarray: The received data, as a view over the response buffer or `out`, or None
+        if no data arrived before the timeout or an error occurred. With `return_seq`, a (seq, data)
+        tuple instead, or None.
+    """
+    params = {"session_id": session_id, "var_id": var_id, "timeout": timeout}
+
+    headers = payload_headers(range_selection(offset, count, hyperslab))
+    with _client.get(f"{server_url}/wait_and_receive_data", wait=timeout, params=params, headers=headers,
+                     stream=True) as response:
+        if response.ok:
+            dtype, shape = payload_layout(response.headers)
+            binary_data = read_decoded_payload(response, out)
+            with trace_span('receive_data', 'unpack', bytes=len(binary_data)):
+                unpacked_data = payload_array(binary_data, out, dtype, shape)
+            logger.debug("Received %d %s elements for session %s variable %s", unpacked_data.size, dtype.name, session_id, var_id)
+            if return_seq:
+                return int(response.headers['Sequence-Number']), unpacked_data
+            return unpacked_data
+        else:
+            logger.info("Error retrieving data for session %s variable %s: %s", session_id, var_id, response.text)
+            return None
+
+
+def pack_batch(data_by_var, dtypes):
+    """
+    Frames data for several variables into a batch body: every variable becomes a
+    (var_id, length) header followed by its little-endian elements in the dtype `dtypes` maps it to.
+    """
+    with trace_span('pack_batch', 'pack') as span:
+        parts = []
+        for var_id, data in data_by_var.items():
+            payload = pack_payload(data, dtypes[var_id])
+            parts.append(BATCH_RECORD_HEADER.pack(var_id, len(payload)))
+            parts.append(payload)
+        body = b"".join(parts)
+        span.set(bytes=len(body))
+    return body
+
+
+def unpack_batch(binary_data, record_header=BATCH_RECORD_HEADER, layouts=()):
+    """
+    Splits a batch body into a dictionary mapping each variable ID to an array of its data,
+    viewing `binary_data`. With `record_header=HISTORY_RECORD_HEADER`, splits a history body
+    into a dictionary mapping each sequence number to an array of its data instead. `layouts`
+    yields the (dtype, shape) of the records in order (see batch_layouts); records beyond it
+    are float64 vectors.
+    """
+    with trace_span('unpack_batch', 'unpack', bytes=len(binary_data)):
+        layouts = iter(layouts)
+        data_by_var = {}
+        offset = 0
+        while offset < len(binary_data):
+            var_id, length = record_header.unpack_from(binary_data, offset)
+            offset += record_header.size
+            dtype, shape = next(layouts, (np.dtype('<f8'), (-1,)))
+            data_by_var[var_id] = np.frombuffer(binary_data, dtype=dtype, count=length // dtype.itemsize,
+                                                offset=offset).reshape(shape)
+            offset += length
+        return data_by_var
+
+
+def send_many(server_url, session_id, data_by_var):
+    """
+    Sends data for several variables of a session to the server in a single request.
+
+    Parameters:
+        server_url (str): The server URL.
+        session_id (str): The session ID to which the data belongs.
+        data_by_var (dict): Maps each variable ID to the array (or list of numbers) to be sent for
+            it, converted to the declared dtype of the variable (see declared_dtype).
+
+    Returns:
+        requests.Response: The server response. Its status code is 409 if the queue of one of the
+        variables is full, in which case nothing was stored.
+    """
+    dtypes = {var_id: payload_dtype(data, declared_dtype(server_url, session_id, var_id))
+              for var_id, data in data_by_var.items()}
+    headers = {'Session-ID': session_id, 'Payload-Dtypes': ",".join(dtypes.values())}
+
+    response = _client.post(f"{server_url}/send_data_batch", data=pack_batch(data_by_var, dtypes), headers=headers)
+
+    return response
+
+
+def receive_many(server_url, session_id, var_ids):
+    """
+    Receives data for several variables of a session from the server in a single request.
+    The server answers at once and does not wait: unless new data is queued for every requested
+    variable, nothing is received and None is returned. Use receive_many_with_retries of the
+    high-level API to wait for the data.
+
+    Parameters:
+        server_url (str): The server URL.
+        session_id (str): The session ID from which data is to be retrieved.
+        var_ids (list of int): The variable IDs to receive.
+
+    Returns:
+        dict: Maps each variable ID to an ndarray of its data, in the declared dtype and shape of
+        the variable, or None if new data is not queued for every variable or an error occurred.
+    """
+    params = {"session_id": session_id, "var_ids": list(var_ids)}
+
+    with _client.get(f"{server_url}/receive_data_batch", params=params, stream=True) as response:
+        if not response.ok:
+            logger.info("Error retrieving data for session %s variables %s: %s", session_id, var_ids, response.text)
+            return None
+        data_by_var = unpack_batch(read_response_payload(response), layouts=batch_layouts(response.headers))
 
+    logger.debug("Received data for session %s variables %s", session_id, list(data_by_var))
+    return data_by_var
+
+
+def receive_history(server_url, session_id, var_id, start_seq, end_seq=None, timeout=0.0, offset=None, count=None,
+                    hyperslab=None):
+    """
+    Reads earlier payloads of a variable by sequence number, from the history the server keeps
+    (see create_session) or from its queue, without consuming them.
+
+    Parameters:
+        server_url (str): The server URL.
+        session_id (str): The session ID from which data is to be retrieved.
+        var_id (int): The variable ID associated with the data.
+        start_seq (int): Sequence number of the first payload to read.
+        end_seq (int): Sequence number of the last payload to read (inclusive), `start_seq` if not given.
+        timeout (float): Maximum number of seconds the server should wait for payloads of the
+            range not sent yet.
+        offset, count, hyperslab: Read only part of every payload (see receive_data).
+
+    Returns:
+        dict: Maps each sequence number of the range to an ndarray of its data, in the declared
+        dtype and shape of the variable or of the part read, or None if a payload of the range is
+        no longer stored, did not arrive before the timeout, or an error occurred.
+
+    Note:
+        Every rank of a domain-decomposed consumer can read its own part of step `seq` with
+        `receive_history(..., seq, timeout=..., hyperslab=...)` while one rank receives the step
+        (for instance with `wait_and_receive_data(..., hyperslab=...)`); the other ranks must read
+        it before `history_length` later steps are received.
+    """
+    params = {"session_id": session_id, "var_id": var_id, "start_seq": start_seq, "timeout": timeout}
+    if end_seq is not None:
+        params["end_seq"] = end_seq
+
+    headers = payload_headers(range_selection(offset, count, hyperslab))
+    with _client.get(f"{server_url}/receive_history", wait=timeout, params=params, headers=headers,
+                     stream=True) as response:
+        if not response.ok:
+            logger.warning("Error retrieving history: %s", response.text)
+            return None
+        layouts = itertools.repeat(payload_layout(response.headers))
+        return unpack_batch(read_response_payload(response), HISTORY_RECORD_HEADER, layouts)
+    
+def get_shared_memory_segment(server_url, session_id, var_id):
+    """
+    Retrieves the shared memory segment of a variable of a same-host session.
+
+    Parameters:
+        server_url (str): The server URL.
+        session_id (str): The ID of the session.
+        var_id (int): The ID of the variable.
+
+    Returns:
+        dict: The `name` of the segment, the `size` of a payload in elements, their `dtype` and
+        `shape`, and the number of payload `slots` if the request is successful, None otherwise.
+    """
+    response = _client.get(f"{server_url}/get_shared_memory_segment", params={'session_id': session_id, 'var_id': var_id})
     if response.ok:
-        binary_data = response.content
-        num_doubles = len(binary_data) // 8  # Each double is 8 bytes
-        unpacked_data = struct.unpack(f'<{num_doubles}d', binary_data)
-        print(f"Received binary data of length {num_doubles}")
-        print("Data array:", unpacked_data)
-        return unpacked_data
+        return response.json()
     else:
-        print("Error retrieving data:", response.text)
+        logger.warning("Error occurred while retrieving the shared memory segment: %s", response.text)
         return None
-    
+
+def commit_shared_data(server_url, session_id, var_id):
+    """
+    Queues the payload written to the shared memory slot of the next sequence number of a variable.
+
+    Parameters:
+        server_url (str): The server URL.
+        session_id (str): The ID of the session.
+        var_id (int): The ID of the variable.
+
+    Returns:
+        requests.Response: The server response. Its JSON body holds the sequence number assigned
+        to the data as `seq` and the queue status; the status code is 409 if the queue is full.
+    """
+    return _client.post(f"{server_url}/commit_shared_data", params={'session_id': session_id, 'var_id': var_id})
+
+def wait_and_receive_shared_data(server_url, session_id, var_id, timeout):
+    """
+    Waits on the server until a payload is queued for a variable of a same-host session and
+    removes it from the queue.
+
+    Parameters:
+        server_url (str): The server URL.
+        session_id (str): The ID of the session.
+        var_id (int): The ID of the variable.
+        timeout (float): Maximum number of seconds the server should wait for the data.
+
+    Returns:
+        int: The sequence number of the payload, whose shared memory slot is to be read, or None
+        if no data arrived before the timeout or an error occurred.
+    """
+    params = {'session_id': session_id, 'var_id': var_id, 'timeout': timeout}
+    response = _client.get(f"{server_url}/wait_and_receive_shared_data", wait=timeout, params=params)
+    if response.ok:
+        return response.json()['seq']
+    else:
+        logger.info("Error retrieving data for session %s variable %s: %s", session_id, var_id, response.text)
+        return None
+
 def end_session(server_url, session_id, user_id):
     """
     Ends a session on the server using a POST request with the session ID and user ID.
@@ -225,7 +868,6 @@ def end_session(server_url, session_id, user_id):
         session_id (str): The ID of the session to be ended.
         user_id (int): The ID of the user (initiator or invitee) ending the session.
     """
-    print(session_id)
     # Prepare data payload for the POST request
     data = {
         "session_id": session_id,
@@ -233,12 +875,16 @@ def end_session(server_url, session_id, user_id):
     }
 
     # Send the POST request to end the session
-    response = requests.post(f"{server_url}/end_session", json=data, verify=False)
+    response = _client.post(f"{server_url}/end_session", json=data)
 
     # Check if the request was successful
     if response.ok:
         # Print the status message from the response
-        print(response.json().get("status", "No status message received."))
+        logger.info("%s", response.json().get("status", "No status message received."))
     else:
         # Print an error message if the request failed
-        print("Error ending session:", response.text)
+        logger.error("Error ending session: %s", response.text)
+
+    # A later session may reuse the ID with other declarations
+    for key in [key for key in _declared_dtypes if key[:2] == (server_url, str(session_id))]:
+        del _declared_dtypes[key]
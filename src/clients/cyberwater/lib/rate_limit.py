@@ -0,0 +1,52 @@
+"""
+Rate limiting of log records of the client API. The exchange server runs on its own and keeps
+a copy of this module next to it (src/server/rate_limit.py); keep both in step.
+
+A misbehaving peer can make either side log the same warning or error on every request, so
+repeats of a warning or error are limited; records below WARNING, such as the session changes
+logged at INFO, are never dropped.
+"""
+import logging
+import threading
+import time
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Lets at most `burst` records of each message of level `min_level` or above through every
+    `interval` seconds. Messages are told apart once formatted, so records about different
+    sessions or variables are limited separately. The first record let through after a drop
+    reports how many identical records were dropped.
+    """
+    # Number of tracked messages above which the windows that have ended are dropped
+    MAX_WINDOWS = 1024
+
+    def __init__(self, burst=10, interval=60.0, min_level=logging.WARNING):
+        super().__init__()
+        self.burst = burst
+        self.interval = interval
+        self.min_level = min_level
+        # Maps (logger name, level, formatted message) to [window start, records let through, records dropped]
+        self._windows = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno < self.min_level:
+            return True
+        now = time.monotonic()
+        key = (record.name, record.levelno, record.getMessage())
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None or now - window[0] >= self.interval:
+                dropped = 0 if window is None else window[2]
+                if window is None and len(self._windows) >= self.MAX_WINDOWS:
+                    self._windows = {k: w for k, w in self._windows.items() if now - w[0] < self.interval}
+                self._windows[key] = [now, 1, 0]
+                if dropped:
+                    record.msg = f"{record.msg} ({dropped} identical messages suppressed)"
+                return True
+            if window[1] < self.burst:
+                window[1] += 1
+                return True
+            window[2] += 1
+            return False
@@ -0,0 +1,137 @@
+"""
+Shared memory fast path for models running on the same host as the exchange server.
+
+A session created with `create_session(..., shared_memory=True)` gets a named shared memory
+segment per variable, with `queue_depth` + 1 slots of the declared size, dtype and shape of the
+variable. The producer writes a payload straight into the slot of its next sequence number and
+commits it, and the consumer copies it out of its slot, so a payload is copied once on each
+side. Only the control messages (queue space, sequence numbers and flags) go through the
+server. Variables of such sessions cannot be sent or received through the other APIs.
+"""
+import numpy as np
+from multiprocessing import resource_tracker, shared_memory
+
+from .diagnostics import logger
+from .low_level_api import (commit_shared_data, get_shared_memory_segment, wait_and_receive_shared_data, wait_for_queue_space,
+                            wire_dtype)
+from .tracing import trace_span
+
+
+def attach_segment(name):
+    """
+    Attaches an existing shared memory segment without letting this process unlink it at exit,
+    which the resource tracker of Python before 3.13 does for every segment it has seen.
+    """
+    try:
+        return shared_memory.SharedMemory(name, track=False)
+    except TypeError:
+        segment = shared_memory.SharedMemory(name)
+        resource_tracker.unregister(segment._name, 'shared_memory')
+        return segment
+
+
+class SharedMemoryVariable:
+    """
+    The shared memory segment of one variable of a same-host session, attached by one of the
+    models. Each variable must have a single producer and a single consumer.
+
+    Parameters:
+        server_url (str): The server URL.
+        session_id (str): The ID of the session.
+        var_id (int): The ID of the variable.
+    """
+    def __init__(self, server_url, session_id, var_id):
+        segment_info = get_shared_memory_segment(server_url, session_id, var_id)
+        if segment_info is None:
+            raise ValueError(f"Variable {var_id} of session {session_id} has no shared memory segment")
+        self.server_url = server_url
+        self.session_id = session_id
+        self.var_id = var_id
+        self.size = segment_info['size']
+        self.dtype = wire_dtype(segment_info['dtype'])
+        self.shape = tuple(segment_info['shape'])
+        self.segment = attach_segment(segment_info['name'])
+        self.slots = np.ndarray((segment_info['slots'], *self.shape), dtype=self.dtype, buffer=self.segment.buf)
+        # Sequence number of the latest payload committed, and number of payloads the producer may
+        # still commit without waiting, as of the last answer of the server
+        self.last_seq = 0
+        self.queue_space = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.slots = None
+        self.segment.close()
+
+    def slot(self, seq):
+        """ Returns the slot of the payload with sequence number `seq` as an array viewing the segment """
+        return self.slots[(seq - 1) % len(self.slots), ...]
+
+    def send_data(self, data, timeout):
+        """
+        Writes data into the slot of the next sequence number of the variable, converted to its
+        dtype, and queues it, waiting on the server for up to `timeout` seconds if the queue is full.
+
+        Parameters:
+            data (numpy.ndarray or list of float): The elements to be sent, as many as the declared
+                size of the variable.
+            timeout (float): Maximum number of seconds to wait for queue space.
+
+        Returns:
+            int: The sequence number assigned to the data, or None if the queue stayed full or an
+            error occurred.
+        """
+        data = np.asarray(data)
+        if data.size != self.size:
+            raise ValueError(f"Variable {self.var_id} holds {self.size} elements, not {data.size}")
+        if self.queue_space == 0:
+            status = wait_for_queue_space(self.server_url, self.session_id, self.var_id, timeout)
+            if status is None:
+                return None
+            self.last_seq = status['last_seq']
+            self.queue_space = status['queue_depth'] - status['queued']
+            if self.queue_space == 0:
+                logger.info("Queue of session %s variable %s is still full", self.session_id, self.var_id)
+                return None
+
+        with trace_span('send_data', 'shared_memory', bytes=self.size * self.dtype.itemsize):
+            np.copyto(self.slot(self.last_seq + 1), data.reshape(self.shape), casting='unsafe')
+        response = commit_shared_data(self.server_url, self.session_id, self.var_id)
+        if not response.ok:
+            logger.error("Failed to commit data for session %s variable %s: %s", self.session_id, self.var_id, response.text)
+            self.queue_space = 0
+            return None
+        status = response.json()
+        self.last_seq = status['seq']
+        self.queue_space = status['queue_depth'] - status['queued']
+        return self.last_seq
+
+    def wait_and_receive_data(self, timeout, return_seq=False, out=None):
+        """
+        Waits on the server until data is queued for the variable, then copies it out of its slot.
+
+        Parameters:
+            timeout (float): Maximum number of seconds the server should wait for the data.
+            return_seq (bool): Also return the sequence number of the data.
+            out (numpy.ndarray): Optional array of the size of the variable to copy the data into.
+
+        Returns:
+            numpy.ndarray: The received data, in the shape of the variable (`out` if given), or
+            None if no data arrived before
+            the timeout or an error occurred. With `return_seq`, a (seq, data) tuple instead, or None.
+        """
+        seq = wait_and_receive_shared_data(self.server_url, self.session_id, self.var_id, timeout)
+        if seq is None:
+            return None
+        with trace_span('receive_data', 'shared_memory', bytes=self.size * self.dtype.itemsize):
+            if out is None:
+                data = self.slot(seq).copy()
+            else:
+                np.copyto(out, self.slot(seq).reshape(out.shape))
+                data = out
+        logger.debug("Received %d %s elements for session %s variable %s", self.size, self.dtype.name, self.session_id, self.var_id)
+        return (seq, data) if return_seq else data
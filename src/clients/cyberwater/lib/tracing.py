@@ -0,0 +1,176 @@
+"""
+Opt-in tracing of the client API.
+
+When enabled, the API records a span for every HTTP round-trip, body read, packing and
+unpacking of payloads, retry loop and sleep, with the bytes transferred. end_session_now
+exports the spans as a summary table or, if an output path was given, as a Chrome trace
+(JSON) that can be opened in chrome://tracing or https://ui.perfetto.dev.
+
+Tracing is enabled with enable_tracing, or with the EXCHANGE_TRACE environment variable set
+to 'table' or to the path of the trace file. While it is disabled, trace_span returns a shared
+no-op span, so instrumented code only pays for one function call.
+"""
+import functools
+import json
+import os
+import threading
+import time
+from urllib.parse import urlsplit
+
+from .diagnostics import logger
+
+
+class Span:
+    """ A timed section of a call; extra arguments, such as `bytes`, can be added with `set` """
+    __slots__ = ('name', 'category', 'args', 'start')
+
+    def __init__(self, name, category, args):
+        if category == 'http' and 'url' in args:
+            name = f"{name} {urlsplit(args.pop('url')).path}"
+        self.name = name
+        self.category = category
+        self.args = args
+
+    def set(self, **args):
+        self.args.update(args)
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc_info):
+        duration = time.perf_counter_ns() - self.start
+        events = _events
+        if events is not None:
+            events.append((self.name, self.category, self.start, duration, self.args, threading.get_ident()))
+        return False
+
+
+class _NullSpan:
+    """ Span returned while tracing is disabled """
+    __slots__ = ()
+
+    def set(self, **args):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+# Recorded spans as (name, category, start_ns, duration_ns, args, thread_id), or None while tracing is disabled
+_events = None
+# Path of the Chrome trace written by finish_tracing, or None to print a summary table
+_output = None
+
+
+def trace_span(name, category, **args):
+    """ Return a context manager timing a section of a call, recorded only while tracing is enabled """
+    if _events is None:
+        return _NULL_SPAN
+    return Span(name, category, args)
+
+
+def traced_call(function):
+    """
+    Decorator recording a span for every call of `function`, with the number of HTTP requests
+    it made, the bytes they transferred and the time it slept between retries.
+    """
+    name = function.__name__
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        events = _events
+        if events is None:
+            return function(*args, **kwargs)
+        first = len(events)
+        with Span(name, 'call', {}) as span:
+            result = function(*args, **kwargs)
+            thread_id = threading.get_ident()
+            nested = [event for event in events[first:] if event[5] == thread_id]
+            span.set(requests=sum(1 for event in nested if event[1] == 'http' and event[0].startswith(('GET', 'POST'))),
+                     bytes=sum(event[4].get('bytes', 0) for event in nested if event[1] == 'http'),
+                     sleep_ms=sum(event[3] for event in nested if event[1] == 'sleep') / 1e6)
+        return result
+    return wrapper
+
+
+def enable_tracing(output=None):
+    """
+    Start recording spans.
+
+    Parameters:
+        output (str): Path of the Chrome trace file written at the end of the session, or None
+            to print a summary table instead.
+    """
+    global _events, _output
+    _events = []
+    _output = output
+
+
+def disable_tracing():
+    """ Stop recording spans and discard those recorded so far """
+    global _events
+    _events = None
+
+
+def tracing_enabled():
+    return _events is not None
+
+
+def summary_table(events=None):
+    """
+    Format the recorded spans as a table with one row per span name: number of calls, total,
+    mean and maximum time, and bytes transferred, sorted by total time.
+    """
+    if events is None:
+        events = _events or []
+    rows = {}
+    for name, category, _, duration, args, _ in events:
+        row = rows.setdefault((category, name), [0, 0, 0, 0])
+        row[0] += 1
+        row[1] += duration
+        row[2] = max(row[2], duration)
+        row[3] += args.get('bytes', 0)
+
+    lines = [f"{'category':<10} {'span':<36} {'calls':>7} {'total ms':>10} {'mean ms':>9} {'max ms':>9} {'bytes':>12}"]
+    for (category, name), (calls, total, longest, size) in sorted(rows.items(), key=lambda item: -item[1][1]):
+        lines.append(f"{category:<10} {name:<36} {calls:>7} {total / 1e6:>10.3f} {total / calls / 1e6:>9.3f} "
+                     f"{longest / 1e6:>9.3f} {size:>12}")
+    return "\n".join(lines)
+
+
+def write_chrome_trace(path, events=None):
+    """ Write the recorded spans to `path` in the Chrome trace event format """
+    if events is None:
+        events = _events or []
+    pid = os.getpid()
+    trace_events = [{'name': name, 'cat': category, 'ph': 'X', 'ts': start / 1e3, 'dur': duration / 1e3,
+                     'pid': pid, 'tid': thread_id, 'args': args}
+                    for name, category, start, duration, args, thread_id in events]
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': trace_events, 'displayTimeUnit': 'ms'}, f)
+
+
+def finish_tracing():
+    """
+    Export the spans recorded so far, as configured by enable_tracing, and start recording
+    anew. Does nothing while tracing is disabled.
+    """
+    global _events
+    if _events is None:
+        return
+    events, _events = _events, []
+    if _output is None:
+        print(summary_table(events))
+    else:
+        write_chrome_trace(_output, events)
+        logger.info("Exchange trace written to %s", _output)
+
+
+if os.environ.get('EXCHANGE_TRACE'):
+    enable_tracing(None if os.environ['EXCHANGE_TRACE'] == 'table' else os.environ['EXCHANGE_TRACE'])
@@ -1,15 +1,53 @@
-from fastapi import FastAPI, HTTPException, Request, Response, Header
+from fastapi import FastAPI, HTTPException, Request, Header, Query
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from pydantic import BaseModel
 from typing import List, Optional
+from collections import Counter
+from abc import ABC, abstractmethod
+from collections.abc import MutableMapping
+from contextlib import asynccontextmanager
+from multiprocessing import shared_memory
 import uvicorn
+import argparse
+import fcntl
+import itertools
+import json
+import logging
+import math
+import mmap
+import os
+import pickle
+import queue
+import re
+import secrets
+import shutil
 import struct
 import threading
+import time
 import asyncio
+import bisect
 import warnings
+import zlib
+
+from rate_limit import RateLimitFilter
 
 warnings.filterwarnings("ignore", category=DeprecationWarning)
 app = FastAPI()
 
+# Diagnostics of the server: session changes at INFO level, per-request details at DEBUG
+logger = logging.getLogger('exchange.server')
+
+def configure_logging(level):
+    """ Set the level of the server logger and write its records to stderr, like Uvicorn's own """
+    logger.setLevel(level.upper())
+    if not logger.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter('%(levelname)s:     %(message)s'))
+        logger.addHandler(handler)
+        logger.addFilter(RateLimitFilter())
+
+configure_logging(os.environ.get('EXCHANGE_LOG_LEVEL', 'info'))
+
 # Pydantic models to validate incoming data
 class SessionData(BaseModel):
     source_model_ID: int
@@ -20,65 +58,1567 @@ class SessionData(BaseModel):
     input_variables_size: List[int] = []
     output_variables_ID: List[int] = []
     output_variables_size: List[int] = []
+    input_variables_queue_depth: List[int] = []
+    output_variables_queue_depth: List[int] = []
+    history_length: int = 1
+    history_bytes: int = 64 << 20
+    shared_memory: bool = False
+    input_variables_dtype: List[str] = []
+    output_variables_dtype: List[str] = []
+    input_variables_shape: List[List[int]] = []
+    output_variables_shape: List[List[int]] = []
 
 class JoinSessionData(BaseModel):
     session_id: str
     invitee_id: int
 
-# Shared resource: sessions dictionary and a lock to manage concurrent access
-sessions = {}
-session_lock = threading.Lock()
+class Metrics:
+    """
+    Counters and histograms of the server, rendered in the Prometheus text exposition format
+    by /metrics. Every series is identified by a metric name (see METRICS) and its labels.
+    Values are kept per server process.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+
+    def inc(self, name, value=1.0, **labels):
+        """ Add `value` to a counter """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0.0) + value
+
+    def observe(self, name, value, **labels):
+        """ Record a sample in a histogram """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [[0] * len(HISTOGRAM_BUCKETS), 0.0, 0]
+            for i, bound in enumerate(HISTOGRAM_BUCKETS):
+                if value <= bound:
+                    histogram[0][i] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def forget(self, **labels):
+        """ Drop every series having all of the given labels, e.g. those of an ended session """
+        wanted = set(labels.items())
+        with self._lock:
+            for series in (self._counters, self._histograms):
+                for key in [key for key in series if wanted <= set(key[1])]:
+                    del series[key]
+
+    def render(self, gauges=()):
+        """ Render all series, followed by `gauges`, a list of (name, labels, value) computed by the caller """
+        samples = {}
+        with self._lock:
+            for (name, labels), value in self._counters.items():
+                samples.setdefault(name, []).append((name, labels, value))
+            for (name, labels), (buckets, total, count) in self._histograms.items():
+                lines = samples.setdefault(name, [])
+                for bound, bucket_count in zip(HISTOGRAM_BUCKETS, buckets):
+                    lines.append((name + '_bucket', labels + (('le', repr(bound)),), bucket_count))
+                lines.append((name + '_bucket', labels + (('le', '+Inf'),), count))
+                lines.append((name + '_sum', labels, total))
+                lines.append((name + '_count', labels, count))
+        for name, labels, value in gauges:
+            samples.setdefault(name, []).append((name, tuple(sorted(labels.items())), value))
+
+        output = []
+        for name, (kind, description) in METRICS.items():
+            output.append(f"# HELP {name} {description}")
+            output.append(f"# TYPE {name} {kind}")
+            for sample_name, labels, value in samples.get(name, []):
+                output.append(f"{sample_name}{format_labels(labels)} {value}")
+        return "\n".join(output) + "\n"
+
+def format_labels(labels):
+    """ Format (name, value) label pairs as a Prometheus label set """
+    if not labels:
+        return ""
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + "}"
+
+# Metrics exposed by /metrics, by name: (Prometheus type, description)
+METRICS = {
+    'exchange_requests_total': ('counter', "Requests served, by route, method and status code"),
+    'exchange_request_duration_seconds': ('histogram', "Time from receiving a request to sending the end of its response, by route"),
+    'exchange_lock_wait_seconds': ('histogram', "Time requests waited to acquire the lock of a session"),
+    'exchange_flag_wait_seconds': ('histogram', "Time long-polling requests were held waiting for a flag or queue change, by route"),
+    'exchange_flag_wait_seconds_total': ('counter', "Total time requests waited for a flag or queue change, by session and variable"),
+    'exchange_received_bytes_total': ('counter', "Payload bytes received from clients, by session and variable"),
+    'exchange_sent_bytes_total': ('counter', "Payload bytes sent to clients, by session and variable"),
+    'exchange_sessions': ('gauge', "Current sessions, by status"),
+    'exchange_variable_flag': ('gauge', "Current flag of each variable (1 while payloads are queued)"),
+    'exchange_queued_payloads': ('gauge', "Payloads queued and not received yet, by session and variable"),
+}
+
+# Upper bounds (in seconds) of the histogram buckets
+HISTOGRAM_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Shared resource: metrics of this server process
+metrics = Metrics()
+
+class MetricsMiddleware:
+    """
+    ASGI middleware counting requests and timing them, until the last chunk of a streamed
+    response has been sent. Paths that are not routes of the app are reported as 'other'.
+    """
+    def __init__(self, app):
+        self.app = app
+        self.route_paths = None  # Paths of the routes of the app, collected on the first request
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        if self.route_paths is None:
+            self.route_paths = frozenset(route.path for route in app.routes)
+        route = scope['path'] if scope['path'] in self.route_paths else 'other'
+        status_code = 500
+        start = time.perf_counter()
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message['type'] == 'http.response.start':
+                status_code = message['status']
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            metrics.inc('exchange_requests_total', route=route, method=scope['method'], status=str(status_code))
+            metrics.observe('exchange_request_duration_seconds', time.perf_counter() - start, route=route)
+
+app.add_middleware(MetricsMiddleware)
+
+class SessionStore(ABC):
+    """
+    Base class of the session stores.
+
+    A store keeps every session as a dictionary (see create_session for its layout) and hands
+    it out through `lock`, which serializes all work on one session. The store also owns the
+    per-(session, variable) asyncio events used to wake long-polling requests, and a plain
+    threading lock that is only held for bookkeeping, never while a request is being served.
+    Backends implement create, remove, items and lock; one missing any of them cannot be
+    instantiated.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._session_locks = {}
+        self._flag_events = {}
+
+    @abstractmethod
+    def create(self, base_session_id, session):
+        """ Store `session` under the first free ID derived from `base_session_id` and return that ID """
+
+    @abstractmethod
+    def remove(self, session_id):
+        """ Remove a session; must be called while holding its lock """
+
+    @abstractmethod
+    def items(self):
+        """ Return a snapshot of the (session_id, session) pairs """
+
+    @abstractmethod
+    def lock(self, session_id, detail="Session not found", readonly=False):
+        """
+        Async context manager holding the lock of a session and yielding it, raising a 404 with
+        `detail` if it does not exist. Requests that only read the session pass `readonly`, and
+        the store then skips saving or journaling it when the lock is released.
+        """
+
+    def session_lock(self, session_id):
+        """ The asyncio lock serializing requests of this process on a session """
+        with self._lock:
+            lock = self._session_locks.get(session_id)
+            if lock is None:
+                lock = self._session_locks[session_id] = asyncio.Lock()
+            return lock
+
+    def flag_event(self, session_id, var_id):
+        """ The event that will be set on the next flag change of a variable """
+        with self._lock:
+            events = self._flag_events.setdefault(session_id, {})
+            event = events.get(var_id)
+            if event is None:
+                event = events[var_id] = asyncio.Event()
+            return event
+
+    def notify(self, session_id, var_id):
+        """ Wake every request waiting for a flag change of a variable """
+        # Each event is used once: waiters grab the current event, and a fresh one replaces it on every change
+        with self._lock:
+            event = self._flag_events.get(session_id, {}).pop(var_id, None)
+        if event is not None:
+            event.set()
+
+    def forget(self, session_id):
+        """ Drop the lock and events of a removed session, waking any request still waiting on it """
+        with self._lock:
+            self._session_locks.pop(session_id, None)
+            events = self._flag_events.pop(session_id, {})
+        for event in events.values():
+            event.set()
+
+class InProcessSessionStore(SessionStore):
+    """
+    Session store keeping all sessions in a dictionary of the server process.
+
+    This is the default store. Sessions are only visible to the process that created them,
+    so the server must run with a single worker.
+
+    With a `spill_dir`, payloads are moved out of the process heap into memory-mapped files
+    under that directory (see spill_payloads): those of the least recently used sessions once
+    the payloads held in memory exceed `memory_limit` bytes, and those of sessions not used for
+    `idle_timeout` seconds. A spilled payload stays in the 'data' mapping of its session (see
+    ResidentPayloads) as a read-only mmap, which the endpoints serve like any other payload.
+
+    With a `journal` (see SessionJournal), the sessions saved by a previous run of the server
+    are recovered at startup (see recover), and every change made to a session is journaled
+    once its lock is released.
+    """
+    def __init__(self, spill_dir=None, memory_limit=None, idle_timeout=None, journal=None):
+        super().__init__()
+        self._sessions = {}
+        self._last_access = {}
+        self.spill_dir = spill_dir
+        self.memory_limit = memory_limit
+        self.idle_timeout = idle_timeout
+        self.journal = journal
+        self.spill_task = None
+        self._resident_bytes = 0
+        if spill_dir is not None:
+            os.makedirs(spill_dir, exist_ok=True)
+
+    def recover(self):
+        """ Load the sessions saved in the journal, if any, and return their number """
+        if self.journal is None:
+            return 0
+        recovered = self.journal.recover()
+        for session in recovered.values():
+            session['data'] = ResidentPayloads(self, session['data'])
+        with self._lock:
+            self._sessions.update(recovered)
+            self._last_access.update((session_id, time.monotonic()) for session_id in recovered)
+        return len(recovered)
+
+    def create(self, base_session_id, session):
+        session['data'] = ResidentPayloads(self, session['data'])
+        with self._lock:
+            i = 1
+            session_id = f"{base_session_id},{i}"
+            while session_id in self._sessions:
+                i += 1
+                session_id = f"{base_session_id},{i}"
+            session['session_id'] = session_id
+            self._sessions[session_id] = session
+        if self.journal is not None:
+            self.journal.record(session_id, session)
+        return session_id
+
+    def get(self, session_id):
+        """ Return the session with the given ID, or None if it does not exist """
+        with self._lock:
+            return self._sessions.get(session_id)
+
+    def remove(self, session_id):
+        with self._lock:
+            session = self._sessions.pop(session_id, None)
+            self._last_access.pop(session_id, None)
+        if session is not None:
+            session['data'].detach()
+        if self.journal is not None:
+            self.journal.record_removal(session_id)
+        self.forget(session_id)
+
+    def items(self):
+        with self._lock:
+            return list(self._sessions.items())
+
+    @asynccontextmanager
+    async def lock(self, session_id, detail="Session not found", readonly=False):
+        session = self.get(session_id)
+        if session is None:
+            raise HTTPException(status_code=404, detail=detail)
+        start = time.perf_counter()
+        async with self.session_lock(session_id):
+            metrics.observe('exchange_lock_wait_seconds', time.perf_counter() - start)
+            # The session may have been ended while this request was waiting for its lock
+            if self.get(session_id) is not session:
+                raise HTTPException(status_code=404, detail=detail)
+            try:
+                yield session
+            finally:
+                with self._lock:
+                    exists = session_id in self._sessions
+                    if exists:
+                        self._last_access[session_id] = time.monotonic()
+                if exists and self.journal is not None and not readonly:
+                    self.journal.record(session_id, session)
+                    self.journal.snapshot(self.items())
+        if self.memory_limit is not None and self._resident_bytes > self.memory_limit:
+            self.start_spill()
+
+    def resident_bytes(self):
+        """ Total size of the payloads held in the process heap, i.e. not spilled """
+        return self._resident_bytes
+
+    def add_resident_bytes(self, size):
+        """ Account for payloads added to (or, with a negative `size`, removed from) the process heap """
+        with self._lock:
+            self._resident_bytes += size
+
+    def start_spill(self):
+        """ Run spill_payloads in the background unless it is already running, and return its task """
+        if self.spill_task is None or self.spill_task.done():
+            self.spill_task = asyncio.create_task(self.spill_payloads())
+        return self.spill_task
+
+    async def spill_payloads(self):
+        """
+        Spill the payloads of idle sessions, then those of the least recently used sessions
+        while the payloads held in memory exceed the memory limit. Requests are served while
+        the payloads are written, and each one is swapped for its mapping under the session lock.
+        """
+        if self.spill_dir is None:
+            return
+        now = time.monotonic()
+        with self._lock:
+            candidates = sorted(self._sessions.items(), key=lambda item: self._last_access.get(item[0], now))
+            last_access = dict(self._last_access)
+
+        try:
+            for session_id, session in candidates:
+                idle = self.idle_timeout is not None and now - last_access.get(session_id, now) >= self.idle_timeout
+                over_limit = self.memory_limit is not None and self._resident_bytes > self.memory_limit
+                if not idle and not over_limit:
+                    break  # Candidates are ordered by last access, so the remaining ones are neither idle nor needed
+                await self._spill(session_id, session)
+        except OSError:
+            logger.exception("Spilling payloads to %s failed", self.spill_dir)
+
+    async def _spill(self, session_id, session):
+        """ Replace the in-memory payloads of a session by memory-mapped files """
+        for key, payload in list(session['data'].items()):
+            if isinstance(payload, mmap.mmap) or len(payload) < SPILL_MIN_SIZE:
+                continue
+            var_id, seq = key
+            path = os.path.join(self.spill_dir, f"{session_id}_var_{var_id}_{seq}.bin")
+            # Payloads are never modified once stored, so the file is written outside of the session lock
+            mapping = await asyncio.to_thread(self._write_spill_file, path, payload)
+            async with self.session_lock(session_id):
+                # The payload may have been received, evicted or the session ended meanwhile
+                if self.get(session_id) is session and session['data'].get(key) is payload:
+                    session['data'][key] = mapping
+                else:
+                    mapping.close()
+
+    @staticmethod
+    def _write_spill_file(path, payload):
+        """ Write a payload to a file and return a read-only mapping of it """
+        with open(path, 'w+b') as f:
+            f.write(payload)
+            f.flush()
+            mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        # The mapping keeps the file alive: the kernel reclaims it once the payload is dropped
+        # from the session and any response still streaming it has finished
+        os.unlink(path)
+        return mapping
+
+class ResidentPayloads(MutableMapping):
+    """
+    Variable payloads of a session in an InProcessSessionStore, keyed by (var_id, seq), which
+    keeps the count of payload bytes the store holds in the process heap up to date as payloads
+    are stored, spilled and dropped, so that checking the memory limit costs nothing.
+    """
+    def __init__(self, store, payloads=()):
+        self._store = store
+        self._payloads = {}
+        self.update(payloads)
+
+    @staticmethod
+    def _resident_size(payload):
+        return 0 if isinstance(payload, mmap.mmap) else len(payload)
+
+    def __getitem__(self, key):
+        return self._payloads[key]
+
+    def _account(self, size):
+        if self._store is not None:
+            self._store.add_resident_bytes(size)
+
+    def detach(self):
+        """ Stop counting these payloads in the store, once their session has been removed """
+        self._account(-sum(map(self._resident_size, self._payloads.values())))
+        self._store = None
+
+    def __setitem__(self, key, payload):
+        previous = self._payloads.get(key)
+        self._payloads[key] = payload
+        self._account(self._resident_size(payload) - (0 if previous is None else self._resident_size(previous)))
+
+    def __delitem__(self, key):
+        self._account(-self._resident_size(self._payloads.pop(key)))
+
+    def __iter__(self):
+        return iter(self._payloads)
+
+    def __len__(self):
+        return len(self._payloads)
+
+class SharedPayloads(MutableMapping):
+    """
+    Variable payloads of a session in a SharedSessionStore, keyed by (var_id, seq) like the
+    'data' dictionary of an in-process session and stored as one raw file per queue slot.
+
+    Payload files are never modified in place: a new payload is written to a temporary file
+    that atomically replaces the old one. Reads can therefore return a read-only memory map,
+    which stays valid while a response is still streaming it after the session lock is released
+    and even after the slot has been deleted.
+    """
+    def __init__(self, directory, var_ids):
+        self.directory = directory
+        self.var_ids = list(var_ids)
+
+    def _path(self, key):
+        if not isinstance(key, tuple) or len(key) != 2 or key[0] not in self.var_ids:
+            raise KeyError(key)
+        var_id, seq = key
+        return os.path.join(self.directory, f"var_{var_id}_{seq}.bin")
+
+    def __getitem__(self, key):
+        try:
+            with open(self._path(key), 'rb') as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    return b""
+                return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except FileNotFoundError:
+            raise KeyError(key)
+
+    def __setitem__(self, key, payload):
+        path = self._path(key)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(payload)
+        os.replace(path + '.tmp', path)
+
+    def __delitem__(self, key):
+        try:
+            os.unlink(self._path(key))
+        except FileNotFoundError:
+            raise KeyError(key)
+
+    def __iter__(self):
+        for name in os.listdir(self.directory):
+            match = re.fullmatch(r"var_(-?[0-9]+)_(-?[0-9]+)\.bin", name)
+            if match:
+                yield int(match.group(1)), int(match.group(2))
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+class PolledEvent:
+    """
+    Flag event of a SharedSessionStore. Changes made by this process set the wrapped event
+    immediately; changes made by other workers are noticed by waking up every `interval`
+    seconds, after which the waiting request checks the flag again.
+    """
+    def __init__(self, event, interval):
+        self.event = event
+        self.interval = interval
+
+    async def wait(self):
+        try:
+            await asyncio.wait_for(self.event.wait(), timeout=self.interval)
+        except asyncio.TimeoutError:
+            pass
+        return True
+
+class SharedSessionStore(SessionStore):
+    """
+    Session store shared by several server worker processes on the same host.
+
+    Every session is a directory under `root` holding a pickle of its metadata and one raw
+    file per queued variable payload (see SharedPayloads). Placing `root` on a tmpfs such as
+    /dev/shm keeps the payloads in shared memory. Workers exclude each other with flock on
+    a per-session lock file, and on a registry lock file while creating sessions.
+    """
+    def __init__(self, root, poll_interval=0.01):
+        super().__init__()
+        self.root = root
+        self.poll_interval = poll_interval
+        os.makedirs(root, exist_ok=True)
+
+    def _directory(self, session_id):
+        # Session IDs are comma separated integers; anything else could escape `root`
+        if not re.fullmatch(r"[-0-9,]+", session_id):
+            return None
+        return os.path.join(self.root, session_id)
+
+    def create(self, base_session_id, session):
+        with open(os.path.join(self.root, 'registry.lock'), 'w') as registry_lock:
+            fcntl.flock(registry_lock, fcntl.LOCK_EX)
+            i = 1
+            session_id = f"{base_session_id},{i}"
+            while os.path.exists(self._directory(session_id)):
+                i += 1
+                session_id = f"{base_session_id},{i}"
+            directory = self._directory(session_id)
+            os.makedirs(directory)
+            session['session_id'] = session_id
+            self._save(directory, session)
+        return session_id
+
+    def _save(self, directory, session, previous=None):
+        """ Atomically replace the metadata file of a session, unless it is unchanged from `previous` """
+        metadata = pickle.dumps({key: value for key, value in session.items() if key != 'data'})
+        if metadata == previous:
+            return
+        metadata_path = os.path.join(directory, 'session.pkl')
+        with open(metadata_path + '.tmp', 'wb') as f:
+            f.write(metadata)
+        os.replace(metadata_path + '.tmp', metadata_path)
+
+    def remove(self, session_id):
+        shutil.rmtree(self._directory(session_id), ignore_errors=True)
+        self.forget(session_id)
+
+    def items(self):
+        items = []
+        for session_id in sorted(os.listdir(self.root)):
+            try:
+                with open(os.path.join(self.root, session_id, 'session.pkl'), 'rb') as f:
+                    items.append((session_id, pickle.load(f)))
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+        return items
+
+    @asynccontextmanager
+    async def lock(self, session_id, detail="Session not found", readonly=False):
+        directory = self._directory(session_id)
+        if directory is None or not os.path.isdir(directory):
+            raise HTTPException(status_code=404, detail=detail)
+
+        start = time.perf_counter()
+        async with self.session_lock(session_id):
+            try:
+                fd = os.open(os.path.join(directory, 'lock'), os.O_RDWR | os.O_CREAT)
+            except FileNotFoundError:
+                raise HTTPException(status_code=404, detail=detail)
+            try:
+                # Poll instead of blocking so that the event loop keeps serving other requests
+                while True:
+                    try:
+                        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                        break
+                    except BlockingIOError:
+                        await asyncio.sleep(self.poll_interval / 10)
+                metrics.observe('exchange_lock_wait_seconds', time.perf_counter() - start)
+
+                # The session may have been ended while this request was waiting for its lock
+                try:
+                    with open(os.path.join(directory, 'session.pkl'), 'rb') as f:
+                        metadata = f.read()
+                except FileNotFoundError:
+                    raise HTTPException(status_code=404, detail=detail)
+                session = pickle.loads(metadata)
+                session['data'] = SharedPayloads(directory, session['flags'])
+
+                yield session
+
+                if not readonly and os.path.isdir(directory):
+                    self._save(directory, session, previous=metadata)
+            finally:
+                os.close(fd)
+
+    def flag_event(self, session_id, var_id):
+        return PolledEvent(super().flag_event(session_id, var_id), self.poll_interval)
+
+class SessionJournal:
+    """
+    Append-only journal of the sessions of an InProcessSessionStore, from which they are
+    recovered when the server restarts.
+
+    After every request that may have changed a session (see SessionStore.lock), the store
+    hands the session to `record`, which compares it with what was journaled before and queues records of the changes: the new metadata (the session
+    without its payloads), new payloads and discarded payloads. A writer thread appends the
+    records to `journal.<generation>` off the request path. Once the journal outgrows both
+    `compact_bytes` and the last snapshot, `snapshot` queues a copy of all sessions, which the
+    writer saves as `snapshot.<generation + 1>` before starting a new journal and deleting
+    the files of the previous generation. Recovery loads the latest snapshot and replays its
+    journal up to the first incomplete record, such as one cut short by a crash.
+
+    Records only ever set or delete state, so replaying a change that a snapshot already
+    contains is harmless. Same-host sessions (see create_shared_segments) are not journaled:
+    their payloads live in shared memory segments, which are unlinked when the server stops.
+    Without `fsync`, records reach the operating system as soon as the
+    writer has caught up, which survives a crash of the server but not of the host.
+    """
+    def __init__(self, directory, compact_bytes=64 << 20, fsync=False):
+        self.directory = directory
+        self.compact_bytes = compact_bytes
+        self.fsync = fsync
+        os.makedirs(directory, exist_ok=True)
+        self.generation = 0
+        self.journal_bytes = 0
+        self.snapshot_bytes = 0
+        self._metadata = {}  # Pickled metadata of every session as last journaled
+        self._payload_keys = {}  # Keys of the payloads of every session as last journaled
+        self._jobs = queue.SimpleQueue()
+        self._snapshot_pending = False
+        self._file = None
+        self._writer = None
+
+    def _path(self, kind, generation):
+        return os.path.join(self.directory, f"{kind}.{generation}")
+
+    def recover(self):
+        """ Rebuild the sessions saved in the journal directory and start journaling; returns a dictionary of the sessions by ID """
+        generations = [int(name.split('.')[1]) for name in os.listdir(self.directory)
+                       if re.fullmatch(r"snapshot\.[0-9]+", name)]
+        self.generation = max(generations, default=0)
+
+        sessions = {}
+        snapshot_path = self._path('snapshot', self.generation)
+        if os.path.exists(snapshot_path):
+            self.snapshot_bytes = self._replay(snapshot_path, sessions)
+        journal_path = self._path('journal', self.generation)
+        self.journal_bytes = self._replay(journal_path, sessions) if os.path.exists(journal_path) else 0
+
+        # Files of other generations are left over from a crash during compaction
+        for name in os.listdir(self.directory):
+            if re.fullmatch(r"(snapshot|journal)\.[0-9]+(\.tmp)?", name) and name.split('.')[1] != str(self.generation):
+                os.unlink(os.path.join(self.directory, name))
+
+        for session_id, session in sessions.items():
+            self._metadata[session_id] = self._pickle_metadata(session)
+            self._payload_keys[session_id] = set(session['data'])
+
+        # Appending after an incomplete record would hide every later record from the next recovery
+        self._file = open(journal_path, 'ab')
+        self._file.truncate(self.journal_bytes)
+        self._writer = threading.Thread(target=self._write, name="session-journal", daemon=True)
+        self._writer.start()
+        return sessions
+
+    def _replay(self, path, sessions):
+        """ Apply the records of a file to `sessions`, returning the length of its complete records """
+        with open(path, 'rb') as f:
+            contents = f.read()
+        view = memoryview(contents)
+        offset = 0
+        while offset + JOURNAL_RECORD_HEADER.size <= len(view):
+            crc, description_length, payload_length = JOURNAL_RECORD_HEADER.unpack_from(view, offset)
+            start = offset + JOURNAL_RECORD_HEADER.size
+            end = start + description_length + payload_length
+            if end > len(view) or zlib.crc32(view[start:end]) != crc:
+                break
+            description = pickle.loads(view[start:start + description_length])
+            self._apply(sessions, description, bytes(view[start + description_length:end]))
+            offset = end
+        return offset
+
+    @staticmethod
+    def _apply(sessions, description, payload):
+        kind, session_id, *key = description
+        if kind == 'session':
+            session = pickle.loads(payload)
+            session['data'] = sessions[session_id]['data'] if session_id in sessions else {}
+            sessions[session_id] = session
+        elif kind == 'payload' and session_id in sessions:
+            sessions[session_id]['data'][tuple(key)] = payload
+        elif kind == 'discard' and session_id in sessions:
+            sessions[session_id]['data'].pop(tuple(key), None)
+        elif kind == 'remove':
+            sessions.pop(session_id, None)
+
+    @staticmethod
+    def _pickle_metadata(session):
+        return pickle.dumps({key: value for key, value in session.items() if key != 'data'})
+
+    def record(self, session_id, session):
+        """ Queue records of the changes made to a session since it was last journaled """
+        if session.get('shared_memory'):
+            return
+        metadata = self._pickle_metadata(session)
+        if metadata != self._metadata.get(session_id):
+            self._metadata[session_id] = metadata
+            self._jobs.put((('session', session_id), metadata))
+
+        # Payloads are never modified once stored, so comparing keys finds every change
+        journaled = self._payload_keys.get(session_id, set())
+        payloads = session['data']
+        for key in payloads.keys() - journaled:
+            self._jobs.put((('payload', session_id, *key), payloads[key]))
+        for key in journaled - payloads.keys():
+            self._jobs.put((('discard', session_id, *key), b""))
+        self._payload_keys[session_id] = set(payloads)
+
+    def record_removal(self, session_id):
+        """ Queue the record of the removal of a session """
+        self._metadata.pop(session_id, None)
+        self._payload_keys.pop(session_id, None)
+        self._jobs.put((('remove', session_id), b""))
+
+    def snapshot(self, items):
+        """ Queue a snapshot of the given (session_id, session) pairs if the journal is due for compaction """
+        if self._snapshot_pending or self.journal_bytes < max(self.compact_bytes, self.snapshot_bytes):
+            return
+        self._snapshot_pending = True
+        records = []
+        for session_id, session in items:
+            if session.get('shared_memory'):
+                continue
+            records.append((('session', session_id), self._pickle_metadata(session)))
+            records.extend((('payload', session_id, *key), payload) for key, payload in session['data'].items())
+        self._jobs.put((None, records))
+
+    def close(self):
+        """ Write the queued records and stop the writer thread """
+        if self._writer is not None:
+            self._jobs.put(None)
+            self._writer.join()
+            self._writer = None
+
+    def _write(self):
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                self._file.close()
+                return
+            description, payload = job
+            if description is None:
+                self._compact(payload)
+            else:
+                self.journal_bytes += self._append(self._file, description, payload)
+            if self._jobs.empty():
+                self._file.flush()
+                if self.fsync:
+                    os.fsync(self._file.fileno())
+
+    @staticmethod
+    def _append(f, description, payload):
+        description = pickle.dumps(description)
+        crc = zlib.crc32(payload, zlib.crc32(description))
+        f.write(JOURNAL_RECORD_HEADER.pack(crc, len(description), len(payload)))
+        f.write(description)
+        f.write(payload)
+        return JOURNAL_RECORD_HEADER.size + len(description) + len(payload)
+
+    def _compact(self, records):
+        """ Save a snapshot as the next generation and switch to a new, empty journal """
+        generation = self.generation + 1
+        snapshot_path = self._path('snapshot', generation)
+        with open(snapshot_path + '.tmp', 'wb') as f:
+            snapshot_bytes = sum(self._append(f, description, payload) for description, payload in records)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(snapshot_path + '.tmp', snapshot_path)
+
+        self._file.close()
+        self._file = open(self._path('journal', generation), 'wb')
+        for kind in ('journal', 'snapshot'):
+            try:
+                os.unlink(self._path(kind, self.generation))
+            except FileNotFoundError:
+                pass
+        self.generation = generation
+        self.snapshot_bytes = snapshot_bytes
+        self.journal_bytes = 0
+        self._snapshot_pending = False
+
+# Each journal record is a header (little-endian uint32 CRC-32 of the rest of the record, uint64
+# length of the pickled record description, uint64 payload length) followed by both
+JOURNAL_RECORD_HEADER = struct.Struct('<IQQ')
+
+# Default location of the shared session store, on a tmpfs so that payloads stay in shared memory
+DEFAULT_SHARED_STORE_DIR = '/dev/shm/exchange_sessions'
+
+# Payloads smaller than a page are never spilled, as their mapping would take more memory than they do
+SPILL_MIN_SIZE = mmap.PAGESIZE
+
+def create_session_store():
+    """
+    Build the session store selected by the EXCHANGE_SESSION_STORE environment variable:
+    'memory' (default) for an InProcessSessionStore, or 'shared' for a SharedSessionStore
+    rooted at EXCHANGE_STORE_DIR.
+
+    The in-process store spills payloads to EXCHANGE_SPILL_DIR, if set, once they exceed
+    EXCHANGE_SPILL_MEMORY_LIMIT bytes or their session has been idle for
+    EXCHANGE_SPILL_IDLE_SECONDS seconds. It journals sessions to EXCHANGE_JOURNAL_DIR, if set,
+    syncing the journal to disk if EXCHANGE_JOURNAL_FSYNC=1.
+    """
+    backend = os.environ.get('EXCHANGE_SESSION_STORE', 'memory')
+    if backend == 'memory':
+        memory_limit = os.environ.get('EXCHANGE_SPILL_MEMORY_LIMIT')
+        idle_timeout = os.environ.get('EXCHANGE_SPILL_IDLE_SECONDS')
+        journal_dir = os.environ.get('EXCHANGE_JOURNAL_DIR')
+        journal = None
+        if journal_dir is not None:
+            journal = SessionJournal(journal_dir, fsync=os.environ.get('EXCHANGE_JOURNAL_FSYNC', '0') == '1')
+        return InProcessSessionStore(os.environ.get('EXCHANGE_SPILL_DIR'),
+                                     None if memory_limit is None else int(memory_limit),
+                                     None if idle_timeout is None else float(idle_timeout), journal)
+    elif backend == 'shared':
+        return SharedSessionStore(os.environ.get('EXCHANGE_STORE_DIR', DEFAULT_SHARED_STORE_DIR))
+    raise ValueError(f"Unknown session store: {backend}")
+
+# Shared resource: store of all sessions, each with its own lock to manage concurrent access
+sessions = create_session_store()
+
+# Each record of a batch body is a header (little-endian int32 variable ID, uint64 payload length
+# in bytes) immediately followed by the payload itself
+BATCH_RECORD_HEADER = struct.Struct('<iQ')
+
+# Each record of a history body is a header (little-endian uint64 sequence number, uint64 payload
+# length in bytes) immediately followed by the payload itself
+HISTORY_RECORD_HEADER = struct.Struct('<QQ')
+
+# Each request of the binary transport (see serve_binary_connection) is a header (little-endian
+# uint8 operation, uint8 session ID length, int32 variable ID, int64 argument, float64 timeout
+# in seconds, uint64 payload length) followed by the UTF-8 session ID and the payload
+BINARY_REQUEST_HEADER = struct.Struct('<BBiqdQ')
+
+# Each response of the binary transport is a header (little-endian uint16 status code as in the
+# HTTP API, int64 value, uint64 body length) followed by the body, which holds the error detail
+# in UTF-8 if the status code is not 200
+BINARY_RESPONSE_HEADER = struct.Struct('<HqQ')
+
+# Operations of the binary transport, with the HTTP route each one mirrors. The value of the
+# response is the sequence number of the payload sent or received, the flag status or the
+# number of queued payloads or the size of the variable. OP_WAIT_FOR_QUEUE_SPACE responds with
+# a QUEUE_STATUS_RECORD body
+OP_SEND_DATA = 1               # /send_data
+OP_RECEIVE_DATA = 2            # /receive_data
+OP_WAIT_AND_RECEIVE_DATA = 3   # /wait_and_receive_data, with the timeout
+OP_GET_VARIABLE_FLAG = 4       # /get_variable_flag
+OP_WAIT_FOR_VARIABLE_FLAG = 5  # /wait_for_variable_flag, with the expected flag status as argument and the timeout
+OP_WAIT_FOR_QUEUE_SPACE = 6    # /wait_for_queue_space, with the timeout
+OP_GET_VARIABLE_SIZE = 7       # /get_variable_size, whose JSON response is the body
+
+BINARY_OP_NAMES = {OP_SEND_DATA: 'send_data', OP_RECEIVE_DATA: 'receive_data',
+                   OP_WAIT_AND_RECEIVE_DATA: 'wait_and_receive_data', OP_GET_VARIABLE_FLAG: 'get_variable_flag',
+                   OP_WAIT_FOR_VARIABLE_FLAG: 'wait_for_variable_flag', OP_WAIT_FOR_QUEUE_SPACE: 'wait_for_queue_space',
+                   OP_GET_VARIABLE_SIZE: 'get_variable_size'}
+
+# Body of the OP_WAIT_FOR_QUEUE_SPACE response: little-endian int64 queued payloads, queue depth
+# and sequence number of the latest payload sent (see queue_status)
+QUEUE_STATUS_RECORD = struct.Struct('<qqq')
+
+# Port of the binary transport listener (EXCHANGE_BINARY_PORT), or None to serve HTTP only
+BINARY_PORT = int(os.environ['EXCHANGE_BINARY_PORT']) if os.environ.get('EXCHANGE_BINARY_PORT') else None
+BINARY_HOST = os.environ.get('EXCHANGE_BINARY_HOST', '0.0.0.0')
+
+# Upper bound (in bytes) on the payload of a binary transport request (EXCHANGE_MAX_BINARY_PAYLOAD),
+# checked before the payload is read; only OP_SEND_DATA requests carry one
+MAX_BINARY_PAYLOAD = int(os.environ.get('EXCHANGE_MAX_BINARY_PAYLOAD', 1 << 30))
+
+# Size of the pieces in which payloads are streamed to clients
+STREAM_CHUNK_SIZE = 1 << 20
+
+# Content coding for payloads: the bytes of every 8-byte group are regrouped by position (byte
+# shuffle), which gathers the bytes of equal significance of doubles (or of 4-byte elements) and
+# makes smooth fields much more compressible, and then deflated with zlib
+SHUFFLE_ZLIB_ENCODING = 'x-shuffle-zlib'
+COMPRESSION_LEVEL = 1
+
+# Keep payloads compressed in the session store (EXCHANGE_STORE_COMPRESSED=1) instead of raw
+STORE_COMPRESSED = os.environ.get('EXCHANGE_STORE_COMPRESSED', '0') == '1'
+
+# Upper bound (in seconds) on how long a long-polling request may be held open by the server
+MAX_WAIT_TIMEOUT = 60.0
+
+# Upper bound on the number of payloads a producer may queue ahead for one variable
+MAX_QUEUE_DEPTH = 256
+
+# Upper bound on the number of received payloads kept in the history of one variable
+MAX_HISTORY_LENGTH = 4096
+
+# Element types a variable may be declared with, and their size in bytes. Payloads hold the
+# elements of a variable in C order and little-endian byte order; variables are float64 by default
+VARIABLE_DTYPES = {'float64': 8, 'float32': 4, 'int64': 8, 'int32': 4, 'int16': 2, 'int8': 1,
+                   'uint64': 8, 'uint32': 4, 'uint16': 2, 'uint8': 1, 'bool': 1}
+DEFAULT_DTYPE = 'float64'
+
+# Units of the Range header of requests reading part of the payload of a variable, and of the
+# Content-Range header of requests sending part of it (see resolve_range): `elements` selects
+# elements first-last (inclusive) of the flattened payload, `hyperslab` a start:stop slice of
+# every dimension of the declared shape, comma-separated
+RANGE_UNITS = ('elements', 'hyperslab')
+
+# Shared memory segments of same-host sessions created by this server process, by name
+shared_segments = {}
+
+def set_variable_flag(session, var_id, flag_status):
+    """ Update the flag of a variable and wake every request waiting for it or its queue to change """
+    session['flags'][var_id] = flag_status
+    sessions.notify(session['session_id'], var_id)
+
+def queue_status(session, var_id):
+    """ Describe the payload queue of a variable; `last_seq` is the sequence number of the latest payload sent """
+    return {"var_id": var_id, "queued": len(session['queues'][var_id]),
+            "queue_depth": session['queue_depths'][var_id], "last_seq": session['last_seq'][var_id]}
+
+def check_transport(session, var_id, shared):
+    """
+    Reject a data request with 409 unless the variable is exchanged through shared memory if
+    `shared` is true, and through the server otherwise (see create_shared_segments)
+    """
+    if (var_id in session.get('shared_memory', {})) != shared:
+        transport = "is not" if shared else "is"
+        raise HTTPException(status_code=409, detail=f"Variable ID {var_id} {transport} exchanged through shared memory")
+
+def variable_layout(session, var_id):
+    """
+    Return the (dtype, shape) of the payloads of a variable; the shape of a variable without a
+    declared size is [-1], a vector of any length
+    """
+    dtype = session.get('var_dtypes', {}).get(var_id, DEFAULT_DTYPE)
+    shape = session.get('var_shapes', {}).get(var_id)
+    if shape is None:
+        shape = [session['var_sizes'].get(var_id, -1)]
+    return dtype, shape
+
+def layout_header(shape):
+    """ Format a shape for the Payload-Shape header: its dimensions, comma-separated """
+    return ",".join(map(str, shape))
+
+def check_payload_dtype(session, var_id, dtype):
+    """
+    Reject with 400 a payload whose sender declared it as `dtype` (see the Payload-Dtype header)
+    while its variable holds another element type, and return the declared dtype
+    """
+    declared_dtype, _ = variable_layout(session, var_id)
+    if dtype is not None and dtype != declared_dtype:
+        raise HTTPException(status_code=400, detail=f"Payload for variable ID {var_id} holds {dtype} elements, "
+                                                    f"but the variable was declared with {declared_dtype}")
+    return declared_dtype
+
+def check_payload_size(session, var_id, size, dtype=None):
+    """
+    Reject with 400 a payload of `size` raw bytes that does not hold the declared number of
+    elements of its variable, or that does not hold its element type (see check_payload_dtype)
+    """
+    declared_dtype = check_payload_dtype(session, var_id, dtype)
+    itemsize = VARIABLE_DTYPES[declared_dtype]
+    declared_size = session['var_sizes'].get(var_id)
+    if size % itemsize != 0:
+        raise HTTPException(status_code=400, detail=f"Payload length for variable ID {var_id} is not a multiple "
+                                                    f"of the {itemsize} bytes of {declared_dtype}")
+    if declared_size is not None and size != declared_size * itemsize:
+        raise HTTPException(status_code=400, detail=f"Payload for variable ID {var_id} holds {size // itemsize} "
+                                                    f"{declared_dtype} elements, but the variable was declared with {declared_size}")
+
+def parse_range(value, separator):
+    """
+    Split a Range header value (`separator` '=') or a Content-Range header value (`separator`
+    ' ') into its unit, its selection and the total after its slash, None if there is none;
+    400 if the unit is not one of RANGE_UNITS
+    """
+    unit, _, selection = value.strip().partition(separator)
+    selection, _, total = selection.partition('/')
+    if unit not in RANGE_UNITS or not selection.strip():
+        raise HTTPException(status_code=400, detail="Unsupported range " + value)
+    return unit, selection.strip(), total.strip() or None
+
+def resolve_range(session, var_id, unit, selection):
+    """
+    Resolve a range of a variable (see RANGE_UNITS) into the byte runs (offset, length) of the
+    selected elements in its raw payloads, in C order, the shape of the selection and the
+    Content-Range header value describing it. Responds with 400 if the range is malformed,
+    including a hyperslab with another number of dimensions than the variable and an empty or
+    reversed selection, or if the variable has no declared size, and with 416 if the range is
+    well-formed but lies outside of the variable.
+    """
+    dtype, shape = variable_layout(session, var_id)
+    size = session['var_sizes'].get(var_id)
+    if size is None:
+        raise HTTPException(status_code=400, detail=f"Variable ID {var_id} has no declared size to select a range of")
+    try:
+        if unit == 'elements':
+            first, _, last = selection.partition('-')
+            first = int(first)
+            if last and int(last) < first:
+                raise ValueError(selection)
+            last = min(int(last), size - 1) if last else size - 1
+            bounds, starts, counts = [size], [first], [last - first + 1]
+        else:
+            dims = selection.split(',')
+            if len(dims) != len(shape):
+                raise HTTPException(status_code=400, detail=f"Range {selection} has {len(dims)} dimensions, but variable "
+                                                            f"ID {var_id} has shape {layout_header(shape)}")
+            bounds, starts, counts = list(shape), [], []
+            for dim, extent in zip(dims, shape):
+                start, colon, stop = dim.partition(':')
+                start = int(start) if start.strip() else 0
+                if colon and stop.strip() and int(stop) <= start:
+                    raise ValueError(selection)
+                stop = (int(stop) if stop.strip() else extent) if colon else start + 1
+                starts.append(start)
+                counts.append(stop - start)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Malformed range " + selection)
+    if any(start < 0 or count < 1 or start + count > bound for bound, start, count in zip(bounds, starts, counts)):
+        raise HTTPException(status_code=416, detail=f"Range {selection} lies outside of variable ID {var_id} "
+                                                    f"of shape {layout_header(shape)}")
+
+    runs = slab_runs(bounds, starts, counts, VARIABLE_DTYPES[dtype])
+    if unit == 'elements':
+        return runs, counts, f"elements {first}-{last}/{size}"
+    slab = ",".join(f"{start}:{start + count}" for start, count in zip(starts, counts))
+    return runs, counts, f"hyperslab {slab}/{layout_header(shape)}"
+
+def slab_runs(shape, starts, counts, itemsize):
+    """
+    Return the byte runs (offset, length) of the hyperslab of a C-order array of `shape`
+    selected by `starts` and `counts` per dimension, in C order. The innermost dimensions
+    selected in full are merged into the runs of the dimension outside of them.
+    """
+    inner = len(shape) - 1
+    run = counts[inner]
+    while inner > 0 and counts[inner] == shape[inner]:
+        inner -= 1
+        run *= counts[inner]
+    strides = [math.prod(shape[dim + 1:]) for dim in range(len(shape))]
+    base = starts[inner] * strides[inner]
+    outer = itertools.product(*(range(start, start + count) for start, count in zip(starts[:inner], counts[:inner])))
+    return [((base + sum(index * stride for index, stride in zip(indices, strides))) * itemsize, run * itemsize)
+            for indices in outer]
+
+def slice_payload(payload, runs):
+    """ Copy the byte runs of a raw payload into one contiguous payload """
+    with memoryview(payload) as view:
+        return b"".join(view[offset:offset + length] for offset, length in runs)
+
+def create_shared_segments(var_sizes, var_dtypes, queue_depths):
+    """
+    Create a shared memory segment for every variable of a same-host session and return their
+    names by variable ID. A segment holds `queue_depth` + 1 slots of the declared size of the
+    variable in its dtype; the payload with sequence number `seq` lives in slot (seq - 1) % slots.
+    The extra slot keeps the payload the consumer is copying out from being overwritten by the
+    producer, which may only write once the queue has room.
+    """
+    names = {}
+    try:
+        for var_id, size in var_sizes.items():
+            slot_size = size * VARIABLE_DTYPES[var_dtypes[var_id]]
+            segment = shared_memory.SharedMemory(create=True, size=max(1, slot_size * (queue_depths[var_id] + 1)),
+                                                 name=f"exchange_{secrets.token_hex(8)}_{var_id}")
+            shared_segments[segment.name] = segment
+            names[var_id] = segment.name
+    except OSError as e:
+        release_shared_segments(names.values())
+        raise HTTPException(status_code=507, detail="Cannot allocate shared memory: " + str(e))
+    return names
+
+def release_shared_segments(names):
+    """ Unlink the shared memory segments with the given names; segments created by another worker are attached first """
+    for name in names:
+        segment = shared_segments.pop(name, None)
+        try:
+            if segment is None:
+                segment = shared_memory.SharedMemory(name)
+            segment.close()
+            segment.unlink()
+        except FileNotFoundError:
+            logger.debug("Shared memory segment %s was already unlinked", name)
+
+def enqueue_payload(session, var_id, payload, encoding):
+    """ Append a payload to the queue of a variable under the next sequence number and return that number """
+    seq = session['last_seq'][var_id] + 1
+    session['last_seq'][var_id] = seq
+    session['data'][(var_id, seq)] = payload
+    session['queues'][var_id].append((seq, encoding))
+    set_variable_flag(session, var_id, 1)  # Data is present
+    return seq
+
+def dequeue_payload(session, var_id):
+    """
+    Take the oldest queued payload of a variable and return it as (seq, payload, encoding).
+    The payload moves to the history of the variable, where it is the one /receive_data serves
+    again while the queue is empty. The flag stays 1 as long as further payloads are queued.
+    """
+    seq, encoding = session['queues'][var_id].pop(0)
+    payload = session['data'][(var_id, seq)]
+    record_history(session, var_id, seq, encoding, len(payload))
+    set_variable_flag(session, var_id, 1 if session['queues'][var_id] else 0)
+    return seq, payload, encoding
+
+def record_history(session, var_id, seq, encoding, size):
+    """
+    Append a received payload to the history of a variable, then evict the oldest payloads
+    while the history holds more than `history_length` of them or more than `history_bytes`
+    bytes. The most recently received payload is always kept.
+    """
+    history = session['history'][var_id]
+    history.append((seq, encoding, size))
+    total_size = sum(size for _, _, size in history)
+    while len(history) > 1 and (len(history) > session['history_length'] or total_size > session['history_bytes']):
+        evicted_seq, _, evicted_size = history.pop(0)
+        session['data'].pop((var_id, evicted_seq), None)
+        total_size -= evicted_size
+
+def stored_encodings(session, var_id):
+    """ Map the sequence number of every queued or historical payload of a variable to its encoding """
+    return {seq: encoding for seq, encoding, *_ in session['queues'][var_id] + session['history'][var_id]}
+
+def store_part(session, var_id, payload, unit, selection):
+    """
+    Keep a part of the next payload of a variable, the raw elements of a range (see
+    resolve_range), under the negative sequence number -(index + 1) of the part. Responds with
+    400 if its size does not match the range or the range overlaps one of the parts kept so far.
+    Return the number of bytes of the payload the parts cover.
+    """
+    runs, _, _ = resolve_range(session, var_id, unit, selection)
+    if len(payload) != sum(length for _, length in runs):
+        raise HTTPException(status_code=400, detail=f"Part for variable ID {var_id} holds {len(payload)} bytes, "
+                                                    f"but its range {selection} selects {sum(length for _, length in runs)}")
+    parts = session.setdefault('parts', {}).setdefault(var_id, [])
+    written = sorted(run for part in parts for run in resolve_range(session, var_id, *part)[0])
+    starts = [offset for offset, _ in written]
+    for offset, length in runs:
+        index = bisect.bisect_right(starts, offset)
+        if (index > 0 and sum(written[index - 1]) > offset) or (index < len(written) and written[index][0] < offset + length):
+            raise HTTPException(status_code=400, detail=f"Range {selection} overlaps a part already sent for variable ID {var_id}")
+    session['data'][(var_id, -(len(parts) + 1))] = payload
+    parts.append((unit, selection))
+    return sum(length for _, length in written) + len(payload)
+
+def assemble_parts(session, var_id, size):
+    """ Copy the parts kept for a variable (see store_part) into a payload of `size` bytes, drop them and return the payload """
+    payload = bytearray(size)
+    with memoryview(payload) as view:
+        for index, part in enumerate(session['parts'][var_id]):
+            position = 0
+            with memoryview(session['data'][(var_id, -(index + 1))]) as part_view:
+                for offset, length in resolve_range(session, var_id, *part)[0]:
+                    view[offset:offset + length] = part_view[position:position + length]
+                    position += length
+    drop_parts(session, var_id)
+    return payload
+
+def drop_parts(session, var_id):
+    """ Drop the parts kept for the next payload of a variable (see store_part) """
+    for index in range(len(session.get('parts', {}).get(var_id, []))):
+        session['data'].pop((var_id, -(index + 1)), None)
+    session.get('parts', {}).pop(var_id, None)
+
+def clear_variable(session, var_id):
+    """ Drop every queued and previously received payload of a variable, and the parts of the next one """
+    for slot_seq, *_ in session['queues'][var_id] + session['history'][var_id]:
+        session['data'].pop((var_id, slot_seq), None)
+    drop_parts(session, var_id)
+    session['queues'][var_id] = []
+    session['history'][var_id] = []
+    set_variable_flag(session, var_id, 0)
+
+def wait_deadline(timeout):
+    """ Convert a client supplied timeout into an event loop deadline, capped at MAX_WAIT_TIMEOUT """
+    return asyncio.get_running_loop().time() + min(max(timeout, 0.0), MAX_WAIT_TIMEOUT)
+
+async def wait_for_flag_change(event, deadline, route, session_id, var_id):
+    """ Wait for a flag event until `deadline`; return False if the deadline passed first """
+    remaining = deadline - asyncio.get_running_loop().time()
+    if remaining <= 0:
+        return False
+    start = time.perf_counter()
+    try:
+        await asyncio.wait_for(event.wait(), timeout=remaining)
+        return True
+    except asyncio.TimeoutError:
+        return False
+    finally:
+        waited = time.perf_counter() - start
+        metrics.observe('exchange_flag_wait_seconds', waited, route=route)
+        metrics.inc('exchange_flag_wait_seconds_total', waited, session_id=session_id, var_id=str(var_id))
+
+def count_bytes(direction, session_id, var_id, size):
+    """ Count payload bytes 'received' from or 'sent' to clients for a variable """
+    metrics.inc(f'exchange_{direction}_bytes_total', size, session_id=session_id, var_id=str(var_id))
+
+async def read_payload(request):
+    """
+    Stream a request body into a buffer preallocated from its Content-Length header, so that
+    apart from the buffer itself only one chunk of the upload is held in memory at a time.
+    Bodies sent without a Content-Length are accumulated as they arrive.
+    """
+    content_length = request.headers.get('content-length')
+    if content_length is None:
+        buffer = bytearray()
+        async for chunk in request.stream():
+            buffer += chunk
+        return buffer
+
+    buffer = bytearray(int(content_length))
+    offset = 0
+    with memoryview(buffer) as view:
+        async for chunk in request.stream():
+            if offset + len(chunk) > len(buffer):
+                raise HTTPException(status_code=400, detail="Request body is longer than its Content-Length")
+            view[offset:offset + len(chunk)] = chunk
+            offset += len(chunk)
+    if offset != len(buffer):
+        raise HTTPException(status_code=400, detail="Request body is shorter than its Content-Length")
+    return buffer
+
+async def payload_chunks(payload):
+    """
+    Yield a payload in STREAM_CHUNK_SIZE pieces: views of payloads held in memory, which are
+    never modified once stored, and copies of memory-mapped ones, taken one piece at a time
+    """
+    with memoryview(payload) as view:
+        for offset in range(0, len(view), STREAM_CHUNK_SIZE):
+            if isinstance(payload, mmap.mmap):
+                yield bytes(view[offset:offset + STREAM_CHUNK_SIZE])
+            else:
+                yield view[offset:offset + STREAM_CHUNK_SIZE]
+
+async def payload_response(payload, encoding, accept_encoding, seq, layout, part=None):
+    """
+    Stream a stored payload back to the client, compressed if both the store and the client
+    allow it, with its sequence number in the Sequence-Number header and the dtype and shape of
+    its variable (see variable_layout) in the Payload-Dtype and Payload-Shape headers. With the
+    `part` of a range (see resolve_range), only the selected elements are sent, uncompressed,
+    with status 206, the shape of the selection and a Content-Range header.
+    """
+    dtype, shape = layout
+    headers = {'Sequence-Number': str(seq), 'Payload-Dtype': dtype, 'Payload-Shape': layout_header(shape)}
+    if part is not None:
+        runs, shape, headers['Content-Range'] = part
+        payload = slice_payload(await raw_payload(payload, encoding), runs)
+        headers['Payload-Shape'] = layout_header(shape)
+    elif encoding != 'identity' and accepts_encoding(accept_encoding, encoding):
+        headers['Content-Encoding'] = encoding
+    else:
+        payload = await raw_payload(payload, encoding)
+    headers['Content-Length'] = str(len(payload))
+    return StreamingResponse(payload_chunks(payload), status_code=200 if part is None else 206,
+                             media_type='application/octet-stream', headers=headers)
+
+def encode_payload(payload):
+    """ Byte-shuffle and compress a raw payload; a last group shorter than 8 bytes is shuffled as is """
+    view = memoryview(payload)
+    shuffled = b"".join(view[byte::8].tobytes() for byte in range(8))
+    return zlib.compress(shuffled, COMPRESSION_LEVEL)
+
+def decode_payload(payload):
+    """ Decompress and un-shuffle a payload produced by encode_payload """
+    shuffled = memoryview(zlib.decompress(payload))
+    n, tail = divmod(len(shuffled), 8)
+    raw = bytearray(len(shuffled))
+    offset = 0
+    for byte in range(8):
+        length = n + (byte < tail)
+        raw[byte::8] = shuffled[offset:offset + length]
+        offset += length
+    return raw
+
+def decoded_size(payload):
+    """ Size in bytes of the raw form of a payload produced by encode_payload, decompressed one piece at a time """
+    decompressor = zlib.decompressobj()
+    size = len(decompressor.decompress(payload, STREAM_CHUNK_SIZE))
+    while decompressor.unconsumed_tail:
+        size += len(decompressor.decompress(decompressor.unconsumed_tail, STREAM_CHUNK_SIZE))
+    return size + len(decompressor.flush())
+
+async def storage_form(payload, content_encoding):
+    """
+    Convert an uploaded payload sent with `content_encoding` into the form kept in the session
+    store (see STORE_COMPRESSED), and return it with its encoding and the size of its raw form
+    in bytes. Compression work runs in a worker thread so that it does not stall the event loop.
+    """
+    content_encoding = content_encoding or 'identity'
+    if content_encoding not in ('identity', SHUFFLE_ZLIB_ENCODING):
+        raise HTTPException(status_code=415, detail="Unsupported Content-Encoding " + content_encoding)
+
+    if content_encoding == SHUFFLE_ZLIB_ENCODING and not STORE_COMPRESSED:
+        payload = await asyncio.to_thread(decode_payload, payload)
+        content_encoding = 'identity'
+    if content_encoding == 'identity':
+        raw_size = len(payload)
+        if STORE_COMPRESSED:
+            payload = await asyncio.to_thread(encode_payload, payload)
+            content_encoding = SHUFFLE_ZLIB_ENCODING
+    else:
+        # Payloads kept as uploaded are only decompressed to check their size
+        raw_size = await asyncio.to_thread(decoded_size, payload)
+    return payload, content_encoding, raw_size
+
+def accepts_encoding(accept_encoding, encoding):
+    """ Whether an Accept-Encoding header value lists `encoding` """
+    if not accept_encoding:
+        return False
+    return encoding in (token.split(';')[0].strip() for token in accept_encoding.split(','))
+
+async def raw_payload(payload, encoding):
+    """ Return a stored payload in raw form """
+    if encoding == 'identity':
+        return payload
+    return await asyncio.to_thread(decode_payload, payload)
+
+def parse_batch(binary_data):
+    """ Split a framed batch body into a list of (var_id, payload) records, without copying the payloads """
+    records = []
+    view = memoryview(binary_data)
+    offset = 0
+    while offset < len(view):
+        if offset + BATCH_RECORD_HEADER.size > len(view):
+            raise HTTPException(status_code=400, detail="Truncated batch record header")
+        var_id, length = BATCH_RECORD_HEADER.unpack_from(view, offset)
+        offset += BATCH_RECORD_HEADER.size
+        if offset + length > len(view):
+            raise HTTPException(status_code=400, detail="Invalid payload length for variable ID " + str(var_id))
+        records.append((var_id, view[offset:offset + length]))
+        offset += length
+    return records
+
+async def batch_chunks(records, record_header=BATCH_RECORD_HEADER):
+    """ Yield a framed body built from a list of (key, payload) records, the key being the first field of `record_header` """
+    for key, payload in records:
+        yield record_header.pack(key, len(payload))
+        async for chunk in payload_chunks(payload):
+            yield chunk
+
+def batch_response(records, seqs, layouts):
+    """
+    Stream a framed batch body back to the client, with the sequence numbers of its records in
+    the Sequence-Numbers header and their dtypes and shapes in the Payload-Dtypes and
+    Payload-Shapes headers, the shapes separated by semicolons
+    """
+    content_length = sum(BATCH_RECORD_HEADER.size + len(payload) for _, payload in records)
+    headers = {'Content-Length': str(content_length), 'Sequence-Numbers': ",".join(map(str, seqs)),
+               'Payload-Dtypes': ",".join(dtype for dtype, _ in layouts),
+               'Payload-Shapes': ";".join(layout_header(shape) for _, shape in layouts)}
+    return StreamingResponse(batch_chunks(records), media_type='application/octet-stream', headers=headers)
+
+def history_response(records, layout):
+    """
+    Stream a framed history body, built from a list of (seq, payload) records, back to the
+    client, with the dtype and shape of the variable, or of the range read, as in payload_response
+    """
+    dtype, shape = layout
+    content_length = sum(HISTORY_RECORD_HEADER.size + len(payload) for _, payload in records)
+    headers = {'Content-Length': str(content_length), 'Payload-Dtype': dtype, 'Payload-Shape': layout_header(shape)}
+    return StreamingResponse(batch_chunks(records, HISTORY_RECORD_HEADER), media_type='application/octet-stream',
+                             headers=headers)
+
+async def serve_binary_connection(reader, writer):
+    """
+    Serve the requests of one binary transport connection in order, until the client closes it.
+
+    The binary transport shares the sessions of the HTTP API, which is still used to create, join
+    and end them, but exchanges data, flags and queue status over a persistent TCP connection
+    with fixed-size frame headers (see BINARY_REQUEST_HEADER), avoiding the per-request parsing
+    of HTTP headers and query strings. Payloads are always sent and received raw. Payloads larger
+    than MAX_BINARY_PAYLOAD are refused with 413 before they are read, after which the connection
+    is closed.
+    """
+    try:
+        while True:
+            try:
+                header = await reader.readexactly(BINARY_REQUEST_HEADER.size)
+            except asyncio.IncompleteReadError as e:
+                if e.partial:
+                    logger.warning("Binary transport connection closed in the middle of a request header")
+                break
+            op, id_length, var_id, argument, timeout, payload_length = BINARY_REQUEST_HEADER.unpack(header)
+            session_id = await reader.readexactly(id_length)
+
+            route = 'binary:' + BINARY_OP_NAMES.get(op, 'other')
+            status_code, value, body = 200, 0, b""
+            payload = None
+            start = time.perf_counter()
+            try:
+                try:
+                    session_id = session_id.decode()
+                except UnicodeDecodeError:
+                    raise HTTPException(status_code=400, detail="Session ID is not valid UTF-8")
+                limit = MAX_BINARY_PAYLOAD if op == OP_SEND_DATA else 0
+                if payload_length > limit:
+                    raise HTTPException(status_code=413, detail=f"Payload of {payload_length} bytes exceeds "
+                                                                f"the limit of {limit} bytes")
+                payload = await reader.readexactly(payload_length) if payload_length else b""
+                value, body = await binary_operation(op, session_id, var_id, argument, timeout, payload)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                raise
+            except HTTPException as e:
+                status_code, body = e.status_code, str(e.detail).encode()
+            except Exception:
+                logger.exception("Binary transport %s request failed", route)
+                status_code, body = 500, b"Internal Server Error"
+            finally:
+                metrics.inc('exchange_requests_total', route=route, method='BINARY', status=str(status_code))
+
+            writer.write(BINARY_RESPONSE_HEADER.pack(status_code, value, len(body)))
+            if isinstance(body, (bytes, bytearray)):
+                writer.write(body)
+            else:
+                # Payloads served from a memory mapping are copied out one piece at a time
+                async for chunk in payload_chunks(body):
+                    writer.write(chunk)
+                    await writer.drain()
+            await writer.drain()
+            metrics.observe('exchange_request_duration_seconds', time.perf_counter() - start, route=route)
+            if payload is None and payload_length:
+                # The payload of a refused request was not read, so the next frame cannot be found
+                break
+    except (ConnectionError, asyncio.IncompleteReadError):
+        logger.warning("Binary transport connection lost")
+    finally:
+        writer.close()
+
+async def binary_operation(op, session_id, var_id, argument, timeout, payload):
+    """ Run one binary transport request and return the (value, body) of its response """
+    if op == OP_SEND_DATA:
+        return await store_payload(session_id, var_id, payload, 'identity'), b""
+    if op in (OP_RECEIVE_DATA, OP_WAIT_AND_RECEIVE_DATA):
+        if op == OP_RECEIVE_DATA:
+            seq, binary_data, encoding, _, _ = await take_payload(session_id, var_id)
+        else:
+            seq, binary_data, encoding, _, _ = await wait_and_take_payload(session_id, var_id, timeout, "binary:wait_and_receive_data")
+        binary_data = await raw_payload(binary_data, encoding)
+        count_bytes('sent', session_id, var_id, len(binary_data))
+        return seq, binary_data
+    if op == OP_GET_VARIABLE_FLAG:
+        return (await get_variable_flag(session_id, var_id))['flag_status'], b""
+    if op == OP_WAIT_FOR_VARIABLE_FLAG:
+        return (await wait_for_variable_flag(session_id, var_id, argument, timeout))['flag_status'], b""
+    if op == OP_WAIT_FOR_QUEUE_SPACE:
+        status = await wait_for_queue_space(session_id, var_id, timeout)
+        return status['queued'], QUEUE_STATUS_RECORD.pack(status['queued'], status['queue_depth'], status['last_seq'])
+    if op == OP_GET_VARIABLE_SIZE:
+        info = await get_variable_size(session_id, var_id)
+        return info['size'], json.dumps(info).encode()
+    raise HTTPException(status_code=400, detail="Unknown binary transport operation " + str(op))
 
 @app.on_event("startup")
 async def startup_event():
-    """ Start background tasks at server startup """
-    app.state.print_sessions_task = asyncio.create_task(print_sessions_every_n_seconds(n=10))
+    """ Recover journaled sessions and start background tasks at server startup """
+    if isinstance(sessions, InProcessSessionStore) and sessions.journal is not None:
+        start = time.perf_counter()
+        recovered = sessions.recover()
+        logger.info("Recovered %d sessions from the journal in %.3f s", recovered, time.perf_counter() - start)
+    app.state.background_tasks = []
+    if isinstance(sessions, InProcessSessionStore) and sessions.spill_dir is not None and sessions.idle_timeout is not None:
+        app.state.background_tasks.append(asyncio.create_task(spill_idle_sessions(interval=sessions.idle_timeout / 2)))
+    app.state.binary_server = None
+    if BINARY_PORT is not None:
+        # Every worker process listens on the same port, among which the kernel spreads the connections
+        app.state.binary_server = await asyncio.start_server(serve_binary_connection, BINARY_HOST, BINARY_PORT,
+                                                             limit=STREAM_CHUNK_SIZE, reuse_port=True)
+        logger.info("Binary transport listening on %s:%d", BINARY_HOST, BINARY_PORT)
 
 @app.on_event("shutdown")
 async def shutdown_event():
-    """ Cancel the periodic print task on server shutdown """
-    app.state.print_sessions_task.cancel()
-    try:
-        await app.state.print_sessions_task
-    except asyncio.CancelledError:
-        print("Background task was cancelled")
+    """ Cancel the background tasks and close the binary transport listener on server shutdown """
+    if app.state.binary_server is not None:
+        app.state.binary_server.close()
+    for task in app.state.background_tasks:
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            logger.debug("Background task was cancelled")
+    if isinstance(sessions, InProcessSessionStore) and sessions.spill_task is not None:
+        sessions.spill_task.cancel()
+    if isinstance(sessions, InProcessSessionStore) and sessions.journal is not None:
+        sessions.journal.close()
+    # Shared memory segments do not outlive the server process that created them
+    release_shared_segments(list(shared_segments))
 
-async def print_sessions_every_n_seconds(n=10):
-    """ Periodically print the current sessions and their flags every `n` seconds """
+async def spill_idle_sessions(interval):
+    """ Periodically spill the payloads of idle sessions to disk, even if no request comes in """
     while True:
-        with session_lock:
-            print("Current Sessions and Flags:")
-            for session_id, session_info in sessions.items():
-                flags = session_info['flags']
-                print(f"Session ID: {session_id}, Flags: {flags}")
-        await asyncio.sleep(n)
+        await asyncio.sleep(interval)
+        await sessions.start_spill()
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    """
+    Expose the metrics of this server process (see METRICS) in the Prometheus text format,
+    including the current sessions and the flags and queue lengths of their variables.
+    """
+    gauges = []
+    statuses = Counter()
+    for session_id, session in sessions.items():
+        statuses[session['status']] += 1
+        for var_id, flag in session['flags'].items():
+            gauges.append(('exchange_variable_flag', {'session_id': session_id, 'var_id': str(var_id)}, flag))
+            gauges.append(('exchange_queued_payloads', {'session_id': session_id, 'var_id': str(var_id)},
+                           len(session['queues'][var_id])))
+    gauges.extend(('exchange_sessions', {'status': status}, count) for status, count in statuses.items())
+    return PlainTextResponse(metrics.render(gauges), media_type='text/plain; version=0.0.4')
 
 @app.post("/create_session")
 async def create_session(session_data: SessionData):
-    """ Create a new session with given parameters and store it in a global dictionary """
-    with session_lock:
-        base_session_id = f"{session_data.source_model_ID},{session_data.destination_model_ID},{session_data.initiator_id},{session_data.invitee_id}"
-        session_id = base_session_id + ",1"
-        i = 1
-        while session_id in sessions:
-            i += 1
-            session_id = f"{base_session_id},{i}"
+    """ Create a new session with given parameters and store it in the session registry """
+    base_session_id = f"{session_data.source_model_ID},{session_data.destination_model_ID},{session_data.initiator_id},{session_data.invitee_id}"
 
-        # Map variable IDs to their respective sizes
-        var_sizes = {**dict(zip(session_data.input_variables_ID, session_data.input_variables_size)),
-                     **dict(zip(session_data.output_variables_ID, session_data.output_variables_size))}
-        
-        # Initialize session data
-        sessions[session_id] = {
-            'status': 'created',
-            'data': {var: None for var in set(session_data.input_variables_ID) | set(session_data.output_variables_ID)},
-            'flags': {var: 0 for var in set(session_data.input_variables_ID) | set(session_data.output_variables_ID)},
-            'client_vars': {session_data.initiator_id: list(session_data.input_variables_ID)},
-            'end_requests': set(),
-            'var_sizes': var_sizes
-        }
-        
-        return {"status": "created", "session_id": session_id}
+    # Map variable IDs to their respective sizes
+    var_sizes = {**dict(zip(session_data.input_variables_ID, session_data.input_variables_size)),
+                 **dict(zip(session_data.output_variables_ID, session_data.output_variables_size))}
+
+    # Map variable IDs to the number of payloads a producer may queue ahead (1 unless given)
+    all_vars = set(session_data.input_variables_ID) | set(session_data.output_variables_ID)
+    queue_depths = {**dict(zip(session_data.input_variables_ID, session_data.input_variables_queue_depth)),
+                    **dict(zip(session_data.output_variables_ID, session_data.output_variables_queue_depth))}
+    for var, depth in queue_depths.items():
+        if not 1 <= depth <= MAX_QUEUE_DEPTH:
+            raise HTTPException(status_code=400, detail=f"Queue depth of variable ID {var} must be between 1 and {MAX_QUEUE_DEPTH}")
+    if not 1 <= session_data.history_length <= MAX_HISTORY_LENGTH or session_data.history_bytes < 0:
+        raise HTTPException(status_code=400, detail=f"History length must be between 1 and {MAX_HISTORY_LENGTH} and history bytes not negative")
+
+    # Map variable IDs to the element type (float64 unless given) and shape (a vector of the
+    # declared size unless given) of their payloads. A variable declared with a shape alone
+    # gets the number of its elements as size
+    var_dtypes = {**dict(zip(session_data.input_variables_ID, session_data.input_variables_dtype)),
+                  **dict(zip(session_data.output_variables_ID, session_data.output_variables_dtype))}
+    var_shapes = {**dict(zip(session_data.input_variables_ID, session_data.input_variables_shape)),
+                  **dict(zip(session_data.output_variables_ID, session_data.output_variables_shape))}
+    for var, dtype in var_dtypes.items():
+        if dtype not in VARIABLE_DTYPES:
+            raise HTTPException(status_code=400, detail=f"Unsupported dtype {dtype} of variable ID {var}, "
+                                                        f"expected one of {', '.join(VARIABLE_DTYPES)}")
+    for var, shape in var_shapes.items():
+        if any(dim < 0 for dim in shape) or var_sizes.setdefault(var, math.prod(shape)) != math.prod(shape):
+            raise HTTPException(status_code=400, detail=f"Shape {shape} of variable ID {var} does not match its size {var_sizes[var]}")
+    if session_data.shared_memory and set(var_sizes) != all_vars:
+        raise HTTPException(status_code=400, detail="Shared memory sessions need the size of every variable")
+
+    # Initialize session data. The payloads of each variable form a bounded queue: 'data' maps
+    # (var_id, seq) to a payload, 'queues' lists the (seq, encoding) of the payloads not received
+    # yet, oldest first, and 'flags' is 1 while that queue is not empty. Received payloads move
+    # to 'history', a list of (seq, encoding, size) bounded by 'history_length' and 'history_bytes'.
+    # Variables of same-host sessions are exchanged through the shared memory segments named in
+    # 'shared_memory', and only their (empty) queue entries are kept here. 'parts' lists the
+    # ranges of the parts sent so far of the next payload of a variable (see store_part)
+    session = {
+        'status': 'created',
+        'data': {},
+        'flags': {var: 0 for var in all_vars},
+        'queues': {var: [] for var in all_vars},
+        'queue_depths': {var: queue_depths.get(var, 1) for var in all_vars},
+        'last_seq': {var: 0 for var in all_vars},
+        'history': {var: [] for var in all_vars},
+        'history_length': session_data.history_length,
+        'history_bytes': session_data.history_bytes,
+        'client_vars': {session_data.initiator_id: list(session_data.input_variables_ID)},
+        'end_requests': set(),
+        'var_sizes': var_sizes,
+        'var_dtypes': {var: var_dtypes.get(var, DEFAULT_DTYPE) for var in all_vars},
+        'var_shapes': {var: var_shapes.get(var, [size]) for var, size in var_sizes.items()},
+        'shared_memory': {},
+        'parts': {}
+    }
+    if session_data.shared_memory:
+        session['shared_memory'] = create_shared_segments(var_sizes, session['var_dtypes'], session['queue_depths'])
+    session_id = sessions.create(base_session_id, session)
+    logger.info("Created session %s", session_id)
+
+    return {"status": "created", "session_id": session_id}
     
 @app.get("/get_session_status")
 async def get_session_status(session_id: str):
@@ -91,11 +1631,7 @@ async def get_session_status(session_id: str):
     Returns:
         The status of the session as an integer.
     """
-    with session_lock:  # Assuming session_lock is a threading lock for thread-safe operations
-        # Check if the session exists
-        if session_id not in sessions:
-            raise HTTPException(status_code=404, detail="Session not found")
-
+    async with sessions.lock(session_id, readonly=True) as session:  # Raises a 404 if the session does not exist
         # Map statuses to integers
         status_mapping = {
             "created": 1, # Session is created, when one client has created the session
@@ -104,119 +1640,440 @@ async def get_session_status(session_id: str):
         }
 
         # Return the status of the session
-        session_status = sessions[session_id]['status']
+        session_status = session['status']
         return status_mapping.get(session_status, 0)  # Return 0 if status is unknown
 
 @app.post("/join_session")
 async def join_session(data: JoinSessionData):
     """ Allow a new client to join an existing session """
-    with session_lock:
-        session_id = data.session_id
-        joining_invitee_id = data.invitee_id
+    session_id = data.session_id
+    joining_invitee_id = data.invitee_id
 
-        if session_id not in sessions:
-            raise HTTPException(status_code=404, detail="Session not found")
-
-        if sessions[session_id].get('status') == 'active':
+    async with sessions.lock(session_id) as session:
+        if session.get('status') == 'active':
             raise HTTPException(status_code=400, detail="Session is already active")
 
         # Assign variables not used by the initiator to the joining client
-        session = sessions[session_id]
         initiator_input_vars = session['client_vars'].get(list(session['client_vars'].keys())[0], [])
-        all_vars = set(session['data'].keys())
+        all_vars = set(session['flags'].keys())
         joining_client_input_vars = list(all_vars - set(initiator_input_vars))
 
         session['status'] = 'active'
         session['client_vars'][joining_invitee_id] = joining_client_input_vars
+        logger.info("Session %s joined by %s", session_id, joining_invitee_id)
 
         return {"status": "joined and activated", "session_id": session_id}
 
 @app.post("/send_data")
-async def send_data(request: Request, session_id: Optional[str] = Header(None), var_id: Optional[int] = Header(None)):
+async def send_data(request: Request, session_id: Optional[str] = Header(None), var_id: Optional[int] = Header(None),
+                    content_encoding: Optional[str] = Header(None), payload_dtype: Optional[str] = Header(None),
+                    content_range: Optional[str] = Header(None)):
     """
-    Receive binary data for a specific variable in a session.
+    Receive binary data for a specific variable in a session and queue it under the next
+    sequence number, which is returned as `seq`.
+
+    The body holds the elements of the variable in its dtype, little-endian (see VARIABLE_DTYPES),
+    and may be sent with `Content-Encoding: x-shuffle-zlib` (see encode_payload). Responds with
+    400 if the payload does not hold the declared number of elements of the variable, or if its
+    Payload-Dtype header names another dtype than the declared one, and with 409 if the queue of
+    the variable already holds `queue_depth` payloads not received yet.
+
+    With a Content-Range header (`elements first-last/size` or `hyperslab start:stop,.../shape`,
+    see RANGE_UNITS, the total may be `*`), the body holds only the elements of that range, so
+    that each rank of a domain-decomposed producer can send its own part. The payload is queued
+    once its parts cover every element of the variable, and `seq` is null until then. Parts may
+    not overlap; a part overlapping an earlier one is rejected with 400.
     """
     if session_id is None or var_id is None:
         raise HTTPException(status_code=400, detail="Session-ID or Var-ID header missing")
 
-    binary_data = await request.body()
-    # `binary_data` is a bytes object that contains packed binary data, 
-    # and `data` is a list or tuple of floating-point numbers to be packed into binary format.
-
-    # Unpacking binary data into a list of doubles (double-precision floating points):
-    # 1. '<' indicates little-endian byte order.
-    # 2. 'd' represents a double in C (8 bytes).
-    # 3. 'len(binary_data) // 8' calculates how many doubles are packed in `binary_data`.
-    array_data = list(struct.unpack('<' + 'd' * (len(binary_data) // 8), binary_data))
-
-    with session_lock:
-        if session_id in sessions and var_id in sessions[session_id]['data']:
-            sessions[session_id]['data'][var_id] = array_data
-            sessions[session_id]['flags'][var_id] = 1  # Data is present
-            return {"status": "Binary data received for " + str(var_id)}
+    # The payload is streamed into its own buffer outside of the session lock and stored as is, so
+    # storing it and serving it back later needs no per-element conversion. Stored payloads are
+    # never modified afterwards, a new send replaces them. Buffers are not reused across sends:
+    # queue and history slots, streaming responses, the journal writer and spills may all still
+    # read a payload after it was dropped, and none of them reports when it is done.
+    binary_data = await read_payload(request)
+    if content_range is not None:
+        seq = await store_payload_part(session_id, var_id, binary_data, content_encoding, content_range, payload_dtype)
+        return {"status": "Part of binary data received for " + str(var_id), "seq": seq}
+    seq = await store_payload(session_id, var_id, binary_data, content_encoding, payload_dtype)
+    return {"status": "Binary data received for " + str(var_id), "seq": seq}
+
+async def store_payload(session_id, var_id, binary_data, content_encoding, dtype=None):
+    """ Queue an uploaded payload for a variable in its storage form and return its sequence number (see /send_data) """
+    received_size = len(binary_data)
+    binary_data, encoding, raw_size = await storage_form(binary_data, content_encoding)
+
+    async with sessions.lock(session_id, detail="Session or variable not found") as session:
+        if var_id in session['queues']:
+            check_transport(session, var_id, False)
+            check_payload_size(session, var_id, raw_size, dtype)
+            if len(session['queues'][var_id]) >= session['queue_depths'][var_id]:
+                logger.debug("Queue of variable %s of session %s is full", var_id, session_id)
+                raise HTTPException(status_code=409, detail="Queue for variable ID " + str(var_id) + " is full")
+            seq = enqueue_payload(session, var_id, binary_data, encoding)
+            count_bytes('received', session_id, var_id, received_size)
+            return seq
         else:
             raise HTTPException(status_code=404, detail="Session or variable not found")
 
+async def store_payload_part(session_id, var_id, binary_data, content_encoding, content_range, dtype=None):
+    """
+    Keep an uploaded part of the next payload of a variable (see /send_data) and queue the
+    payload once its parts are complete. Return its sequence number then, None before. Payloads
+    assembled from parts are stored raw.
+    """
+    unit, selection, total = parse_range(content_range, ' ')
+    received_size = len(binary_data)
+    content_encoding = content_encoding or 'identity'
+    if content_encoding == SHUFFLE_ZLIB_ENCODING:
+        binary_data = await asyncio.to_thread(decode_payload, binary_data)
+    elif content_encoding != 'identity':
+        raise HTTPException(status_code=415, detail="Unsupported Content-Encoding " + content_encoding)
+
+    async with sessions.lock(session_id, detail="Session or variable not found") as session:
+        if var_id not in session['queues']:
+            raise HTTPException(status_code=404, detail="Session or variable not found")
+        check_transport(session, var_id, False)
+        dtype = check_payload_dtype(session, var_id, dtype)
+        _, _, expected_range = resolve_range(session, var_id, unit, selection)
+        if total not in (None, '*', expected_range.rpartition('/')[2]):
+            raise HTTPException(status_code=416, detail=f"Range {content_range} does not match variable ID {var_id}, "
+                                                        f"{expected_range}")
+        if len(session['queues'][var_id]) >= session['queue_depths'][var_id]:
+            logger.debug("Queue of variable %s of session %s is full", var_id, session_id)
+            raise HTTPException(status_code=409, detail="Queue for variable ID " + str(var_id) + " is full")
+        size = session['var_sizes'][var_id] * VARIABLE_DTYPES[dtype]
+        covered = store_part(session, var_id, binary_data, unit, selection)
+        count_bytes('received', session_id, var_id, received_size)
+        if covered < size:
+            return None
+        return enqueue_payload(session, var_id, assemble_parts(session, var_id, size), 'identity')
 
 @app.get("/get_variable_flag")
 async def get_variable_flag(session_id: str, var_id: int):
     """
     Get the flag status for a specific variable in the session.
     """
-    with session_lock:
-        if session_id in sessions and var_id in sessions[session_id]['flags']:
-            flag_status = sessions[session_id]['flags'][var_id]
+    async with sessions.lock(session_id, detail="Session or variable not found", readonly=True) as session:
+        if var_id in session['flags']:
+            flag_status = session['flags'][var_id]
             return {"var_id": var_id, "flag_status": flag_status}
         else:
             raise HTTPException(status_code=404, detail="Session or variable not found")
         
+@app.get("/wait_for_variable_flag")
+async def wait_for_variable_flag(session_id: str, var_id: int, flag_status: int = 1, timeout: float = 30.0):
+    """
+    Wait until the flag of a specific variable in the session equals `flag_status`.
+
+    The request is held open until the flag changes to the expected value or `timeout` seconds
+    (capped at MAX_WAIT_TIMEOUT) have passed, and then returns the current flag status. This
+    replaces client-side polling of /get_variable_flag.
+    """
+    deadline = wait_deadline(timeout)
+    while True:
+        async with sessions.lock(session_id, detail="Session or variable not found", readonly=True) as session:
+            if var_id not in session['flags']:
+                raise HTTPException(status_code=404, detail="Session or variable not found")
+            current_status = session['flags'][var_id]
+            event = sessions.flag_event(session_id, var_id)
+
+        # Wait outside the lock until the flag is changed or the deadline expires
+        if current_status == flag_status or not await wait_for_flag_change(event, deadline, "/wait_for_variable_flag", session_id, var_id):
+            return {"var_id": var_id, "flag_status": current_status}
+
+@app.get("/wait_for_queue_space")
+async def wait_for_queue_space(session_id: str, var_id: int, timeout: float = 30.0):
+    """
+    Wait until the queue of a specific variable in the session has room for another payload.
+
+    The request is held open until a payload is received from the queue or `timeout` seconds
+    (capped at MAX_WAIT_TIMEOUT) have passed, and then returns the queue status (see
+    queue_status). Producers use it to run up to `queue_depth` payloads ahead of the consumer.
+    """
+    deadline = wait_deadline(timeout)
+    while True:
+        async with sessions.lock(session_id, detail="Session or variable not found", readonly=True) as session:
+            if var_id not in session['queues']:
+                raise HTTPException(status_code=404, detail="Session or variable not found")
+            status = queue_status(session, var_id)
+            event = sessions.flag_event(session_id, var_id)
+
+        if status['queued'] < status['queue_depth'] or not await wait_for_flag_change(event, deadline, "/wait_for_queue_space", session_id, var_id):
+            return status
+
 @app.get("/get_variable_size")
 async def get_variable_size(session_id: str, var_id: int):
     """
-    Retrieve the size of a specific variable in the session.
+    Retrieve the size (number of elements) of a specific variable in the session, with the
+    `dtype` and `shape` of the payloads it accepts (see VARIABLE_DTYPES). The size of a variable
+    declared without one is -1, and its shape [-1] (see variable_layout).
     """
-    with session_lock:
-        if session_id in sessions and 'var_sizes' in sessions[session_id]:
-            var_sizes = sessions[session_id]['var_sizes']
-            if var_id in var_sizes:
-                return {"var_id": var_id, "size": var_sizes[var_id]}
-            else:
-                raise HTTPException(status_code=404, detail="Variable ID not found in session")
+    async with sessions.lock(session_id, readonly=True) as session:
+        if var_id in session['queues']:
+            dtype, shape = variable_layout(session, var_id)
+            return {"var_id": var_id, "size": session['var_sizes'].get(var_id, -1), "dtype": dtype, "shape": shape}
         else:
-            raise HTTPException(status_code=404, detail="Session not found")
+            raise HTTPException(status_code=404, detail="Variable ID not found in session")
 
 
 @app.get("/receive_data")
-async def receive_data(session_id: str, var_id: int):
+async def receive_data(session_id: str, var_id: int, accept_encoding: Optional[str] = Header(None),
+                       range_header: Optional[str] = Header(None, alias='Range')):
+    """
+    Send the oldest queued payload of a specific variable in a session, or the last received
+    one again if the queue is empty. Its sequence number is sent in the Sequence-Number header,
+    and the dtype and shape of the variable in the Payload-Dtype and Payload-Shape headers.
+
+    The data is sent compressed, with `Content-Encoding: x-shuffle-zlib`, if it is stored
+    compressed and the request lists that encoding in its Accept-Encoding header.
+
+    With a Range header (`elements=first-last`, the last index optional, or
+    `hyperslab=start:stop,...`, see RANGE_UNITS), only the elements of that range are sent, with
+    status 206 (see payload_response); the whole payload is received all the same. Responds with
+    416 if the range lies outside of the variable.
     """
-    Send binary data for a specific variable in a session.
+    seq, binary_data, encoding, layout, part = await take_payload(session_id, var_id, request_selection(range_header))
+    response = await payload_response(binary_data, encoding, accept_encoding, seq, layout, part)
+    count_bytes('sent', session_id, var_id, int(response.headers['content-length']))
+    return response
+
+def request_selection(range_header):
+    """ Return the (unit, selection) of a Range header value (see parse_range), or None without one """
+    return None if range_header is None else parse_range(range_header, '=')[:2]
+
+async def take_payload(session_id, var_id, selection=None):
+    """
+    Take the payload /receive_data serves for a variable and return it as (seq, payload,
+    encoding, layout, part), `layout` being the (dtype, shape) of the variable and `part` the
+    resolved range of a (unit, selection), if given (see resolve_range). The range is resolved
+    before the payload is taken, so that an invalid range leaves the queue as it was.
     """
-    with session_lock:
-        if session_id in sessions and var_id in sessions[session_id]['data']:
-            data = sessions[session_id]['data'][var_id]
-            if data is not None:
-                binary_data = struct.pack('<' + 'd' * len(data), *data)
-                sessions[session_id]['flags'][var_id] = 0  # Reset the flag after data is sent
-                return Response(content=binary_data, media_type='application/octet-stream')
+    async with sessions.lock(session_id, detail="Session or variable not found") as session:
+        if var_id in session['queues']:
+            check_transport(session, var_id, False)
+            part = None if selection is None else resolve_range(session, var_id, *selection)
+            if session['queues'][var_id]:
+                # Resets the flag once the queue is empty
+                return (*dequeue_payload(session, var_id), variable_layout(session, var_id), part)
+            elif session['history'][var_id]:
+                seq, encoding, _ = session['history'][var_id][-1]
+                return seq, session['data'][(var_id, seq)], encoding, variable_layout(session, var_id), part
             else:
                 raise HTTPException(status_code=404, detail="Data not available for variable ID " + str(var_id))
         else:
             raise HTTPException(status_code=404, detail="Session or variable not found")
 
+@app.get("/wait_and_receive_data")
+async def wait_and_receive_data(session_id: str, var_id: int, timeout: float = 30.0,
+                                accept_encoding: Optional[str] = Header(None),
+                                range_header: Optional[str] = Header(None, alias='Range')):
+    """
+    Wait until data is queued for a specific variable, then send the oldest queued payload and
+    remove it from the queue.
+
+    Checking the queue, reading the data and updating the flag happen under a single lock
+    acquisition, so concurrent readers never receive the same data twice. Responds with 408
+    if no data arrived within `timeout` seconds (capped at MAX_WAIT_TIMEOUT). Compression, the
+    Sequence-Number header and ranges are as in /receive_data.
+    """
+    seq, binary_data, encoding, layout, part = await wait_and_take_payload(session_id, var_id, timeout, "/wait_and_receive_data",
+                                                                           selection=request_selection(range_header))
+    response = await payload_response(binary_data, encoding, accept_encoding, seq, layout, part)
+    count_bytes('sent', session_id, var_id, int(response.headers['content-length']))
+    return response
+
+async def wait_and_take_payload(session_id, var_id, timeout, route, shared=False, selection=None):
+    """
+    Wait for a payload to be queued for a variable, dequeue it and return it as (seq, payload,
+    encoding, layout, part) like take_payload. `shared` tells whether the variable is expected to be exchanged through shared memory.
+    """
+    deadline = wait_deadline(timeout)
+    while True:
+        async with sessions.lock(session_id, detail="Session or variable not found") as session:
+            if var_id not in session['queues']:
+                raise HTTPException(status_code=404, detail="Session or variable not found")
+            check_transport(session, var_id, shared)
+            part = None if selection is None else resolve_range(session, var_id, *selection)
+            if session['queues'][var_id]:
+                # Updates the flag as part of the same operation
+                return (*dequeue_payload(session, var_id), variable_layout(session, var_id), part)
+            event = sessions.flag_event(session_id, var_id)
+
+        if not await wait_for_flag_change(event, deadline, route, session_id, var_id):
+            raise HTTPException(status_code=408, detail="Timed out waiting for data for variable ID " + str(var_id))
+
+@app.post("/send_data_batch")
+async def send_data_batch(request: Request, session_id: Optional[str] = Header(None),
+                          payload_dtypes: Optional[str] = Header(None)):
+    """
+    Receive binary data for several variables of a session in one request.
+
+    The body is a sequence of framed records (see BATCH_RECORD_HEADER), each queued like the
+    body of /send_data; their sequence numbers are returned as `seqs`, in record order. The
+    batch is applied all-or-nothing: it is rejected with 409 if it does not fit in the queue of
+    any of its variables, and with 400 if any record does not match the declared size of its
+    variable, or the dtype given for it in the comma-separated Payload-Dtypes header.
+    """
+    if session_id is None:
+        raise HTTPException(status_code=400, detail="Session-ID header missing")
+
+    records = []
+    for var_id, payload in parse_batch(await read_payload(request)):
+        payload, encoding, raw_size = await storage_form(payload, 'identity')
+        records.append((var_id, raw_size, payload, encoding))
+
+    async with sessions.lock(session_id) as session:
+        for var_id, count in Counter(var_id for var_id, _, _, _ in records).items():
+            if var_id not in session['queues']:
+                raise HTTPException(status_code=404, detail="Variable ID " + str(var_id) + " not found in session")
+            check_transport(session, var_id, False)
+            if len(session['queues'][var_id]) + count > session['queue_depths'][var_id]:
+                logger.debug("Queue of variable %s of session %s is full", var_id, session_id)
+                raise HTTPException(status_code=409, detail="Queue for variable ID " + str(var_id) + " is full")
+        dtypes = payload_dtypes.split(",") if payload_dtypes else [None] * len(records)
+        for (var_id, size, _, _), dtype in zip(records, dtypes):
+            check_payload_size(session, var_id, size, dtype)
+
+        seqs = [enqueue_payload(session, var_id, payload, encoding) for var_id, _, payload, encoding in records]
+        for var_id, size, _, _ in records:
+            count_bytes('received', session_id, var_id, size)
+        return {"status": "Binary data received for " + ", ".join(str(var_id) for var_id, _, _, _ in records), "seqs": seqs}
+
+@app.get("/receive_data_batch")
+async def receive_data_batch(session_id: str, var_ids: List[int] = Query(...)):
+    """
+    Send the oldest queued payload of several variables of a session in one framed response,
+    with their sequence numbers, dtypes and shapes in headers (see batch_response).
+
+    The batch is served all-or-nothing: it is rejected with 404 unless new data (flag 1) is
+    queued for every requested variable, in which case it is removed from their queues. Batch
+    responses are never compressed.
+    """
+    async with sessions.lock(session_id) as session:
+        for var_id, count in Counter(var_ids).items():
+            if var_id not in session['queues']:
+                raise HTTPException(status_code=404, detail="Variable ID " + str(var_id) + " not found in session")
+            check_transport(session, var_id, False)
+            if len(session['queues'][var_id]) < count:
+                raise HTTPException(status_code=404, detail="Data not available for variable ID " + str(var_id))
+
+        slots = [(var_id, *dequeue_payload(session, var_id)) for var_id in var_ids]
+        layouts = [variable_layout(session, var_id) for var_id in var_ids]
+    records = [(var_id, await raw_payload(payload, encoding)) for var_id, _, payload, encoding in slots]
+    for var_id, payload in records:
+        count_bytes('sent', session_id, var_id, len(payload))
+    return batch_response(records, [seq for _, seq, _, _ in slots], layouts)
+
+@app.get("/receive_history")
+async def receive_history(session_id: str, var_id: int, start_seq: int, end_seq: Optional[int] = None, timeout: float = 0.0,
+                          range_header: Optional[str] = Header(None, alias='Range')):
+    """
+    Send the payloads of a specific variable with sequence numbers `start_seq` to `end_seq`
+    (inclusive, `start_seq` alone if not given) in one framed response (see HISTORY_RECORD_HEADER),
+    without changing the queue or the flag of the variable.
+
+    Both received payloads still in the history of the variable and queued payloads can be read.
+    Payloads not sent yet are waited for up to `timeout` seconds (capped at MAX_WAIT_TIMEOUT).
+    Responds with 404 if any payload of the range is not stored (anymore) by then. With a Range
+    header, as in /receive_data, only the elements of that range of every payload are sent,
+    which lets every rank of a domain-decomposed consumer read its own part of a step while one
+    of them receives it; the step must be read before `history_length` later steps evict it.
+    History responses are never compressed.
+    """
+    end_seq = start_seq if end_seq is None else end_seq
+    if end_seq < start_seq:
+        raise HTTPException(status_code=400, detail="end_seq must not be lower than start_seq")
+    selection = request_selection(range_header)
+
+    deadline = wait_deadline(timeout)
+    while True:
+        async with sessions.lock(session_id, detail="Session or variable not found", readonly=True) as session:
+            if var_id not in session['queues']:
+                raise HTTPException(status_code=404, detail="Session or variable not found")
+            check_transport(session, var_id, False)
+            part = None if selection is None else resolve_range(session, var_id, *selection)
+            encodings = stored_encodings(session, var_id)
+            missing = next((seq for seq in range(start_seq, end_seq + 1) if seq not in encodings), None)
+            if missing is None:
+                slots = [(seq, session['data'][(var_id, seq)], encodings[seq]) for seq in range(start_seq, end_seq + 1)]
+                layout = variable_layout(session, var_id)
+                break
+            # Payloads sent already but no longer stored were evicted and will not come back
+            if missing <= session['last_seq'][var_id]:
+                raise HTTPException(status_code=404, detail=f"Step {missing} of variable ID {var_id} is not available")
+            event = sessions.flag_event(session_id, var_id)
+
+        if not await wait_for_flag_change(event, deadline, "/receive_history", session_id, var_id):
+            raise HTTPException(status_code=404, detail=f"Step {missing} of variable ID {var_id} is not available")
+
+    records = [(seq, await raw_payload(payload, encoding)) for seq, payload, encoding in slots]
+    if part is not None:
+        runs, shape, _ = part
+        records = [(seq, slice_payload(payload, runs)) for seq, payload in records]
+        layout = (layout[0], shape)
+    count_bytes('sent', session_id, var_id, sum(len(payload) for _, payload in records))
+    return history_response(records, layout)
+
+@app.get("/get_shared_memory_segment")
+async def get_shared_memory_segment(session_id: str, var_id: int):
+    """
+    Describe the shared memory segment of a variable of a same-host session: its `name`, the
+    `size` of a payload in elements, their `dtype` and `shape`, and the number of payload
+    `slots` (see create_shared_segments).
+    """
+    async with sessions.lock(session_id, detail="Session or variable not found", readonly=True) as session:
+        if var_id not in session['queues']:
+            raise HTTPException(status_code=404, detail="Session or variable not found")
+        check_transport(session, var_id, True)
+        dtype, shape = variable_layout(session, var_id)
+        return {"var_id": var_id, "name": session['shared_memory'][var_id], "size": session['var_sizes'][var_id],
+                "dtype": dtype, "shape": shape, "slots": session['queue_depths'][var_id] + 1}
+
+@app.post("/commit_shared_data")
+async def commit_shared_data(session_id: str, var_id: int):
+    """
+    Queue the payload a producer has written to the shared memory segment of a variable, in the
+    slot of the next sequence number, and return that number as `seq` with the queue status
+    (see queue_status).
+
+    Responds with 409 if the queue of the variable is full; producers must wait for queue space
+    before writing to the segment, as the slot may still be read by the consumer otherwise.
+    """
+    async with sessions.lock(session_id, detail="Session or variable not found") as session:
+        if var_id not in session['queues']:
+            raise HTTPException(status_code=404, detail="Session or variable not found")
+        check_transport(session, var_id, True)
+        if len(session['queues'][var_id]) >= session['queue_depths'][var_id]:
+            logger.debug("Queue of variable %s of session %s is full", var_id, session_id)
+            raise HTTPException(status_code=409, detail="Queue for variable ID " + str(var_id) + " is full")
+        seq = enqueue_payload(session, var_id, b"", 'identity')
+        dtype, _ = variable_layout(session, var_id)
+        count_bytes('received', session_id, var_id, session['var_sizes'][var_id] * VARIABLE_DTYPES[dtype])
+        return {**queue_status(session, var_id), "seq": seq}
+
+@app.get("/wait_and_receive_shared_data")
+async def wait_and_receive_shared_data(session_id: str, var_id: int, timeout: float = 30.0):
+    """
+    Wait until a payload is queued for a variable of a same-host session, remove it from the
+    queue and return its sequence number as `seq`, from which the consumer finds its slot in the
+    shared memory segment. The consumer must have copied the payload out before it receives the
+    next one of the variable. Responds with 408 as /wait_and_receive_data.
+    """
+    seq, _, _, _, _ = await wait_and_take_payload(session_id, var_id, timeout, "/wait_and_receive_shared_data", shared=True)
+    return {"var_id": var_id, "seq": seq}
+
 class EndSessionData(BaseModel):
     session_id: str
     user_id: int
 
 @app.post("/end_session")
 async def end_session(data: EndSessionData):
-    with session_lock:
-        session_id = data.session_id
-        user_id = data.user_id  # Updated to use 'user_id'
+    session_id = data.session_id
+    user_id = data.user_id  # Updated to use 'user_id'
 
-        if session_id not in sessions:
-            raise HTTPException(status_code=404, detail="Session not found")
-
-        session = sessions[session_id]
+    async with sessions.lock(session_id) as session:
         if user_id not in session['client_vars']:
             raise HTTPException(status_code=404, detail="User not part of the session")
 
@@ -226,23 +2083,80 @@ async def end_session(data: EndSessionData):
             session['status'] = 'partial end'
             vars_to_clear = session['client_vars'][user_id]
             for var in vars_to_clear:
-                print ("Variable Clearing:", var)
-                if var in session['data']:
-                    session['data'][var] = None
-                    session['flags'][var] = 0
+                logger.debug("Clearing variable %s of session %s", var, session_id)
+                if var in session['queues']:
+                    clear_variable(session, var)
+            logger.info("Session %s ended by user %s", session_id, user_id)
             return {"status": "Partial session end for user " + str(user_id), "session_id": session_id}
         else:
             session['status'] = 'end'
-            del sessions[session_id]
+            # Also wakes any request still waiting on this session so that it can report the session is gone
+            sessions.remove(session_id)
+            release_shared_segments(session.get('shared_memory', {}).values())
+            metrics.forget(session_id=session_id)
+            logger.info("Session %s ended", session_id)
             return {"status": "Session ended successfully", "session_id": session_id}
         
 if __name__ == '__main__':
     def main():
-        # Task to print sessions periodically
-        loop = asyncio.get_event_loop()
-        loop.create_task(print_sessions_every_n_seconds())
-        
-        # Start the server with Uvicorn
-        uvicorn.run(app, host='0.0.0.0', port=8000)
+        global STORE_COMPRESSED, BINARY_PORT, BINARY_HOST, sessions
+        parser = argparse.ArgumentParser(description="Data exchange server")
+        parser.add_argument('--host', default='0.0.0.0')
+        parser.add_argument('--port', type=int, default=8000)
+        parser.add_argument('--workers', type=int, default=1,
+                            help="Number of worker processes; more than one requires the shared session store")
+        parser.add_argument('--store', choices=['memory', 'shared'], default=os.environ.get('EXCHANGE_SESSION_STORE', 'memory'),
+                            help="Session store backend (see create_session_store)")
+        parser.add_argument('--store-dir', default=os.environ.get('EXCHANGE_STORE_DIR', DEFAULT_SHARED_STORE_DIR),
+                            help="Directory of the shared session store")
+        parser.add_argument('--store-compressed', action='store_true', default=STORE_COMPRESSED,
+                            help="Keep payloads compressed in the session store")
+        parser.add_argument('--spill-dir', default=os.environ.get('EXCHANGE_SPILL_DIR'),
+                            help="Directory to which the memory store spills payloads, preferably on a local disk")
+        parser.add_argument('--spill-memory-limit', type=int, default=os.environ.get('EXCHANGE_SPILL_MEMORY_LIMIT'),
+                            help="Bytes of payloads held in memory above which the least recently used sessions are spilled")
+        parser.add_argument('--spill-idle-seconds', type=float, default=os.environ.get('EXCHANGE_SPILL_IDLE_SECONDS'),
+                            help="Seconds after which the payloads of an unused session are spilled")
+        parser.add_argument('--journal-dir', default=os.environ.get('EXCHANGE_JOURNAL_DIR'),
+                            help="Directory in which the memory store journals sessions, which are recovered from it on restart")
+        parser.add_argument('--log-level', choices=['debug', 'info', 'warning', 'error'],
+                            default=os.environ.get('EXCHANGE_LOG_LEVEL', 'info').lower(),
+                            help="Lowest level of the messages logged; requests are only logged at debug level")
+        parser.add_argument('--journal-fsync', action='store_true', default=os.environ.get('EXCHANGE_JOURNAL_FSYNC', '0') == '1',
+                            help="Sync the journal to disk after every write, to survive a crash of the host")
+        parser.add_argument('--binary-port', type=int, default=BINARY_PORT,
+                            help="Port of the binary transport listener, on the same host; by default only HTTP is served")
+        args = parser.parse_args()
+
+        if args.workers > 1 and args.store != 'shared':
+            parser.error("--workers > 1 requires --store shared")
+        if args.spill_dir is not None and args.store != 'memory':
+            parser.error("--spill-dir requires --store memory")
+        if args.journal_dir is not None and args.store != 'memory':
+            parser.error("--journal-dir requires --store memory; the shared store keeps its sessions in files already")
+
+        # Start the server with Uvicorn; background tasks are started by startup_event.
+        # The per-request access log is only written at debug level, as it would slow down every exchange
+        configure_logging(args.log_level)
+        os.environ['EXCHANGE_LOG_LEVEL'] = args.log_level
+        BINARY_PORT, BINARY_HOST = args.binary_port, args.host
+        if args.binary_port is not None:
+            os.environ['EXCHANGE_BINARY_PORT'] = str(args.binary_port)
+            os.environ['EXCHANGE_BINARY_HOST'] = args.host
+        if args.workers == 1 and args.store == 'memory':
+            STORE_COMPRESSED = args.store_compressed
+            journal = None
+            if args.journal_dir is not None:
+                journal = SessionJournal(args.journal_dir, fsync=args.journal_fsync)
+            sessions = InProcessSessionStore(args.spill_dir, args.spill_memory_limit, args.spill_idle_seconds, journal)
+            uvicorn.run(app, host=args.host, port=args.port, log_level=args.log_level, access_log=args.log_level == 'debug')
+        else:
+            # Worker processes import the app themselves and pick the store up from the environment
+            os.environ['EXCHANGE_SESSION_STORE'] = args.store
+            os.environ['EXCHANGE_STORE_DIR'] = args.store_dir
+            os.environ['EXCHANGE_STORE_COMPRESSED'] = '1' if args.store_compressed else '0'
+            uvicorn.run("exchange_server:app", host=args.host, port=args.port, workers=args.workers,
+                        app_dir=os.path.dirname(os.path.abspath(__file__)), log_level=args.log_level,
+                        access_log=args.log_level == 'debug')
 
     main()
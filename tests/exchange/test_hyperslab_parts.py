@@ -0,0 +1,115 @@
+import itertools
+import unittest
+
+import numpy as np
+from fastapi import HTTPException
+
+import exchange_server
+
+
+def session_with(shape, dtype='float64'):
+    """ A session holding variable 1 of the given shape and dtype, as create_session lays it out """
+    return {'var_sizes': {1: int(np.prod(shape))}, 'var_dtypes': {1: dtype}, 'var_shapes': {1: list(shape)},
+            'data': {}}
+
+
+class TestSlabRuns(unittest.TestCase):
+    """ The byte runs of a hyperslab select the same elements as NumPy slicing """
+
+    def test_runs_match_numpy(self):
+        shape = (3, 4, 5)
+        elements = np.arange(np.prod(shape)).reshape(shape)
+        for starts in itertools.product(range(2), range(3), range(4)):
+            for counts in [(1, 1, 1), (2, 1, 1), (1, 4 - starts[1], 5 - starts[2]), (3 - starts[0], 1, 1),
+                           (1, 1, 5 - starts[2]), (3 - starts[0], 4 - starts[1], 1)]:
+                selected = elements[tuple(slice(start, start + count) for start, count in zip(starts, counts))]
+                runs = exchange_server.slab_runs(list(shape), list(starts), list(counts), 8)
+                offsets = [offset // 8 + index for offset, length in runs for index in range(length // 8)]
+                self.assertEqual(offsets, selected.ravel().tolist(), (starts, counts))
+
+    def test_full_inner_dimensions_are_merged(self):
+        runs = exchange_server.slab_runs([3, 4, 5], [1, 0, 0], [2, 4, 5], 4)
+        self.assertEqual(runs, [(80, 160)])
+
+
+class TestResolveRange(unittest.TestCase):
+    """ Malformed ranges get 400, well-formed ranges outside of the variable 416 """
+
+    def assertStatus(self, status_code, unit, selection, shape=(2, 3, 4)):
+        with self.assertRaises(HTTPException) as context:
+            exchange_server.resolve_range(session_with(shape), 1, unit, selection)
+        self.assertEqual(context.exception.status_code, status_code, context.exception.detail)
+
+    def test_malformed(self):
+        self.assertStatus(400, 'hyperslab', '0:2,0:3')
+        self.assertStatus(400, 'hyperslab', '0:2,0:3,0:4,0:1')
+        self.assertStatus(400, 'hyperslab', '0', shape=())
+        self.assertStatus(400, 'hyperslab', '0:2,2:1,0:4')
+        self.assertStatus(400, 'hyperslab', '0:2,1:1,0:4')
+        self.assertStatus(400, 'hyperslab', '0:2,a,0:4')
+        self.assertStatus(400, 'elements', '5-3')
+        self.assertStatus(400, 'elements', '-3')
+
+    def test_outside(self):
+        self.assertStatus(416, 'hyperslab', '0:3,0:3,0:4')
+        self.assertStatus(416, 'hyperslab', '2,0:3,0:4')
+        self.assertStatus(416, 'hyperslab', '-1:1,0:3,0:4')
+        self.assertStatus(416, 'elements', '24-30')
+
+    def test_selection(self):
+        runs, shape, content_range = exchange_server.resolve_range(session_with((2, 3, 4)), 1, 'hyperslab', '1,0:2,:')
+        self.assertEqual((runs, shape, content_range), ([(96, 64)], [1, 2, 4], "hyperslab 1:2,0:2,0:4/2,3,4"))
+
+
+class TestPartAssembly(unittest.TestCase):
+    """ Hyperslab parts of a multi-dimensional variable are assembled into its payload """
+
+    PARTS = ['0,:,:', '1,0:2,:', '1,2,0:3', '1,2,3:4']
+
+    def setUp(self):
+        self.session = session_with((2, 3, 4), 'int32')
+        self.values = np.arange(24, dtype='<i4').reshape(2, 3, 4) * 7
+
+    def part(self, selection):
+        index = tuple(int(dim) if ':' not in dim else slice(*(int(bound) if bound else None for bound in dim.split(':')))
+                      for dim in selection.split(','))
+        return np.ascontiguousarray(self.values[index]).tobytes()
+
+    def test_assembly(self):
+        covered = 0
+        for selection in self.PARTS:
+            covered = exchange_server.store_part(self.session, 1, self.part(selection), 'hyperslab', selection)
+        self.assertEqual(covered, self.values.nbytes)
+        payload = exchange_server.assemble_parts(self.session, 1, self.values.nbytes)
+        self.assertEqual(bytes(payload), self.values.tobytes())
+        self.assertEqual(self.session['data'], {})
+        self.assertNotIn(1, self.session['parts'])
+
+    def test_assembly_in_any_order(self):
+        for selection in reversed(self.PARTS):
+            exchange_server.store_part(self.session, 1, self.part(selection), 'hyperslab', selection)
+        payload = exchange_server.assemble_parts(self.session, 1, self.values.nbytes)
+        self.assertEqual(bytes(payload), self.values.tobytes())
+
+    def test_overlapping_part(self):
+        exchange_server.store_part(self.session, 1, self.part('1,0:2,:'), 'hyperslab', '1,0:2,:')
+        with self.assertRaises(HTTPException) as context:
+            exchange_server.store_part(self.session, 1, self.part('1,1:3,0:2'), 'hyperslab', '1,1:3,0:2')
+        self.assertEqual(context.exception.status_code, 400)
+        self.assertEqual(len(self.session['parts'][1]), 1)
+
+    def test_part_of_wrong_size(self):
+        with self.assertRaises(HTTPException) as context:
+            exchange_server.store_part(self.session, 1, self.part('0,:,:')[:-4], 'hyperslab', '0,:,:')
+        self.assertEqual(context.exception.status_code, 400)
+
+    def test_dropped_parts(self):
+        exchange_server.store_part(self.session, 1, self.part('0,:,:'), 'hyperslab', '0,:,:')
+        exchange_server.drop_parts(self.session, 1)
+        self.assertEqual(self.session['data'], {})
+        self.assertEqual(exchange_server.store_part(self.session, 1, self.part('0,:,:'), 'hyperslab', '0,:,:'),
+                         self.values.nbytes // 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
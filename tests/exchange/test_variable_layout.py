@@ -0,0 +1,103 @@
+import contextlib
+import os
+import re
+import socket
+import subprocess
+import sys
+import time
+import unittest
+
+import numpy as np
+
+from clients.cyberwater.lib import low_level_api
+from clients.cyberwater.lib.binary_api import BinaryExchangeClient
+
+SERVER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir, 'src', 'server')
+PORT = 18851
+BINARY_PORT = 18852
+SERVER_URL = f"http://127.0.0.1:{PORT}"
+
+
+@contextlib.contextmanager
+def exchange_server():
+    """ Runs an exchange server with the binary transport on PORT and BINARY_PORT """
+    server = subprocess.Popen([sys.executable, 'exchange_server.py', '--host', '127.0.0.1', '--port', str(PORT),
+                               '--binary-port', str(BINARY_PORT)],
+                              cwd=SERVER_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        deadline = time.monotonic() + 30
+        while True:
+            try:
+                socket.create_connection(('127.0.0.1', PORT), timeout=1).close()
+                break
+            except OSError:
+                if server.poll() is not None or time.monotonic() > deadline:
+                    raise RuntimeError("The exchange server did not start")
+                time.sleep(0.1)
+        yield
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def requests_served(route):
+    """ Number of requests the server has served on a route, from its /metrics """
+    text = low_level_api._client.get(f"{SERVER_URL}/metrics").text
+    pattern = r'^exchange_requests_total\{[^}]*route="' + re.escape(route) + r'"[^}]*\} (\S+)$'
+    return sum(float(value) for value in re.findall(pattern, text, re.MULTILINE))
+
+
+class TestVariableLayout(unittest.TestCase):
+    """ The layout of a variable is asked for once, even if the variable was declared without a size """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = exchange_server()
+        cls.server.__enter__()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.__exit__(None, None, None)
+
+    def start_session(self, run):
+        # Variable 1 is declared with a dtype but without a size
+        info = low_level_api.create_session(SERVER_URL, 900 + run, 1, 1, 2, input_variables_ID=[1],
+                                            input_variables_size=[], input_variables_dtype=['float32'])
+        self.assertIn('session_id', info, info)
+        session_id = info['session_id']
+        self.assertTrue(low_level_api.join_session(SERVER_URL, session_id, 2)['success'])
+        self.addCleanup(low_level_api.end_session, SERVER_URL, session_id, 2)
+        self.addCleanup(low_level_api.end_session, SERVER_URL, session_id, 1)
+        return session_id
+
+    def test_variable_info_without_size(self):
+        session_id = self.start_session(1)
+        info = low_level_api.get_variable_info(SERVER_URL, session_id, 1)
+        self.assertEqual(info, {"var_id": 1, "size": -1, "dtype": "float32", "shape": [-1]})
+
+    def test_http_sends_ask_once(self):
+        session_id = self.start_session(2)
+        before = requests_served('/get_variable_size')
+        for step in range(5):
+            response = low_level_api.send_data(SERVER_URL, session_id, 1, np.arange(step + 1.0))
+            self.assertTrue(response.ok, response.text)
+            received = low_level_api.receive_data(SERVER_URL, session_id, 1)
+            self.assertEqual(received.dtype, np.float32)
+            self.assertEqual(received.tolist(), list(range(step + 1)))
+        self.assertEqual(requests_served('/get_variable_size') - before, 1)
+
+    def test_binary_exchanges_ask_once(self):
+        session_id = self.start_session(3)
+        before = requests_served('binary:get_variable_size')
+        with BinaryExchangeClient('127.0.0.1', BINARY_PORT) as client:
+            for step in range(5):
+                status_code, _ = client.send_data(session_id, 1, np.arange(step + 1.0))
+                self.assertEqual(status_code, 200)
+                received = client.receive_data(session_id, 1)
+                self.assertEqual(received.dtype, np.float32)
+                self.assertEqual(received.tolist(), list(range(step + 1)))
+        self.assertEqual(requests_served('binary:get_variable_size') - before, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()